@@ -6,7 +6,7 @@ import enum
 import torch.nn as nn
 import torch.nn.functional as F
 
-from modules import sd_models, cache, errors, hashes, shared
+from modules import sd_models, cache, errors, hashes, shared, safetensors_header
 import modules.models.sd3.mmdit
 
 NetworkWeights = namedtuple('NetworkWeights', ['network_key', 'sd_key', 'w', 'sd_module'])
@@ -21,6 +21,25 @@ class SdVersion(enum.Enum):
     SDXL = 4
 
 
+def detect_version_from_header(filename):
+    """Tells which model a .safetensors network was trained for from names and shapes of its tensors, without reading weights."""
+
+    header = safetensors_header.read_header(filename)
+    context_dims = {768: SdVersion.SD1, 1024: SdVersion.SD2, 2048: SdVersion.SDXL}
+
+    for key, (_, shape) in header.tensors.items():
+        if key.startswith("lora_te2_") or key.startswith("lora_te1_"):
+            return SdVersion.SDXL
+
+        # cross attention key projection takes text encoder output as input, so its width is the text encoder's
+        if ("attn2_to_k" in key or "attn2.to_k" in key) and key.endswith("down.weight") and len(shape) == 2:
+            version = context_dims.get(shape[1])
+            if version is not None:
+                return version
+
+    return SdVersion.Unknown
+
+
 class NetworkOnDisk:
     def __init__(self, name, filename):
         self.name = name
@@ -28,14 +47,9 @@ class NetworkOnDisk:
         self.metadata = {}
         self.is_safetensors = os.path.splitext(filename)[1].lower() == ".safetensors"
 
-        def read_metadata():
-            metadata = sd_models.read_metadata_from_safetensors(filename)
-
-            return metadata
-
         if self.is_safetensors:
             try:
-                self.metadata = cache.cached_data_for_file('safetensors-metadata', "lora/" + self.name, filename, read_metadata)
+                self.metadata = sd_models.read_metadata_from_safetensors(filename)
             except Exception as e:
                 errors.display(e, f"reading lora {filename}")
 
@@ -63,7 +77,18 @@ class NetworkOnDisk:
             return SdVersion.SDXL
         elif str(self.metadata.get('ss_v2', "")) == "True":
             return SdVersion.SD2
-        elif len(self.metadata):
+        elif str(self.metadata.get('ss_v2', "")) == "False" or str(self.metadata.get('ss_base_model_version', "")).startswith("sd_v1"):
+            return SdVersion.SD1
+
+        if self.is_safetensors:
+            try:
+                version = cache.cached_data_for_file('lora-architecture', os.path.abspath(self.filename), self.filename, lambda: detect_version_from_header(self.filename).name)
+                if version != SdVersion.Unknown.name:
+                    return SdVersion[version]
+            except Exception as e:
+                errors.display(e, f"detecting version of lora {self.filename}")
+
+        if len(self.metadata):
             return SdVersion.SD1
 
         return SdVersion.Unknown
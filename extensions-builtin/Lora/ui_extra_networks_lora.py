@@ -27,6 +27,8 @@ class ExtraNetworksPageLora(ui_extra_networks.ExtraNetworksPage):
         search_terms = [self.search_terms_from_path(lora_on_disk.filename)]
         if lora_on_disk.hash:
             search_terms.append(lora_on_disk.hash)
+        if lora_on_disk.sd_version != network.SdVersion.Unknown:
+            search_terms.append(lora_on_disk.sd_version.name)
         item = {
             "name": name,
             "filename": lora_on_disk.filename,
@@ -47,6 +47,11 @@ function setupExtraNetworksForTab(tabname) {
         }
 
         var applyFilter = function(force) {
+            if (extraNetworksPagedCards(tabname_full)) {
+                extraNetworksLoadCards(tabname, tabname_full, false, force);
+                return;
+            }
+
             var searchTerm = search.value.toLowerCase();
             gradioApp().querySelectorAll('#' + tabname + '_extra_tabs div.card').forEach(function(elem) {
                 var searchOnly = elem.querySelector('.search_only');
@@ -69,6 +74,11 @@ function setupExtraNetworksForTab(tabname) {
         };
 
         var applySort = function(force) {
+            if (extraNetworksPagedCards(tabname_full)) {
+                extraNetworksLoadCards(tabname, tabname_full, false, force);
+                return;
+            }
+
             var cards = gradioApp().querySelectorAll('#' + tabname_full + ' div.card');
             var parent = gradioApp().querySelector('#' + tabname_full + "_cards");
             var reverse = sort_dir.dataset.sortdir == "Descending";
@@ -185,8 +195,67 @@ function applyExtraNetworkSort(tabname_full) {
 
 var extraNetworksApplyFilter = {};
 var extraNetworksApplySort = {};
+var extraNetworksCardsRequests = {};
 var activePromptTextarea = {};
 
+function extraNetworksPagedCards(tabname_full) {
+    var parent = gradioApp().querySelector('#' + tabname_full + "_cards");
+    return parent && parseInt(parent.dataset.pageSize) > 0 ? parent : null;
+}
+
+function extraNetworksLoadCards(tabname, tabname_full, append, force) {
+    // loads cards from server when they are paginated; either replaces all cards (when search or sort changes), or adds the next page of them
+    var parent = extraNetworksPagedCards(tabname_full);
+    if (!parent) return;
+
+    var search = gradioApp().querySelector("#" + tabname_full + "_extra_search");
+    var sortDir = gradioApp().querySelector("#" + tabname_full + "_extra_sort_dir");
+    var activeSortElem = gradioApp().querySelector('#' + tabname_full + "_controls .extra-network-control--sort.extra-network-control--enabled");
+    var params = {
+        page: parent.dataset.extraPage,
+        tabname: tabname,
+        search: search ? search.value.toLowerCase() : "",
+        sort: activeSortElem ? activeSortElem.dataset.sortkey : "default",
+        sort_dir: sortDir ? sortDir.dataset.sortdir : "Ascending",
+        limit: parent.dataset.pageSize,
+    };
+    var state = JSON.stringify(params);
+
+    if (append) {
+        var loaded = parent.querySelectorAll(':scope > .card').length;
+        if (parent.dataset.loading || parent.dataset.state != state || loaded >= parseInt(parent.dataset.total)) return;
+        params.offset = loaded;
+    } else {
+        if (parent.dataset.state == state && !force) return;
+        params.offset = 0;
+    }
+
+    var requestId = (extraNetworksCardsRequests[tabname_full] || 0) + 1;
+    extraNetworksCardsRequests[tabname_full] = requestId;
+    parent.dataset.loading = "1";
+
+    requestGet("./sd_extra_networks/cards", params, function(data) {
+        if (extraNetworksCardsRequests[tabname_full] != requestId) return;
+
+        delete parent.dataset.loading;
+        parent.dataset.state = state;
+        parent.dataset.total = data.total;
+        if (!append) {
+            parent.innerHTML = '';
+            parent.scrollTop = 0;
+        }
+        parent.insertAdjacentHTML('beforeend', data.html);
+
+        if (parent.scrollHeight <= parent.clientHeight) {
+            extraNetworksLoadCards(tabname, tabname_full, true);
+        }
+    }, function() {
+        if (extraNetworksCardsRequests[tabname_full] == requestId) {
+            delete parent.dataset.loading;
+        }
+    });
+}
+
 function setupExtraNetworks() {
     setupExtraNetworksForTab('txt2img');
     setupExtraNetworksForTab('img2img');
@@ -615,6 +684,16 @@ function scheduleAfterScriptsCallbacks() {
 }
 
 onUiLoaded(function() {
+    // scroll events do not bubble, so this listens in capture phase to catch scrolling of any paginated cards container
+    gradioApp().addEventListener("scroll", function(event) {
+        var parent = event.target;
+        if (!parent.classList || !parent.classList.contains("extra-network-cards") || !(parseInt(parent.dataset.pageSize) > 0)) return;
+        if (parent.scrollTop + 2 * parent.clientHeight < parent.scrollHeight) return;
+
+        var tabname_full = parent.id.replace(/_cards$/, '');
+        extraNetworksLoadCards(tabname_full.split('_')[0], tabname_full, true);
+    }, true);
+
     var mutationObserver = new MutationObserver(function(m) {
         let existingSearchfields = gradioApp().querySelectorAll("[id$='_extra_search']").length;
         let neededSearchfields = gradioApp().querySelectorAll("[id$='_extra_tabs'] > .tab-nav > button").length - 2;
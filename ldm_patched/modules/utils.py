@@ -4,7 +4,6 @@
 
 import torch
 import math
-import struct
 import ldm_patched.modules.checkpoint_pickle
 import safetensors.torch
 import numpy as np
@@ -271,12 +270,8 @@ def convert_sd_to(state_dict, dtype):
     return state_dict
 
 def safetensors_header(safetensors_path, max_size=100*1024*1024):
-    with open(safetensors_path, "rb") as f:
-        header = f.read(8)
-        length_of_header = struct.unpack('<Q', header)[0]
-        if length_of_header > max_size:
-            return None
-        return f.read(length_of_header)
+    from modules.safetensors_header import read_header_bytes
+    return read_header_bytes(safetensors_path, max_size=max_size)
 
 def set_attr(obj, attr, value):
     attrs = attr.split(".")
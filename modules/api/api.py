@@ -1,5 +1,7 @@
 import base64
 import io
+import itertools
+import json
 import os
 import time
 import datetime
@@ -12,7 +14,7 @@ from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from secrets import compare_digest
 
@@ -215,6 +217,7 @@ class Api:
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
+        self.add_api_route("/sdapi/v1/interrogate-batch", self.interrogatebatchapi, methods=["POST"], response_model=models.InterrogateBatchResponse)
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
         self.add_api_route("/sdapi/v1/options", self.get_config, methods=["GET"], response_model=models.OptionsModel)
@@ -646,6 +649,32 @@ class Api:
 
         return models.InterrogateResponse(caption=processed)
 
+    def interrogatebatchapi(self, req: models.InterrogateBatchRequest):
+        if req.model == "clip":
+            def interrogate(imgs):
+                # decode and caption one batch at a time so that streamed captions are sent as soon as they are ready
+                batch_size = max(int(shared.opts.interrogate_batch_size), 1)
+                while batch := list(itertools.islice(imgs, batch_size)):
+                    for caption in shared.interrogator.interrogate_batch(batch):
+                        if caption is None:  # interrupted
+                            return
+
+                        yield caption
+        elif req.model == "deepdanbooru":
+            interrogate = deepbooru.model.tag_batch
+        else:
+            raise HTTPException(status_code=404, detail="Model not found")
+
+        def captions():
+            imgs = (decode_base64_to_image(image_b64).convert('RGB') for image_b64 in req.images)
+            with self.queue_lock:
+                yield from interrogate(imgs)
+
+        if req.stream:
+            return StreamingResponse((json.dumps({"index": i, "caption": caption}) + "\n" for i, caption in enumerate(captions())), media_type="application/x-ndjson")
+
+        return models.InterrogateBatchResponse(captions=list(captions()))
+
     def interruptapi(self):
         shared.state.interrupt()
 
@@ -725,7 +754,7 @@ class Api:
 
     def get_sd_models(self):
         import modules.sd_models as sd_models
-        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in sd_models.checkpoints_list.values()]
+        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x), "architecture": x.architecture} for x in sd_models.checkpoints_list.values()]
 
     def get_sd_vaes(self):
         import modules.sd_vae as sd_vae
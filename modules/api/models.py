@@ -200,6 +200,14 @@ class InterrogateRequest(BaseModel):
 class InterrogateResponse(BaseModel):
     caption: str = Field(default=None, title="Caption", description="The generated caption for the image.")
 
+class InterrogateBatchRequest(BaseModel):
+    images: list[str] = Field(default=[], title="Images", description="Images to work on, must be Base64 strings containing the images' data.")
+    model: str = Field(default="deepdanbooru", title="Model", description="The interrogate model used.")
+    stream: bool = Field(default=False, title="Stream", description="Send captions as newline-delimited JSON objects with index and caption as soon as they are ready, instead of a single response.")
+
+class InterrogateBatchResponse(BaseModel):
+    captions: list[str] = Field(default=[], title="Captions", description="The generated captions, in the same order as images.")
+
 class TrainResponse(BaseModel):
     info: str = Field(title="Train info", description="Response string from train embedding or hypernetwork task.")
 
@@ -259,6 +267,7 @@ class SDModelItem(BaseModel):
     sha256: Optional[str] = Field(title="sha256 hash")
     filename: str = Field(title="Filename")
     config: Optional[str] = Field(title="Config file")
+    architecture: Optional[str] = Field(title="Architecture")
 
 class SDVaeItem(BaseModel):
     model_name: str = Field(title="Model Name")
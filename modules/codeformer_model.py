@@ -34,7 +34,7 @@ class FaceRestorerCodeFormer(face_restoration_utils.CommonFaceRestoration):
             download_name=model_download_name,
             ext_filter=['.pth'],
         ):
-            return modelloader.load_spandrel_model(
+            return modelloader.load_spandrel_model_from_file(
                 model_path,
                 device=devices.device_codeformer,
                 expected_architecture='CodeFormer',
@@ -45,6 +45,9 @@ class FaceRestorerCodeFormer(face_restoration_utils.CommonFaceRestoration):
         return devices.device_codeformer
 
     def restore(self, np_image, w: float | None = None):
+        return self.restore_batch([np_image], w=w)[0]
+
+    def restore_batch(self, np_images, w: float | None = None):
         if w is None:
             w = getattr(shared.opts, "code_former_weight", 0.5)
 
@@ -52,7 +55,7 @@ class FaceRestorerCodeFormer(face_restoration_utils.CommonFaceRestoration):
             assert self.net is not None
             return self.net(cropped_face_t, weight=w, adain=True)[0]
 
-        return self.restore_with_helper(np_image, restore_face)
+        return self.restore_batch_with_helper(np_images, restore_face)
 
 
 def setup_model(dirname: str) -> None:
@@ -23,6 +23,8 @@ class DeepDanbooru:
             self.dtype = torch.float16
 
         self.patcher = None
+        self.allowed_tags = None
+        self.tags_order = None
 
     def load(self):
         if self.model is not None:
@@ -57,53 +59,91 @@ class DeepDanbooru:
 
         return res
 
+    def tag_batch(self, pil_images, force_disable_ranks=False):
+        """
+        Tags many images, loading the model once for all of them. Images can come from any iterable and are
+        processed in batches of deepbooru_batch_size; captions are yielded in order as soon as their batch is done.
+        """
+        self.start()
+        try:
+            yield from self.tag_multi_batch(pil_images, force_disable_ranks=force_disable_ranks)
+        finally:
+            self.stop()
+
     def tag_multi(self, pil_image, force_disable_ranks=False):
+        return next(self.tag_multi_batch([pil_image], force_disable_ranks=force_disable_ranks))
+
+    def tag_multi_batch(self, pil_images, force_disable_ranks=False):
+        batch_size = max(int(shared.opts.deepbooru_batch_size), 1)
+
+        batch = []
+        for pil_image in pil_images:
+            batch.append(pil_image)
+            if len(batch) >= batch_size:
+                yield from self.tag_images(batch, force_disable_ranks)
+                batch = []
+
+        if batch:
+            yield from self.tag_images(batch, force_disable_ranks)
+
+    def allowed_tags_mask(self):
+        """Boolean tensor with False for tags that are never included in results: ratings and tags from deepbooru_filter_tags."""
+
+        key = (shared.opts.deepbooru_filter_tags, len(self.model.tags))
+        if self.allowed_tags is None or self.allowed_tags[0] != key:
+            filtertags = {x.strip().replace(' ', '_') for x in shared.opts.deepbooru_filter_tags.split(",")}
+            mask = torch.tensor([not tag.startswith("rating:") and tag not in filtertags for tag in self.model.tags], dtype=torch.bool)
+            self.allowed_tags = (key, mask)
+
+        return self.allowed_tags[1]
+
+    def alphabetical_order(self):
+        """Position of every tag in alphabetically sorted list of all tags."""
+
+        if self.tags_order is None or len(self.tags_order) != len(self.model.tags):
+            order = sorted(range(len(self.model.tags)), key=lambda i: self.model.tags[i])
+            self.tags_order = torch.empty(len(order), dtype=torch.long)
+            self.tags_order[order] = torch.arange(len(order))
+
+        return self.tags_order
+
+    def tag_images(self, pil_images, force_disable_ranks=False):
         threshold = shared.opts.interrogate_deepbooru_score_threshold
         use_spaces = shared.opts.deepbooru_use_spaces
         use_escape = shared.opts.deepbooru_escape
         alpha_sort = shared.opts.deepbooru_sort_alpha
         include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
 
-        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
+        pics = [np.array(images.resize_image(2, pil_image.convert("RGB"), 512, 512), dtype=np.float32) for pil_image in pil_images]
+        a = np.stack(pics) / 255
 
         with torch.no_grad():
             x = torch.from_numpy(a).to(self.load_device, self.dtype)
-            y = self.model(x)[0].detach().cpu().numpy()
-
-        probability_dict = {}
-
-        for tag, probability in zip(self.model.tags, y):
-            if probability < threshold:
-                continue
-
-            if tag.startswith("rating:"):
-                continue
-
-            probability_dict[tag] = probability
+            y = self.model(x).detach().float().cpu()
 
-        if alpha_sort:
-            tags = sorted(probability_dict)
-        else:
-            tags = [tag for tag, _ in sorted(probability_dict.items(), key=lambda x: -x[1])]
+        selected = (y >= threshold) & self.allowed_tags_mask()
 
-        res = []
+        for probabilities, mask in zip(y, selected):
+            indices = mask.nonzero().squeeze(1)
 
-        filtertags = {x.strip().replace(' ', '_') for x in shared.opts.deepbooru_filter_tags.split(",")}
+            if alpha_sort:
+                indices = indices[self.alphabetical_order()[indices].argsort()]
+            else:
+                indices = indices[probabilities[indices].argsort(descending=True, stable=True)]
 
-        for tag in [x for x in tags if x not in filtertags]:
-            probability = probability_dict[tag]
-            tag_outformat = tag
-            if use_spaces:
-                tag_outformat = tag_outformat.replace('_', ' ')
-            if use_escape:
-                tag_outformat = re.sub(re_special, r'\\\1', tag_outformat)
-            if include_ranks:
-                tag_outformat = f"({tag_outformat}:{probability:.3f})"
+            res = []
+            for index, probability in zip(indices.tolist(), probabilities[indices].tolist()):
+                tag_outformat = self.model.tags[index]
+                if use_spaces:
+                    tag_outformat = tag_outformat.replace('_', ' ')
+                if use_escape:
+                    tag_outformat = re.sub(re_special, r'\\\1', tag_outformat)
+                if include_ranks:
+                    tag_outformat = f"({tag_outformat}:{probability:.3f})"
 
-            res.append(tag_outformat)
+                res.append(tag_outformat)
 
-        return ", ".join(res)
+            yield ", ".join(res)
 
 
 model = DeepDanbooru()
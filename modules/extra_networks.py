@@ -3,24 +3,31 @@ import os
 import re
 import logging
 from collections import defaultdict
+from functools import lru_cache
 
 from modules import errors
 
 extra_network_registry = {}
 extra_network_aliases = {}
 
+extra_network_lookup_cache = {}
+"""name used in prompt -> ExtraNetwork object or None; cleared whenever registry or aliases change"""
+
 
 def initialize():
     extra_network_registry.clear()
     extra_network_aliases.clear()
+    extra_network_lookup_cache.clear()
 
 
 def register_extra_network(extra_network):
     extra_network_registry[extra_network.name] = extra_network
+    extra_network_lookup_cache.clear()
 
 
 def register_extra_network_alias(extra_network, alias):
     extra_network_aliases[alias] = extra_network
+    extra_network_lookup_cache.clear()
 
 
 def register_default_extra_networks():
@@ -108,11 +115,7 @@ def lookup_extra_networks(extra_network_data):
     res = {}
 
     for extra_network_name, extra_network_args in list(extra_network_data.items()):
-        extra_network = extra_network_registry.get(extra_network_name, None)
-        alias = extra_network_aliases.get(extra_network_name, None)
-
-        if alias is not None and extra_network is None:
-            extra_network = alias
+        extra_network = find_extra_network(extra_network_name)
 
         if extra_network is None:
             logging.info(f"Skipping unknown extra network: {extra_network_name}")
@@ -123,6 +126,20 @@ def lookup_extra_networks(extra_network_data):
     return res
 
 
+def find_extra_network(name):
+    """returns ExtraNetwork object registered under the name or the alias, or None"""
+
+    if name in extra_network_lookup_cache:
+        return extra_network_lookup_cache[name]
+
+    extra_network = extra_network_registry.get(name, None)
+    if extra_network is None:
+        extra_network = extra_network_aliases.get(name, None)
+
+    extra_network_lookup_cache[name] = extra_network
+    return extra_network
+
+
 def activate(p, extra_network_data):
     """call activate for extra networks in extra_network_data in specified order, then call
     activate for all remaining registered networks with an empty argument list"""
@@ -175,18 +192,27 @@ def deactivate(p, extra_network_data):
 re_extra_net = re.compile(r"<(\w+):([^>]+)>")
 
 
-def parse_prompt(prompt):
-    res = defaultdict(list)
+@lru_cache(maxsize=1024)
+def parse_prompt_cached(prompt):
+    """parses prompt once for any number of calls; returns the prompt without extra networks, and a tuple of (name, args) for each extra network in it"""
+
+    networks = []
 
     def found(m):
-        name = m.group(1)
-        args = m.group(2)
+        networks.append((m.group(1), tuple(m.group(2).split(":"))))
+        return ""
 
-        res[name].append(ExtraNetworkParams(items=args.split(":")))
+    prompt = re_extra_net.sub(found, prompt)
+
+    return prompt, tuple(networks)
 
-        return ""
 
-    prompt = re.sub(re_extra_net, found, prompt)
+def parse_prompt(prompt):
+    res = defaultdict(list)
+
+    prompt, networks = parse_prompt_cached(prompt)
+    for name, args in networks:
+        res[name].append(ExtraNetworkParams(items=list(args)))
 
     return prompt, res
 
@@ -196,10 +222,10 @@ def parse_prompts(prompts):
     extra_data = None
 
     for prompt in prompts:
-        updated_prompt, parsed_extra_data = parse_prompt(prompt)
-
         if extra_data is None:
-            extra_data = parsed_extra_data
+            updated_prompt, extra_data = parse_prompt(prompt)
+        else:
+            updated_prompt, _ = parse_prompt_cached(prompt)
 
         res.append(updated_prompt)
 
@@ -8,12 +8,29 @@ class FaceRestoration:
     def restore(self, np_image):
         return np_image
 
+    def restore_batch(self, np_images):
+        return [self.restore(np_image) for np_image in np_images]
 
-def restore_faces(np_image):
+
+def get_face_restorer():
     face_restorers = [x for x in shared.face_restorers if x.name() == shared.opts.face_restoration_model or shared.opts.face_restoration_model is None]
     if len(face_restorers) == 0:
-        return np_image
+        return None
+
+    return face_restorers[0]
+
 
-    face_restorer = face_restorers[0]
+def restore_faces(np_image):
+    face_restorer = get_face_restorer()
+    if face_restorer is None:
+        return np_image
 
     return face_restorer.restore(np_image)
+
+
+def restore_faces_batch(np_images):
+    face_restorer = get_face_restorer()
+    if face_restorer is None:
+        return np_images
+
+    return face_restorer.restore_batch(np_images)
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import hashlib
 import logging
 import os
+from collections import OrderedDict
 from functools import cached_property
 from typing import TYPE_CHECKING, Callable
 
@@ -56,59 +58,141 @@ def create_face_helper(device) -> FaceRestoreHelper:
     )
 
 
-def restore_with_face_helper(
-    np_image: np.ndarray,
+face_detection_cache = OrderedDict()
+"""image hash -> (landmarks, detected faces) as found by FaceRestoreHelper.get_face_landmarks_5"""
+
+face_detection_cache_size = 16
+
+
+def detect_faces(face_helper: FaceRestoreHelper, np_image: np.ndarray) -> None:
+    """
+    Finds faces in a BGR image and puts them into face_helper, reusing the result for an image seen recently:
+    restoring the same image again (e.g. with different CodeFormer weights) does not run the detector.
+    """
+    key = hashlib.sha256(np_image.tobytes()).hexdigest() + str(np_image.shape)
+
+    face_helper.clean_all()
+    face_helper.read_image(np_image)
+
+    cached = face_detection_cache.get(key)
+    if cached is not None:
+        face_detection_cache.move_to_end(key)
+        landmarks, det_faces = cached
+        face_helper.all_landmarks_5 = [x.copy() for x in landmarks]
+        face_helper.det_faces = [x.copy() for x in det_faces]
+    else:
+        face_helper.get_face_landmarks_5(only_center_face=False, resize=640, eye_dist_threshold=5)
+        face_detection_cache[key] = ([x.copy() for x in face_helper.all_landmarks_5], [x.copy() for x in face_helper.det_faces])
+        while len(face_detection_cache) > face_detection_cache_size:
+            face_detection_cache.popitem(last=False)
+
+    face_helper.align_warp_face()
+
+
+def restore_faces_in_batches(
+    cropped_faces: list[np.ndarray],
+    restore_face: Callable[[torch.Tensor], torch.Tensor],
+) -> list[np.ndarray]:
+    """
+    Restores BGR face crops using restore_face, passing up to `face_restoration_batch_size` faces to it at once.
+    If restoring a batch fails, its faces are restored one by one; a face that can't be restored is returned as it is.
+    """
+    from torchvision.transforms.functional import normalize
+
+    def restore(faces):
+        faces_t = torch.stack([bgr_image_to_rgb_tensor(face / 255.0) for face in faces])
+        normalize(faces_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+        faces_t = faces_t.to(devices.device_codeformer)
+
+        try:
+            with torch.no_grad():
+                faces_t = restore_face(faces_t)
+            devices.torch_gc()
+        except Exception:
+            if len(faces) > 1:
+                logger.debug("Failed to restore a batch of %d faces, restoring them one by one", len(faces), exc_info=True)
+                devices.torch_gc()
+                return [restored for face in faces for restored in restore([face])]
+
+            errors.report('Failed face-restoration inference', exc_info=True)
+
+        return [(rgb_tensor_to_bgr_image(face_t, min_max=(-1, 1)) * 255.0).astype('uint8') for face_t in faces_t]
+
+    batch_size = max(int(shared.opts.face_restoration_batch_size), 1)
+
+    res = []
+    for i in range(0, len(cropped_faces), batch_size):
+        res += restore(cropped_faces[i:i + batch_size])
+
+    return res
+
+
+def restore_with_face_helper_batch(
+    np_images: list[np.ndarray],
     face_helper: FaceRestoreHelper,
     restore_face: Callable[[torch.Tensor], torch.Tensor],
-) -> np.ndarray:
+) -> list[np.ndarray]:
     """
-    Find faces in the image using face_helper, restore them using restore_face, and paste them back into the image.
+    Same as restore_with_face_helper, for multiple images: faces found in all images are restored together,
+    in batches, and then pasted back into their images.
 
-    `restore_face` should take a cropped face image and return a restored face image.
+    `restore_face` should take a batch of cropped face images and return a batch of restored face images.
     """
-    from torchvision.transforms.functional import normalize
-    np_image = np_image[:, :, ::-1]
-    original_resolution = np_image.shape[0:2]
+    found = []
+    cropped_faces = []
 
     try:
-        logger.debug("Detecting faces...")
-        face_helper.clean_all()
-        face_helper.read_image(np_image)
-        face_helper.get_face_landmarks_5(only_center_face=False, resize=640, eye_dist_threshold=5)
-        face_helper.align_warp_face()
-        logger.debug("Found %d faces, restoring", len(face_helper.cropped_faces))
-        for cropped_face in face_helper.cropped_faces:
-            cropped_face_t = bgr_image_to_rgb_tensor(cropped_face / 255.0)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(devices.device_codeformer)
-
-            try:
-                with torch.no_grad():
-                    cropped_face_t = restore_face(cropped_face_t)
-                devices.torch_gc()
-            except Exception:
-                errors.report('Failed face-restoration inference', exc_info=True)
-
-            restored_face = rgb_tensor_to_bgr_image(cropped_face_t, min_max=(-1, 1))
-            restored_face = (restored_face * 255.0).astype('uint8')
-            face_helper.add_restored_face(restored_face)
-
-        logger.debug("Merging restored faces into image")
-        face_helper.get_inverse_affine(None)
-        img = face_helper.paste_faces_to_input_image()
-        img = img[:, :, ::-1]
-        if original_resolution != img.shape[0:2]:
-            img = cv2.resize(
-                img,
-                (0, 0),
-                fx=original_resolution[1] / img.shape[1],
-                fy=original_resolution[0] / img.shape[0],
-                interpolation=cv2.INTER_LINEAR,
-            )
+        logger.debug("Detecting faces in %d images...", len(np_images))
+        for np_image in np_images:
+            detect_faces(face_helper, np_image[:, :, ::-1])
+            found.append((face_helper.input_img, face_helper.affine_matrices, len(face_helper.cropped_faces)))
+            cropped_faces += face_helper.cropped_faces
+
+        logger.debug("Found %d faces, restoring", len(cropped_faces))
+        restored_faces = iter(restore_faces_in_batches(cropped_faces, restore_face))
+
+        logger.debug("Merging restored faces into images")
+        res = []
+        for np_image, (input_img, affine_matrices, face_count) in zip(np_images, found):
+            face_helper.clean_all()
+            face_helper.input_img = input_img
+            face_helper.affine_matrices = affine_matrices
+            for _ in range(face_count):
+                face_helper.add_restored_face(next(restored_faces))
+
+            face_helper.get_inverse_affine(None)
+            img = face_helper.paste_faces_to_input_image()
+            img = img[:, :, ::-1]
+
+            original_resolution = np_image.shape[0:2]
+            if original_resolution != img.shape[0:2]:
+                img = cv2.resize(
+                    img,
+                    (0, 0),
+                    fx=original_resolution[1] / img.shape[1],
+                    fy=original_resolution[0] / img.shape[0],
+                    interpolation=cv2.INTER_LINEAR,
+                )
+            res.append(img)
+
         logger.debug("Face restoration complete")
     finally:
         face_helper.clean_all()
-    return img
+
+    return res
+
+
+def restore_with_face_helper(
+    np_image: np.ndarray,
+    face_helper: FaceRestoreHelper,
+    restore_face: Callable[[torch.Tensor], torch.Tensor],
+) -> np.ndarray:
+    """
+    Find faces in the image using face_helper, restore them using restore_face, and paste them back into the image.
+
+    `restore_face` should take a batch of cropped face images and return a batch of restored face images.
+    """
+    return restore_with_face_helper_batch([np_image], face_helper, restore_face)[0]
 
 
 class CommonFaceRestoration(face_restoration.FaceRestoration):
@@ -146,17 +230,24 @@ class CommonFaceRestoration(face_restoration.FaceRestoration):
         np_image: np.ndarray,
         restore_face: Callable[[torch.Tensor], torch.Tensor],
     ) -> np.ndarray:
+        return self.restore_batch_with_helper([np_image], restore_face)[0]
+
+    def restore_batch_with_helper(
+        self,
+        np_images: list[np.ndarray],
+        restore_face: Callable[[torch.Tensor], torch.Tensor],
+    ) -> list[np.ndarray]:
         try:
             if self.net is None:
                 self.net = self.load_net()
         except Exception:
             logger.warning("Unable to load face-restoration model", exc_info=True)
-            return np_image
+            return np_images
 
         try:
             prepare_free_memory()
             self.send_model_to(self.get_device())
-            return restore_with_face_helper(np_image, self.face_helper, restore_face)
+            return restore_with_face_helper_batch(np_images, self.face_helper, restore_face)
         finally:
             if shared.opts.face_restoration_unload:
                 self.send_model_to(devices.cpu)
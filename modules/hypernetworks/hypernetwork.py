@@ -3,6 +3,7 @@ import glob
 import html
 import os
 import inspect
+import time
 from contextlib import closing
 
 import modules.textual_inversion.dataset
@@ -537,7 +538,7 @@ def train_hypernetwork(id_task, hypernetwork_name: str, learn_rate: float, batch
 
     latent_sampling_method = ds.latent_sampling_method
 
-    dl = modules.textual_inversion.dataset.PersonalizedDataLoader(ds, latent_sampling_method=latent_sampling_method, batch_size=ds.batch_size, pin_memory=pin_memory)
+    dl = modules.textual_inversion.dataset.PersonalizedDataLoader(ds, latent_sampling_method=latent_sampling_method, batch_size=ds.batch_size, pin_memory=pin_memory, prefetch=shared.opts.training_dataloader_prefetch)
 
     old_parallel_processing_allowed = shared.parallel_processing_allowed
 
@@ -589,6 +590,7 @@ def train_hypernetwork(id_task, hypernetwork_name: str, learn_rate: float, batch
     forced_filename = "<none>"
 
     pbar = tqdm.tqdm(total=steps - initial_step)
+    step_start = time.perf_counter()
     try:
         sd_hijack_checkpoint.add()
 
@@ -651,7 +653,10 @@ def train_hypernetwork(id_task, hypernetwork_name: str, learn_rate: float, batch
                 epoch_num = hypernetwork.step // steps_per_epoch
                 epoch_step = hypernetwork.step % steps_per_epoch
 
-                description = f"Training hypernetwork [Epoch {epoch_num}: {epoch_step+1}/{steps_per_epoch}]loss: {loss_step:.7f}"
+                # time since the previous step finished, not counting saving and previews
+                images_per_second = batch_size * gradient_step / (time.perf_counter() - step_start)
+
+                description = f"Training hypernetwork [Epoch {epoch_num}: {epoch_step+1}/{steps_per_epoch}]loss: {loss_step:.7f}, {images_per_second:.2f} images/s"
                 pbar.set_description(description)
                 if hypernetwork_dir is not None and steps_done % save_hypernetwork_every == 0:
                     # Before saving, change name to match current checkpoint.
@@ -738,11 +743,13 @@ def train_hypernetwork(id_task, hypernetwork_name: str, learn_rate: float, batch
 <p>
 Loss: {loss_step:.7f}<br/>
 Step: {steps_done}<br/>
+Speed: {images_per_second:.2f} images/s<br/>
 Last prompt: {html.escape(batch.cond_text[0])}<br/>
 Last saved hypernetwork: {html.escape(last_saved_file)}<br/>
 Last saved image: {html.escape(last_saved_image)}<br/>
 </p>
 """
+                step_start = time.perf_counter()
     except Exception:
         errors.report("Exception in training hypernetwork", exc_info=True)
     finally:
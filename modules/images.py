@@ -150,7 +150,12 @@ class GridAnnotation:
         self.size = None
 
 
-def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
+def grid_annotations_canvas(cols, rows, width, height, hor_texts, ver_texts, margin=0):
+    """
+    Creates an image for a grid of cols x rows cells of width x height, with texts already drawn around the cells the same
+    way as draw_grid_annotations does and the cells left empty. Returns the image and a function that gives the position
+    of top left corner of the cell at (col, row) in it.
+    """
 
     color_active = ImageColor.getcolor(opts.grid_text_active_color, 'RGB')
     color_inactive = ImageColor.getcolor(opts.grid_text_inactive_color, 'RGB')
@@ -197,9 +202,6 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
 
     pad_left = 0 if sum([sum([len(line.text) for line in lines]) for lines in ver_texts]) == 0 else width * 3 // 4
 
-    cols = im.width // width
-    rows = im.height // height
-
     assert cols == len(hor_texts), f'bad number of horizontal texts: {len(hor_texts)}; must be {cols}'
     assert rows == len(ver_texts), f'bad number of vertical texts: {len(ver_texts)}; must be {rows}'
 
@@ -224,12 +226,7 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
 
     pad_top = 0 if sum(hor_text_heights) == 0 else max(hor_text_heights) + line_spacing * 2
 
-    result = Image.new("RGB", (im.width + pad_left + margin * (cols-1), im.height + pad_top + margin * (rows-1)), color_background)
-
-    for row in range(rows):
-        for col in range(cols):
-            cell = im.crop((width * col, height * row, width * (col+1), height * (row+1)))
-            result.paste(cell, (pad_left + (width + margin) * col, pad_top + (height + margin) * row))
+    result = Image.new("RGB", (width * cols + pad_left + margin * (cols-1), height * rows + pad_top + margin * (rows-1)), color_background)
 
     d = ImageDraw.Draw(result)
 
@@ -245,6 +242,23 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
 
         draw_texts(d, x, y, ver_texts[row], fnt, fontsize)
 
+    def cell_position(col, row):
+        return pad_left + (width + margin) * col, pad_top + (height + margin) * row
+
+    return result, cell_position
+
+
+def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
+    cols = im.width // width
+    rows = im.height // height
+
+    result, cell_position = grid_annotations_canvas(cols, rows, width, height, hor_texts, ver_texts, margin)
+
+    for row in range(rows):
+        for col in range(cols):
+            cell = im.crop((width * col, height * row, width * (col+1), height * (row+1)))
+            result.paste(cell, cell_position(col, row))
+
     return result
 
 
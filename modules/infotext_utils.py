@@ -5,6 +5,7 @@ import json
 import os
 import re
 import sys
+from functools import lru_cache
 
 import gradio as gr
 from modules.paths import data_path
@@ -16,6 +17,7 @@ sys.modules['modules.generation_parameters_copypaste'] = sys.modules[__name__]
 re_param_code = r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)'
 re_param = re.compile(re_param_code)
 re_imagesize = re.compile(r"^(\d+)x(\d+)$")
+re_needs_quoting = re.compile(r"[,\n:]")
 re_hypernet_hash = re.compile("\(([0-9a-f]+)\)$")
 type_of_gr_update = type(gr.update())
 
@@ -54,7 +56,7 @@ def reset():
 
 
 def quote(text):
-    if ',' not in str(text) and '\n' not in str(text) and ':' not in str(text):
+    if re_needs_quoting.search(str(text)) is None:
         return text
 
     return json.dumps(text, ensure_ascii=False)
@@ -237,20 +239,18 @@ def restore_old_hires_fix_params(res):
     res['Hires resize-2'] = height
 
 
-def parse_generation_parameters(x: str, skip_fields: list[str] | None = None):
-    """parses generation parameters string, the one you see in text field under the picture in UI:
-```
-girl with an artist's beret, determined, blue eyes, desert scene, computer monitors, heavy makeup, by Alphonse Mucha and Charlie Bowater, ((eyeshadow)), (coquettish), detailed, intricate
-Negative prompt: ugly, fat, obese, chubby, (((deformed))), [blurry], bad anatomy, disfigured, poorly drawn face, mutation, mutated, (extra_limb), (ugly), (poorly drawn hands), messy drawing
-Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model hash: 45dee52b
-```
+def compose_generation_parameters(generation_params: dict) -> str:
+    """creates the last line of infotext from a dict of parameters; parameters with None value are omitted, and ones with value equal to the key are written as just the key"""
 
-    returns a dict with field values
-    """
-    if skip_fields is None:
-        skip_fields = shared.opts.infotext_skip_pasting
+    return ", ".join([k if k == v else f'{k}: {quote(v)}' for k, v in generation_params.items() if v is not None])
 
-    res = {}
+
+@lru_cache(maxsize=1024)
+def split_generation_parameters(x: str):
+    """
+    Splits infotext into prompt, negative prompt and a tuple of (key, value) pairs from the last line, in one pass over the text.
+    Values are unquoted, and sizes like 512x768 are split into "key-1" and "key-2" entries. Results are shared between callers.
+    """
 
     prompt = ""
     negative_prompt = ""
@@ -258,9 +258,10 @@ Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model
     done_with_prompt = False
 
     *lines, lastline = x.strip().split("\n")
-    if len(re_param.findall(lastline)) < 3:
+    params = re_param.findall(lastline)
+    if len(params) < 3:
         lines.append(lastline)
-        lastline = ''
+        params = []
 
     for line in lines:
         line = line.strip()
@@ -272,20 +273,41 @@ Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model
         else:
             prompt += ("" if prompt == "" else "\n") + line
 
-    for k, v in re_param.findall(lastline):
+    res = []
+    for k, v in params:
         try:
             if v[0] == '"' and v[-1] == '"':
                 v = unquote(v)
 
             m = re_imagesize.match(v)
             if m is not None:
-                res[f"{k}-1"] = m.group(1)
-                res[f"{k}-2"] = m.group(2)
+                res.append((f"{k}-1", m.group(1)))
+                res.append((f"{k}-2", m.group(2)))
             else:
-                res[k] = v
+                res.append((k, v))
         except Exception:
             print(f"Error parsing \"{k}: {v}\"")
 
+    return prompt, negative_prompt, tuple(res)
+
+
+def parse_generation_parameters(x: str, skip_fields: list[str] | None = None):
+    """parses generation parameters string, the one you see in text field under the picture in UI:
+```
+girl with an artist's beret, determined, blue eyes, desert scene, computer monitors, heavy makeup, by Alphonse Mucha and Charlie Bowater, ((eyeshadow)), (coquettish), detailed, intricate
+Negative prompt: ugly, fat, obese, chubby, (((deformed))), [blurry], bad anatomy, disfigured, poorly drawn face, mutation, mutated, (extra_limb), (ugly), (poorly drawn hands), messy drawing
+Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model hash: 45dee52b
+```
+
+    returns a dict with field values
+    """
+    if skip_fields is None:
+        skip_fields = shared.opts.infotext_skip_pasting
+
+    prompt, negative_prompt, params = split_generation_parameters(x)
+
+    res = dict(params)
+
     # Extract styles from prompt
     if shared.opts.infotext_styles != "Ignore":
         found_styles, prompt_no_styles, negative_prompt_no_styles = shared.prompt_styles.extract_styles_from_prompt(prompt, negative_prompt)
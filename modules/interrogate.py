@@ -1,3 +1,4 @@
+import hashlib
 import os
 import sys
 from collections import namedtuple
@@ -10,13 +11,14 @@ import torch.hub
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
-from modules import devices, paths, shared, modelloader, errors
+from modules import devices, paths, shared, modelloader, errors, cache
 from ldm_patched.modules import model_management
 from ldm_patched.modules.model_patcher import ModelPatcher
 
 
 blip_image_eval_size = 384
 clip_model_name = 'ViT-L/14'
+text_features_chunk_size = 256
 
 Category = namedtuple("Category", ["name", "topn", "items"])
 
@@ -66,6 +68,8 @@ class InterrogateModels:
 
         self.blip_patcher = None
         self.clip_patcher = None
+        self.text_features_cache = {}
+        self.category_features = None
 
     def categories(self):
         if not os.path.exists(self.content_dir):
@@ -147,71 +151,168 @@ class InterrogateModels:
         pass
 
     def unload(self):
-        pass
+        self.category_features = None
 
-    def rank(self, image_features, text_array, top_count=1):
+    def text_features_key(self, texts):
+        return f"{clip_model_name}:{self.dtype}:" + hashlib.sha256("\n".join(texts).encode("utf8")).hexdigest()
+
+    def text_features(self, texts):
+        """
+        Normalized CLIP features for a list of texts, as a (len(texts), dim) tensor on offload_device. Computed once for
+        every list of texts and kept both in memory and on disk, so category files are only encoded again when they change.
+        """
         import clip
 
-        devices.torch_gc()
+        key = self.text_features_key(texts)
+
+        features = self.text_features_cache.get(key)
+        if features is not None:
+            return features
+
+        disk_cache = cache.cache("interrogate-text-features")
+        features = disk_cache.get(key)
+
+        if features is None:
+            devices.torch_gc()
+
+            with torch.no_grad(), devices.autocast():
+                chunks = [texts[i:i + text_features_chunk_size] for i in range(0, len(texts), text_features_chunk_size)]
+                features = torch.cat([self.clip_model.encode_text(clip.tokenize(chunk, truncate=True).to(self.load_device)).type(self.dtype) for chunk in chunks])
+                features /= features.norm(dim=-1, keepdim=True)
+
+            disk_cache[key] = features.cpu()
+
+        features = features.to(device=self.offload_device, dtype=self.dtype)
+        self.text_features_cache[key] = features
+        return features
+
+    def category_items(self, category):
+        if shared.opts.interrogate_clip_dict_limit != 0:
+            return category.items[0:int(shared.opts.interrogate_clip_dict_limit)]
+
+        return category.items
+
+    def rank_categories(self, image_features, categories):
+        """
+        Finds best matches from each of categories for each image, with one matrix multiplication for all categories.
+        Returns a list with an entry for each image; entries are lists of (category, [(text, score), ...]).
+        """
+        items = [self.category_items(category) for category in categories]
+        keys = tuple(self.text_features_key(x) for x in items)
+
+        if self.category_features is None or self.category_features[0] != keys:
+            features = torch.cat([self.text_features(x) for x in items]).to(device=self.load_device)
+            self.category_features = (keys, features)
+
+            # features of categories that were edited, skipped or cut to a different length are not going to be used again
+            for key in list(self.text_features_cache):
+                if key not in keys:
+                    del self.text_features_cache[key]
+
+        features = self.category_features[1]
+        similarity = 100.0 * image_features @ features.T
+
+        res = [[] for _ in range(image_features.shape[0])]
+        position = 0
+        for category, texts in zip(categories, items):
+            probs = similarity[:, position:position + len(texts)].float().softmax(dim=-1)
+            position += len(texts)
+
+            top_count = min(category.topn, len(texts))
+            top_probs, top_labels = probs.cpu().topk(top_count, dim=-1)
+            for i in range(image_features.shape[0]):
+                res[i].append((category, [(texts[top_labels[i][j]], (top_probs[i][j].item() * 100)) for j in range(top_count)]))
+
+        return res
 
+    def rank(self, image_features, text_array, top_count=1):
         if shared.opts.interrogate_clip_dict_limit != 0:
             text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
 
         top_count = min(top_count, len(text_array))
-        text_tokens = clip.tokenize(list(text_array), truncate=True).to(self.load_device)
-        text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+        text_features = self.text_features(list(text_array)).to(device=image_features.device)
 
-        similarity = torch.zeros((1, len(text_array))).to(self.load_device)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+        similarity = (100.0 * image_features @ text_features.T).float().softmax(dim=-1).mean(dim=0, keepdim=True)
 
         top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-        return [(text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy()*100)) for i in range(top_count)]
+        return [(text_array[top_labels[0][i]], (top_probs[0][i].item() * 100)) for i in range(top_count)]
 
-    def generate_caption(self, pil_image):
-        gpu_image = transforms.Compose([
+    def generate_captions(self, pil_images):
+        transform = transforms.Compose([
             transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).type(self.dtype).to(self.load_device)
+        ])
+        gpu_images = torch.stack([transform(pil_image) for pil_image in pil_images]).type(self.dtype).to(self.load_device)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(gpu_image, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+            return self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
 
-        return caption[0]
+    def generate_caption(self, pil_image):
+        return self.generate_captions([pil_image])[0]
 
-    def interrogate(self, pil_image):
-        res = ""
-        shared.state.begin(job="interrogate")
-        try:
-            self.load()
+    def interrogate_images(self, pil_images, categories):
+        """Captions one batch of images with BLIP and appends the best matching CLIP categories to each caption."""
 
-            caption = self.generate_caption(pil_image)
-            self.send_blip_to_ram()
-            devices.torch_gc()
+        res = self.generate_captions(pil_images)
+        self.send_blip_to_ram()
+        devices.torch_gc()
 
-            res = caption
+        clip_images = torch.stack([self.clip_preprocess(pil_image) for pil_image in pil_images]).type(self.dtype).to(self.load_device)
 
-            clip_image = self.clip_preprocess(pil_image).unsqueeze(0).type(self.dtype).to(self.load_device)
+        with torch.no_grad(), devices.autocast():
+            image_features = self.clip_model.encode_image(clip_images).type(self.dtype)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
 
-            with torch.no_grad(), devices.autocast():
-                image_features = self.clip_model.encode_image(clip_image).type(self.dtype)
+            ranks = self.rank_categories(image_features, categories)
 
-                image_features /= image_features.norm(dim=-1, keepdim=True)
+        for i, image_ranks in enumerate(ranks):
+            for _, matches in image_ranks:
+                for match, score in matches:
+                    if shared.opts.interrogate_return_ranks:
+                        res[i] += f", ({match}:{score/100:.3f})"
+                    else:
+                        res[i] += f", {match}"
 
-                for cat in self.categories():
-                    matches = self.rank(image_features, cat.items, top_count=cat.topn)
-                    for match, score in matches:
-                        if shared.opts.interrogate_return_ranks:
-                            res += f", ({match}:{score/100:.3f})"
-                        else:
-                            res += f", {match}"
+        return res
 
+    def interrogate(self, pil_image):
+        return self.interrogate_batch([pil_image])[0]
+
+    def interrogate_batch(self, pil_images):
+        """
+        Same as interrogate, for many images: both BLIP and CLIP process up to interrogate_batch_size images at once.
+        If the job is interrupted, images that were not processed get None.
+        """
+
+        res = [None] * len(pil_images)
+        batch_size = max(int(shared.opts.interrogate_batch_size), 1)
+
+        shared.state.begin(job="interrogate")
+        shared.state.job_count = (len(pil_images) + batch_size - 1) // batch_size
+
+        try:
+            self.load()
+            categories = self.categories()
         except Exception:
             errors.report("Error interrogating", exc_info=True)
-            res += "<error>"
+            self.unload()
+            shared.state.end()
+            return ["<error>"] * len(pil_images)
+
+        for start in range(0, len(pil_images), batch_size):
+            if shared.state.interrupted:
+                break
+
+            batch = pil_images[start:start + batch_size]
+
+            try:
+                res[start:start + len(batch)] = self.interrogate_images(batch, categories)
+            except Exception:
+                errors.report("Error interrogating", exc_info=True)
+                res[start:start + len(batch)] = ["<error>"] * len(batch)
+
+            shared.state.nextjob()
 
         self.unload()
         shared.state.end()
@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from modules import shared, sd_models, sd_vae, safetensors_header
+
+dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+"""safetensors dtype names -> torch dtypes"""
+
+if hasattr(torch, "float8_e4m3fn"):
+    dtypes["F8_E4M3"] = torch.float8_e4m3fn
+    dtypes["F8_E5M2"] = torch.float8_e5m2
+
+dtype_names = {v: k for k, v in dtypes.items()}
+
+merge_threads = max(min(os.cpu_count() or 1, 4), 1)
+
+
+def can_merge(checkpoint_infos, checkpoint_format):
+    """Whether the merge can be done by StreamingMerge: it needs all inputs and the output to be .safetensors files."""
+
+    return checkpoint_format == "safetensors" and all(os.path.splitext(x.filename)[1].lower() == ".safetensors" for x in checkpoint_infos if x is not None)
+
+
+class SafetensorsSource:
+    """
+    Tensors of a .safetensors checkpoint under the same names read_state_dict would give them;
+    the file is memory-mapped and tensors are read one by one.
+    """
+
+    def __init__(self, filename):
+        import safetensors
+
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu")
+        self.tensors = safetensors_header.read_header(filename).tensors
+
+        ln_final = self.tensors.get('conditioner.embedders.0.model.ln_final.weight')
+        is_sd2_turbo = ln_final is not None and ln_final[1][0] == 1024
+        replacements = sd_models.checkpoint_dict_replacements_sd2_turbo if is_sd2_turbo else sd_models.checkpoint_dict_replacements_sd1
+
+        self.names = {sd_models.transform_checkpoint_dict_key(k, replacements): k for k in self.tensors}
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def keys(self):
+        return self.names.keys()
+
+    def get(self, key, meta=False):
+        """Reads the tensor; with meta=True, returns an empty tensor of the same shape and dtype on meta device instead."""
+
+        name = self.names[key]
+        if meta:
+            dtype, shape = self.tensors[name]
+            return torch.empty(shape, dtype=dtypes[dtype], device="meta")
+
+        return self.file.get_tensor(name)
+
+
+class StreamingMerge:
+    """
+    Merges checkpoints the same way as extras.run_modelmerger does with state dicts loaded into memory, but one tensor
+    at a time, in a few threads, writing every result into the output .safetensors file as soon as it's ready.
+
+    The merge is planned on meta tensors when the object is created, so that shapes and dtypes of all output tensors
+    are known before writing the file header, and result_is_inpainting_model/result_is_instruct_pix2pix_model are set.
+    """
+
+    def __init__(self, primary_model_info, secondary_model_info, tertiary_model_info, *, theta_func1, theta_func2, multiplier, save_as_half, bake_in_vae_filename, discard_weights, skip_keys):
+        self.theta_func1 = theta_func1
+        self.theta_func2 = theta_func2
+        self.multiplier = multiplier
+        self.save_as_half = save_as_half
+        self.skip_keys = set(skip_keys)
+
+        self.a = SafetensorsSource(primary_model_info.filename)
+        self.b = SafetensorsSource(secondary_model_info.filename) if theta_func2 else None
+        self.c = SafetensorsSource(tertiary_model_info.filename) if theta_func1 else None
+
+        self.vae = {}
+        if bake_in_vae_filename is not None:
+            print(f"Baking in VAE from {bake_in_vae_filename}")
+            vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
+            self.vae = {'first_stage_model.' + k: v for k, v in vae_dict.items() if 'first_stage_model.' + k in self.a}
+
+        regex = re.compile(discard_weights) if discard_weights else None
+        self.keys = [key for key in self.a.keys() if regex is None or not re.search(regex, key)]
+
+        self.result_is_inpainting_model = False
+        self.result_is_instruct_pix2pix_model = False
+        self.plan = {}
+        for key in self.keys:
+            tensor = self.merge_tensor(key, meta=True)
+            self.plan[key] = (tensor.dtype, tuple(tensor.shape))
+
+    def merge_tensor(self, key, meta=False):
+        def to_half(tensor):
+            if self.save_as_half and tensor.dtype == torch.float:
+                return tensor.half()
+
+            return tensor
+
+        vae_tensor = self.vae.get(key)
+        if vae_tensor is not None:
+            return to_half(vae_tensor.to(device="meta") if meta else vae_tensor)
+
+        a = self.a.get(key, meta)
+
+        if not self.theta_func2:
+            return to_half(a)
+
+        if 'model' not in key or key not in self.b or key in self.skip_keys:
+            return a
+
+        b = self.b.get(key, meta)
+        if self.theta_func1:
+            b = self.theta_func1(b, self.c.get(key, meta)) if key in self.c else torch.zeros_like(b)
+
+        # see run_modelmerger for merging inpainting and instruct-pix2pix models with normal ones
+        if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
+            if a.shape[1] == 4 and b.shape[1] == 9:
+                raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
+            if a.shape[1] == 4 and b.shape[1] == 8:
+                raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
+
+            if a.shape[1] == 8 and b.shape[1] == 4:
+                a[:, 0:4, :, :] = self.theta_func2(a[:, 0:4, :, :], b, self.multiplier)
+                self.result_is_instruct_pix2pix_model = True
+            else:
+                assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
+                a[:, 0:4, :, :] = self.theta_func2(a[:, 0:4, :, :], b, self.multiplier)
+                self.result_is_inpainting_model = True
+        else:
+            a = self.theta_func2(a, b, self.multiplier)
+
+        return to_half(a)
+
+    def save(self, filename, metadata=None):
+        for k, v in (metadata or {}).items():
+            if not isinstance(v, str):
+                raise ValueError(f"Metadata value for {k} must be a string, got {type(v).__name__}")
+
+        # like safetensors does, larger dtypes go first, so that every tensor is aligned to its element size
+        order = sorted(self.keys, key=lambda k: (-self.plan[k][0].itemsize, k))
+
+        header = {"__metadata__": metadata} if metadata else {}
+        offsets = {}
+        position = 0
+        for key in order:
+            dtype, shape = self.plan[key]
+            size = dtype.itemsize
+            for dim in shape:
+                size *= dim
+
+            header[key] = {"dtype": dtype_names[dtype], "shape": list(shape), "data_offsets": [position, position + size]}
+            offsets[key] = position
+            position += size
+
+        header_bytes = json.dumps(header, separators=(',', ':')).encode("utf8")
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        data_start = 8 + len(header_bytes)
+
+        shared.state.sampling_steps = len(order)
+        shared.state.sampling_step = 0
+
+        temp_filename = f"{filename}.tmp"
+        write_lock = threading.Lock()
+
+        def process(key):
+            tensor = self.merge_tensor(key)
+            assert (tensor.dtype, tuple(tensor.shape)) == self.plan[key], f"{key} does not match the plan: {tensor.dtype} {tuple(tensor.shape)}, expected {self.plan[key]}"
+
+            data = tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+            with write_lock:
+                file.seek(data_start + offsets[key])
+                file.write(data)
+
+        try:
+            with open(temp_filename, "wb") as file, ThreadPoolExecutor(max_workers=merge_threads, thread_name_prefix="merge") as executor:
+                file.write(struct.pack('<Q', len(header_bytes)))
+                file.write(header_bytes)
+
+                pending = deque()
+                for key in order:
+                    pending.append(executor.submit(process, key))
+
+                    while len(pending) >= merge_threads * 2:
+                        pending.popleft().result()
+                        shared.state.sampling_step += 1
+
+                while pending:
+                    pending.popleft().result()
+                    shared.state.sampling_step += 1
+
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
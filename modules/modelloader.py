@@ -3,12 +3,14 @@ from __future__ import annotations
 import importlib
 import logging
 import os
+import threading
+from collections import OrderedDict
 from typing import TYPE_CHECKING
 from urllib.parse import urlparse
 
 import torch
 
-from modules import shared
+from modules import shared, torch_utils
 from modules.upscaler import Upscaler, UpscalerLanczos, UpscalerNearest, UpscalerNone
 from modules.util import load_file_from_url  # noqa, backwards compatibility
 
@@ -138,6 +140,12 @@ def _init_spandrel_extra_archs() -> None:
         _spandrel_extra_init_state = False
 
 
+loaded_spandrel_models = OrderedDict()
+"""(path, device, prefer_half, dtype) -> (mtime, model descriptor, ModelPatcher); the most recently used model is last"""
+
+loaded_spandrel_models_lock = threading.Lock()
+
+
 def load_spandrel_model(
     path: str | os.PathLike,
     *,
@@ -146,8 +154,78 @@ def load_spandrel_model(
     dtype: str | torch.dtype | None = None,
     expected_architecture: str | None = None,
 ) -> spandrel.ModelDescriptor:
-    global _spandrel_extra_init_state
+    """
+    Returns a spandrel model for the file, reusing the one loaded earlier if the file did not change.
+
+    Up to `upscaler_models_cache_limit` models stay in memory. They are registered with the memory management
+    system, which moves them to `device` when they are requested, and back to RAM when other models need space.
+
+    Face restorers keep their nets themselves and should use `load_spandrel_model_from_file` instead.
+    """
+
+    limit = shared.opts.upscaler_models_cache_limit
+    if limit <= 0:
+        unload_spandrel_models()
+        return load_spandrel_model_from_file(path, device=device, prefer_half=prefer_half, dtype=dtype, expected_architecture=expected_architecture)
+
+    from ldm_patched.modules import model_management
+    from ldm_patched.modules.model_patcher import ModelPatcher
+
+    key = (os.path.abspath(path), str(device), prefer_half, str(dtype))
+    mtime = os.path.getmtime(path)
+
+    with loaded_spandrel_models_lock:
+        entry = loaded_spandrel_models.get(key)
+        if entry is not None and entry[0] == mtime:
+            loaded_spandrel_models.move_to_end(key)
+        else:
+            if entry is not None:
+                model_management.unload_model_clones(entry[2])
+
+            model_descriptor = load_spandrel_model_from_file(path, device=device, prefer_half=prefer_half, dtype=dtype, expected_architecture=expected_architecture)
+            patcher = ModelPatcher(
+                model_descriptor.model,
+                load_device=torch.device(device) if device is not None else model_management.get_torch_device(),
+                offload_device=model_management.unet_offload_device(),
+                current_device=torch_utils.get_param(model_descriptor.model).device,
+            )
+            entry = (mtime, model_descriptor, patcher)
+            loaded_spandrel_models[key] = entry
+
+            while len(loaded_spandrel_models) > limit:
+                _, (_, _, removed_patcher) = loaded_spandrel_models.popitem(last=False)
+                model_management.unload_model_clones(removed_patcher)
+
+        _, model_descriptor, patcher = entry
+        if patcher.load_device.type != 'cpu':
+            model_management.load_models_gpu([patcher])
+
+    return model_descriptor
 
+
+def unload_spandrel_models():
+    """Forgets all models loaded by load_spandrel_model, removing them from memory management."""
+
+    if not loaded_spandrel_models:
+        return
+
+    from ldm_patched.modules import model_management
+
+    with loaded_spandrel_models_lock:
+        for _, _, patcher in loaded_spandrel_models.values():
+            model_management.unload_model_clones(patcher)
+
+        loaded_spandrel_models.clear()
+
+
+def load_spandrel_model_from_file(
+    path: str | os.PathLike,
+    *,
+    device: str | torch.device | None,
+    prefer_half: bool = False,
+    dtype: str | torch.dtype | None = None,
+    expected_architecture: str | None = None,
+) -> spandrel.ModelDescriptor:
     import spandrel
     _init_spandrel_extra_archs()
 
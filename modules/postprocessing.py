@@ -1,9 +1,94 @@
+import itertools
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
 from modules import shared, images, devices, scripts, scripts_postprocessing, ui_common, infotext_utils
 from modules.shared import opts
+from modules.timer import Timer
+
+
+def read_image(image_placeholder):
+    """Loads an input for postprocessing; returns (image, existing_pnginfo), or (None, None) if the file can't be read."""
+
+    if isinstance(image_placeholder, str):
+        try:
+            image_data = images.read(image_placeholder)
+        except Exception:
+            return None, None
+    else:
+        image_data = image_placeholder
+
+    image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+
+    parameters, existing_pnginfo = images.read_info_from_image(image_data)
+    if parameters:
+        existing_pnginfo["parameters"] = parameters
+
+    return image_data, existing_pnginfo
+
+
+def prefetch(func, items, executor, depth):
+    """Yields (item, func(item)) for all items in order, while func is already running in executor for up to depth next items."""
+
+    iterator = iter(items)
+    pending = deque((item, executor.submit(func, item)) for item in itertools.islice(iterator, depth))
+
+    try:
+        while pending:
+            item, future = pending.popleft()
+            for next_item in itertools.islice(iterator, 1):
+                pending.append((next_item, executor.submit(func, next_item)))
+
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def existing_output_names(outpath, extension):
+    """Names without extension of images with the given extension in outpath."""
+
+    if not os.path.isdir(outpath):
+        return set()
+
+    res = set()
+    for filename in os.listdir(outpath):
+        stem, ext = os.path.splitext(filename)
+        if ext[1:].lower() == extension.lower():
+            res.add(stem)
+
+    return res
+
+
+def save_postprocessed_image(pp, outpath, basename, forced_filename, suffix, infotext, existing_pnginfo):
+    fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
+
+    if pp.caption:
+        caption_filename = os.path.splitext(fullfn)[0] + ".txt"
+        existing_caption = ""
+        try:
+            with open(caption_filename, encoding="utf8") as file:
+                existing_caption = file.read().strip()
+        except FileNotFoundError:
+            pass
+
+        action = shared.opts.postprocessing_existing_caption_action
+        if action == 'Prepend' and existing_caption:
+            caption = f"{existing_caption} {pp.caption}"
+        elif action == 'Append' and existing_caption:
+            caption = f"{pp.caption} {existing_caption}"
+        elif action == 'Keep' and existing_caption:
+            caption = existing_caption
+        else:
+            caption = pp.caption
+
+        caption = caption.strip()
+        if caption:
+            with open(caption_filename, "w", encoding="utf8") as file:
+                file.write(caption)
 
 
 def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
@@ -42,87 +127,86 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
     infotext = ''
 
     data_to_process = list(get_images(extras_mode, image, image_folder, input_dir))
+
+    if extras_mode == 2 and save_output and opts.use_original_name_batch and opts.postprocessing_skip_existing:
+        # the main result of an input is saved under the input's name with an empty suffix: name tags are only added to extra images
+        done = existing_output_names(outpath, opts.samples_format)
+        data_to_process = [(image_placeholder, name) for image_placeholder, name in data_to_process if os.path.splitext(os.path.basename(name))[0] not in done]
+
     shared.state.job_count = len(data_to_process)
 
-    for image_placeholder, name in data_to_process:
-        image_data: Image.Image
+    # saving with numbered filenames has to happen in order, so unless every input has a name to save under, a single thread saves
+    io_threads = max(int(opts.postprocessing_io_threads), 1)
+    save_threads = io_threads if opts.use_original_name_batch and all(name for _, name in data_to_process) else 1
 
-        shared.state.nextjob()
-        shared.state.textinfo = name
-        shared.state.skipped = False
+    timer = Timer()
+    saving = deque()
 
-        if shared.state.interrupted or shared.state.stopping_generation:
-            break
+    with ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="postprocessing-read") as reader, ThreadPoolExecutor(max_workers=save_threads, thread_name_prefix="postprocessing-save") as saver:
+        images_to_process = prefetch(lambda x: read_image(x[0]), data_to_process, reader, io_threads * 2)
 
-        if isinstance(image_placeholder, str):
-            try:
-                image_data = images.read(image_placeholder)
-            except Exception:
+        for (_, name), (image_data, existing_pnginfo) in images_to_process:
+            timer.record("read")
+
+            shared.state.nextjob()
+            shared.state.textinfo = name
+            shared.state.skipped = False
+
+            if shared.state.interrupted or shared.state.stopping_generation:
+                break
+
+            if image_data is None:
                 continue
-        else:
-            image_data = image_placeholder
 
-        image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+            initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
 
-        parameters, existing_pnginfo = images.read_info_from_image(image_data)
-        if parameters:
-            existing_pnginfo["parameters"] = parameters
+            scripts.scripts_postproc.run(initial_pp, args)
 
-        initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
+            timer.record("process")
 
-        scripts.scripts_postproc.run(initial_pp, args)
+            if shared.state.skipped:
+                continue
+
+            used_suffixes = {}
+            for pp in [initial_pp, *initial_pp.extra_images]:
+                suffix = pp.get_suffix(used_suffixes)
+
+                if opts.use_original_name_batch and name is not None:
+                    basename = os.path.splitext(os.path.basename(name))[0]
+                    forced_filename = basename + suffix
+                else:
+                    basename = ''
+                    forced_filename = None
 
-        if shared.state.skipped:
-            continue
+                infotext = infotext_utils.compose_generation_parameters(pp.info)
+                pnginfo = dict(existing_pnginfo)
 
-        used_suffixes = {}
-        for pp in [initial_pp, *initial_pp.extra_images]:
-            suffix = pp.get_suffix(used_suffixes)
+                if opts.enable_pnginfo:
+                    pp.image.info = pnginfo
+                    pp.image.info["postprocessing"] = infotext
 
-            if opts.use_original_name_batch and name is not None:
-                basename = os.path.splitext(os.path.basename(name))[0]
-                forced_filename = basename + suffix
-            else:
-                basename = ''
-                forced_filename = None
+                shared.state.assign_current_image(pp.image)
 
-            infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
+                if save_output:
+                    while len(saving) >= io_threads * 2:
+                        saving.popleft().result()
 
-            if opts.enable_pnginfo:
-                pp.image.info = existing_pnginfo
-                pp.image.info["postprocessing"] = infotext
+                    saving.append(saver.submit(save_postprocessed_image, pp, outpath, basename, forced_filename, suffix, infotext, pnginfo))
 
-            shared.state.assign_current_image(pp.image)
+                if extras_mode != 2 or show_extras_results:
+                    outputs.append(pp.image)
 
-            if save_output:
-                fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
+            timer.record("save")
 
-                if pp.caption:
-                    caption_filename = os.path.splitext(fullfn)[0] + ".txt"
-                    existing_caption = ""
-                    try:
-                        with open(caption_filename, encoding="utf8") as file:
-                            existing_caption = file.read().strip()
-                    except FileNotFoundError:
-                        pass
+        images_to_process.close()
 
-                    action = shared.opts.postprocessing_existing_caption_action
-                    if action == 'Prepend' and existing_caption:
-                        caption = f"{existing_caption} {pp.caption}"
-                    elif action == 'Append' and existing_caption:
-                        caption = f"{pp.caption} {existing_caption}"
-                    elif action == 'Keep' and existing_caption:
-                        caption = existing_caption
-                    else:
-                        caption = pp.caption
+        while saving:
+            saving.popleft().result()
 
-                    caption = caption.strip()
-                    if caption:
-                        with open(caption_filename, "w", encoding="utf8") as file:
-                            file.write(caption)
+        timer.record("save")
 
-            if extras_mode != 2 or show_extras_results:
-                outputs.append(pp.image)
+    if extras_mode == 2:
+        print(f"Postprocessing images from {input_dir}: {timer.summary()}")
 
     devices.torch_gc()
     shared.state.end()
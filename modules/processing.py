@@ -790,7 +790,7 @@ if opts.sd_processing == "reForge OG":
                 errors.report(f'Error creating infotext for key "{key}"', exc_info=True)
                 generation_params[key] = None
 
-        generation_params_text = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in generation_params.items() if v is not None])
+        generation_params_text = infotext_utils.compose_generation_parameters(generation_params)
 
         negative_prompt_text = f"\nNegative prompt: {negative_prompt}" if negative_prompt else ""
 
@@ -1035,20 +1035,21 @@ if opts.sd_processing == "reForge OG":
 
                 save_samples = p.save_samples()
 
-                for i, x_sample in enumerate(x_samples_ddim):
-                    p.batch_index = i
-
-                    x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                    x_sample = x_sample.astype(np.uint8)
+                x_samples_np = [(255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)).astype(np.uint8) for x_sample in x_samples_ddim]
 
-                    if p.restore_faces:
-                        if save_samples and opts.save_images_before_face_restoration:
+                if p.restore_faces:
+                    if save_samples and opts.save_images_before_face_restoration:
+                        for i, x_sample in enumerate(x_samples_np):
+                            p.batch_index = i
                             images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration")
 
-                        devices.torch_gc()
+                    devices.torch_gc()
+
+                    x_samples_np = modules.face_restoration.restore_faces_batch(x_samples_np)
+                    devices.torch_gc()
 
-                        x_sample = modules.face_restoration.restore_faces(x_sample)
-                        devices.torch_gc()
+                for i, x_sample in enumerate(x_samples_np):
+                    p.batch_index = i
 
                     image = Image.fromarray(x_sample)
 
@@ -2670,7 +2671,7 @@ elif opts.sd_processing == "reForge A1111":
                 errors.report(f'Error creating infotext for key "{key}"', exc_info=True)
                 generation_params[key] = None
 
-        generation_params_text = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in generation_params.items() if v is not None])
+        generation_params_text = infotext_utils.compose_generation_parameters(generation_params)
 
         negative_prompt_text = f"\nNegative prompt: {negative_prompt}" if negative_prompt else ""
 
@@ -2917,20 +2918,21 @@ elif opts.sd_processing == "reForge A1111":
 
                 save_samples = p.save_samples()
 
-                for i, x_sample in enumerate(x_samples_ddim):
-                    p.batch_index = i
-
-                    x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                    x_sample = x_sample.astype(np.uint8)
+                x_samples_np = [(255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)).astype(np.uint8) for x_sample in x_samples_ddim]
 
-                    if p.restore_faces:
-                        if save_samples and opts.save_images_before_face_restoration:
+                if p.restore_faces:
+                    if save_samples and opts.save_images_before_face_restoration:
+                        for i, x_sample in enumerate(x_samples_np):
+                            p.batch_index = i
                             images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration")
 
-                        devices.torch_gc()
+                    devices.torch_gc()
+
+                    x_samples_np = modules.face_restoration.restore_faces_batch(x_samples_np)
+                    devices.torch_gc()
 
-                        x_sample = modules.face_restoration.restore_faces(x_sample)
-                        devices.torch_gc()
+                for i, x_sample in enumerate(x_samples_np):
+                    p.batch_index = i
 
                     image = Image.fromarray(x_sample)
 
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import re
 from collections import namedtuple
+from functools import lru_cache, partial
 import lark
 
 # a prompt like this: "fantasy landscape with a [mountain:lake:0.25] and [an oak:a christmas tree:0.75][ in foreground::0.6][: in background:0.25] [shoddy:masterful:0.5]"
@@ -25,6 +26,106 @@ plain: /([^\\\[\]():|]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
 """)
 
+
+def schedule_step(number, steps, int_offset, flt_offset, use_old_scheduling):
+    """converts NUMBER from [from:to:when] into the step at which the prompt switches from one text to the other"""
+
+    v = float(number)
+    if use_old_scheduling:
+        v = v*steps if v<1 else v
+    else:
+        if "." in number:
+            v = (v - flt_offset) * steps
+        else:
+            v = (v - int_offset)
+    return min(steps, int(v))
+
+
+class CollectSteps(lark.Visitor):
+    """collects all steps at which a parsed prompt changes into self.res"""
+
+    def __init__(self, steps, step_for):
+        self.steps = steps
+        self.step_for = step_for
+        self.res = [steps]
+
+    def scheduled(self, tree):
+        when = self.step_for(tree.children[-2])
+        if when >= 1:
+            self.res.append(when)
+
+    def alternate(self, tree):
+        self.res.extend(range(1, self.steps+1))
+
+
+class AtStep(lark.Transformer):
+    """produces the text of a parsed prompt as it is at the given step"""
+
+    def __init__(self, step, step_for):
+        super().__init__()
+        self.step = step
+        self.step_for = step_for
+
+    def scheduled(self, args):
+        before, after, _, when, _ = args
+        yield before or () if self.step <= self.step_for(when) else after
+
+    def alternate(self, args):
+        args = ["" if not arg else arg for arg in args]
+        yield args[(self.step - 1) % len(args)]
+
+    def start(self, args):
+        def flatten(x):
+            if isinstance(x, str):
+                yield x
+            else:
+                for gen in x:
+                    yield from flatten(gen)
+        return ''.join(flatten(args))
+
+    def plain(self, args):
+        yield args[0].value
+
+    def __default__(self, data, children, meta):
+        for child in children:
+            yield child
+
+
+@lru_cache(maxsize=1024)
+def parse_schedule(prompt):
+    """parses the prompt with schedule_parser; returns None if the prompt has no valid syntax. The tree is shared between callers and must not be modified."""
+
+    try:
+        return schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def get_schedule(prompt, base_steps, hires_steps=None, use_old_scheduling=False):
+    """schedule for a single prompt, as a tuple of (step, text) tuples; see get_learned_conditioning_prompt_schedules"""
+
+    if hires_steps is None or use_old_scheduling:
+        int_offset = 0
+        flt_offset = 0
+        steps = base_steps
+    else:
+        int_offset = base_steps
+        flt_offset = 1.0
+        steps = hires_steps
+
+    tree = parse_schedule(prompt)
+    if tree is None:
+        return ((steps, prompt), )
+
+    step_for = partial(schedule_step, steps=steps, int_offset=int_offset, flt_offset=flt_offset, use_old_scheduling=use_old_scheduling)
+
+    collect_steps = CollectSteps(steps, step_for)
+    collect_steps.visit(tree)
+
+    return tuple((t, AtStep(t, step_for).transform(tree)) for t in sorted(set(collect_steps.res)))
+
+
 def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=None, use_old_scheduling=False):
     """
     >>> g = lambda p: get_learned_conditioning_prompt_schedules([p], 10)[0]
@@ -63,73 +164,7 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
     [[5, 'a  c'], [10, 'a b c']]
     """
 
-    if hires_steps is None or use_old_scheduling:
-        int_offset = 0
-        flt_offset = 0
-        steps = base_steps
-    else:
-        int_offset = base_steps
-        flt_offset = 1.0
-        steps = hires_steps
-
-    def collect_steps(steps, tree):
-        res = [steps]
-
-        class CollectSteps(lark.Visitor):
-            def scheduled(self, tree):
-                s = tree.children[-2]
-                v = float(s)
-                if use_old_scheduling:
-                    v = v*steps if v<1 else v
-                else:
-                    if "." in s:
-                        v = (v - flt_offset) * steps
-                    else:
-                        v = (v - int_offset)
-                tree.children[-2] = min(steps, int(v))
-                if tree.children[-2] >= 1:
-                    res.append(tree.children[-2])
-
-            def alternate(self, tree):
-                res.extend(range(1, steps+1))
-
-        CollectSteps().visit(tree)
-        return sorted(set(res))
-
-    def at_step(step, tree):
-        class AtStep(lark.Transformer):
-            def scheduled(self, args):
-                before, after, _, when, _ = args
-                yield before or () if step <= when else after
-            def alternate(self, args):
-                args = ["" if not arg else arg for arg in args]
-                yield args[(step - 1) % len(args)]
-            def start(self, args):
-                def flatten(x):
-                    if isinstance(x, str):
-                        yield x
-                    else:
-                        for gen in x:
-                            yield from flatten(gen)
-                return ''.join(flatten(args))
-            def plain(self, args):
-                yield args[0].value
-            def __default__(self, data, children, meta):
-                for child in children:
-                    yield child
-        return AtStep().transform(tree)
-
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
+    promptdict = {prompt: [list(x) for x in get_schedule(prompt, base_steps, hires_steps, use_old_scheduling)] for prompt in set(prompts)}
     return [promptdict[prompt] for prompt in prompts]
 
 
@@ -177,6 +212,12 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps, hires_steps, use_old_scheduling)
     cache = {}
 
+    unique_schedules = {}
+    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+        unique_schedules.setdefault(prompt, prompt_schedule)
+
+    conds_for_prompts = encode_prompt_schedules(model, prompts, unique_schedules)
+
     for prompt, prompt_schedule in zip(prompts, prompt_schedules):
 
         cached = cache.get(prompt, None)
@@ -184,8 +225,7 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
             res.append(cached)
             continue
 
-        texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
-        conds = model.get_learned_conditioning(texts)
+        conds = conds_for_prompts[prompt]
 
         cond_schedule = []
         for i, (end_at_step, _) in enumerate(prompt_schedule):
@@ -202,6 +242,92 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
     return res
 
 
+def prompt_batch_key(model, texts, prompts):
+    """
+    Returns a key such that texts of prompts with equal keys can be encoded by the text encoder in one call with the same
+    result as in separate calls: all texts in a call are padded to the length of the longest one, and SDXL zeroes
+    negative conditioning only if all texts in the call are empty. For SDXL, cond_stage_model is the conditioner, and
+    the check is done for every text encoder among its embedders. Returns None if the model does not allow this check.
+    """
+
+    cond_stage_model = getattr(model, 'cond_stage_model', None)
+    if hasattr(cond_stage_model, 'process_texts'):
+        text_models = [cond_stage_model]
+    else:
+        text_models = [x for x in getattr(cond_stage_model, 'embedders', []) if hasattr(x, 'process_texts')]
+
+    if not text_models or not all(hasattr(x, 'get_target_prompt_token_count') for x in text_models):
+        return None
+
+    target_token_counts = []
+    for text_model in text_models:
+        _, token_count = text_model.process_texts(texts)
+        target_token_counts.append(text_model.get_target_prompt_token_count(token_count))
+
+    all_empty_negative = getattr(prompts, 'is_negative_prompt', False) and all(x == '' for x in texts)
+
+    return tuple(target_token_counts), all_empty_negative
+
+
+def encode_prompt_schedules(model, prompts, schedules):
+    """
+    Encodes texts of all schedules with model.get_learned_conditioning. Returns a dict mapping every prompt to conds for
+    its schedule, in the same format model.get_learned_conditioning returns them.
+    If enabled in settings, texts of different prompts are deduplicated and encoded together, in as few calls as allowed by
+    the batch size setting; texts of one prompt are never split between calls.
+    """
+
+    from modules import shared
+
+    max_texts = shared.opts.batch_cond_prompts
+    if max_texts <= 0 or len(schedules) < 2:
+        return {prompt: model.get_learned_conditioning(SdConditioning([x[1] for x in schedule], copy_from=prompts)) for prompt, schedule in schedules.items()}
+
+    res = {}
+    groups = {}
+    for prompt, schedule in schedules.items():
+        texts = [x[1] for x in schedule]
+        key = prompt_batch_key(model, texts, prompts)
+        groups.setdefault(key if key is not None else (prompt, ), []).append((prompt, texts))
+
+    def encode(units):
+        unique_texts = []
+        text_indexes = {}
+        for _, texts in units:
+            for text in texts:
+                if text not in text_indexes:
+                    text_indexes[text] = len(unique_texts)
+                    unique_texts.append(text)
+
+        conds = model.get_learned_conditioning(SdConditioning(unique_texts, copy_from=prompts))
+
+        for prompt, texts in units:
+            indexes = [text_indexes[text] for text in texts]
+            if len(units) == 1 and indexes == list(range(len(unique_texts))):
+                res[prompt] = conds
+            elif isinstance(conds, dict):
+                res[prompt] = {k: v[indexes] for k, v in conds.items()}
+            else:
+                res[prompt] = conds[indexes]
+
+    for units in groups.values():
+        batch = []
+        batch_size = 0
+        for unit in units:
+            if batch and batch_size + len(unit[1]) > max_texts:
+                encode(batch)
+                batch = []
+                batch_size = 0
+
+            batch.append(unit)
+            batch_size += len(unit[1])
+
+        if batch:
+            encode(batch)
+
+    return res
+
+
 re_AND = re.compile(r"\bAND\b")
 re_weight = re.compile(r"^((?:\s|.)*?)(?:\s*:\s*([-+]?(?:\d+\.?|\d*\.\d+)))?\s*$")
 
@@ -416,6 +542,13 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
+    return [[part, weight] for part, weight in parse_prompt_attention_cached(text)]
+
+
+@lru_cache(maxsize=4096)
+def parse_prompt_attention_cached(text):
+    """same as parse_prompt_attention, but returns a tuple of (text, weight) tuples that is shared between callers"""
+
     res = []
     round_brackets = []
     square_brackets = []
@@ -468,7 +601,7 @@ def parse_prompt_attention(text):
         else:
             i += 1
 
-    return res
+    return tuple((part, weight) for part, weight in res)
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,114 @@
+import json
+import os
+import struct
+from dataclasses import dataclass, field
+
+from modules import cache
+
+max_header_size = 100 * 1024 * 1024
+
+
+@dataclass
+class SafetensorsHeader:
+    """Contents of the JSON header of a .safetensors file: user metadata and dtype/shape of every tensor, without tensor data."""
+
+    metadata: dict[str, str] = field(default_factory=dict)
+    """the __metadata__ section; values are strings as stored in the file"""
+
+    tensors: dict[str, tuple[str, tuple[int, ...]]] = field(default_factory=dict)
+    """tensor name -> (dtype, shape)"""
+
+    def dtypes(self) -> dict[str, int]:
+        """Number of tensors of each dtype."""
+
+        res = {}
+        for dtype, _ in self.tensors.values():
+            res[dtype] = res.get(dtype, 0) + 1
+
+        return res
+
+    def parameters(self) -> int:
+        """Total number of elements in all tensors."""
+
+        res = 0
+        for _, shape in self.tensors.values():
+            count = 1
+            for dim in shape:
+                count *= dim
+            res += count
+
+        return res
+
+    def shape(self, key):
+        """Shape of the tensor with the given name, or None if there is no such tensor."""
+
+        entry = self.tensors.get(key)
+        return None if entry is None else entry[1]
+
+
+def read_header_bytes(filename, max_size=max_header_size):
+    """Reads the JSON header of a .safetensors file as bytes: the 8-byte length and exactly that many bytes after it; returns None if the header is larger than max_size."""
+
+    with open(filename, "rb") as file:
+        length_bytes = file.read(8)
+        if len(length_bytes) != 8:
+            raise ValueError(f"{filename} is not a safetensors file")
+
+        length = struct.unpack('<Q', length_bytes)[0]
+        if length > max_size:
+            return None
+
+        data = file.read(length)
+
+    if length < 2 or len(data) != length or data[0:1] != b'{':
+        raise ValueError(f"{filename} is not a safetensors file")
+
+    return data
+
+
+def parse_header(data: bytes) -> SafetensorsHeader:
+    obj = json.loads(data)
+
+    res = SafetensorsHeader()
+    for key, value in obj.items():
+        if key == "__metadata__":
+            res.metadata = dict(value or {})
+        else:
+            res.tensors[key] = (value["dtype"], tuple(value["shape"]))
+
+    return res
+
+
+def read_header(filename) -> SafetensorsHeader:
+    """Reads and parses the header of a .safetensors file, without caching."""
+
+    data = read_header_bytes(filename)
+    if data is None:
+        raise ValueError(f"{filename} has a header larger than {max_header_size} bytes")
+
+    return parse_header(data)
+
+
+def get_metadata(filename) -> dict[str, str]:
+    """
+    Returns the __metadata__ section of a .safetensors file, reading the header from disk only if the file's mtime or size
+    changed since it was last read.
+
+    Only metadata is cached: the tensor map can be megabytes for a large checkpoint. Code that needs names and shapes of
+    tensors uses read_header and caches what it derives from them instead.
+    """
+
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+
+    metadata_cache = cache.cache("safetensors-metadata")
+    entry = metadata_cache.get(key)
+    if entry is None or entry.get("mtime") != stat.st_mtime or entry.get("size") != stat.st_size:
+        entry = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "metadata": read_header(filename).metadata,
+        }
+        metadata_cache[key] = entry
+
+    return entry["metadata"]
@@ -1,5 +1,5 @@
 import math
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import torch
 
@@ -26,6 +26,11 @@ PromptChunkFix = namedtuple('PromptChunkFix', ['offset', 'embedding'])
 chunk. Those objects are found in PromptChunk.fixes and, are placed into FrozenCLIPEmbedderWithCustomWordsBase.hijack.fixes, and finally
 are applied by sd_hijack.EmbeddingsWithFixes's forward function."""
 
+tokenization_cache = OrderedDict()
+"""results of TextConditionalModel.tokenize_line for recently seen lines, shared by all jobs; see TextConditionalModel.tokenize_line_cached"""
+
+tokenization_cache_size = 1024
+
 
 class TextConditionalModel(torch.nn.Module):
     def __init__(self):
@@ -173,6 +178,42 @@ class TextConditionalModel(torch.nn.Module):
 
         return chunks, token_count
 
+    def tokenization_cache_key(self, line):
+        """key for tokenization_cache; includes everything besides the line itself that affects the result of tokenize_line"""
+
+        return (
+            line,
+            type(self).__name__,
+            self.id_start,
+            self.id_end,
+            self.comma_token,
+            self.chunk_length,
+            opts.emphasis,
+            opts.comma_padding_backtrack,
+            self.hijack.embedding_db.version,
+        )
+
+    def tokenize_line_cached(self, line):
+        """
+        Same as tokenize_line(), but remembers results for recently used lines, so that the same prompt is not tokenized
+        again by every job. PromptChunk objects in returned list are shared between callers and must not be modified.
+        """
+
+        key = self.tokenization_cache_key(line)
+
+        cached = tokenization_cache.get(key)
+        if cached is None:
+            cached = self.tokenize_line(line)
+
+            tokenization_cache[key] = cached
+            while len(tokenization_cache) > tokenization_cache_size:
+                tokenization_cache.popitem(last=False)
+        else:
+            tokenization_cache.move_to_end(key, last=True)
+
+        chunks, token_count = cached
+        return list(chunks), token_count
+
     def process_texts(self, texts):
         """
         Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
@@ -181,16 +222,10 @@ class TextConditionalModel(torch.nn.Module):
 
         token_count = 0
 
-        cache = {}
         batch_chunks = []
         for line in texts:
-            if line in cache:
-                chunks = cache[line]
-            else:
-                chunks, current_token_count = self.tokenize_line(line)
-                token_count = max(current_token_count, token_count)
-
-                cache[line] = chunks
+            chunks, current_token_count = self.tokenize_line_cached(line)
+            token_count = max(current_token_count, token_count)
 
             batch_chunks.append(chunks)
 
@@ -211,21 +246,29 @@ class TextConditionalModel(torch.nn.Module):
 
         used_embeddings = {}
         chunk_count = max([len(x) for x in batch_chunks])
+        all_batch_chunks = [[chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks] for i in range(chunk_count)]
 
-        zs = []
-        for i in range(chunk_count):
-            batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+        for batch_chunk in all_batch_chunks:
+            for x in batch_chunk:
+                for _position, embedding in x.fixes:
+                    used_embeddings[embedding.name] = embedding
 
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
-            self.hijack.fixes = [x.fixes for x in batch_chunk]
+        devices.torch_npu_set_device()
 
-            for fixes in self.hijack.fixes:
-                for _position, embedding in fixes:
-                    used_embeddings[embedding.name] = embedding
-            devices.torch_npu_set_device()
-            z = self.process_tokens(tokens, multipliers)
-            zs.append(z)
+        if opts.batch_cond_chunks and chunk_count > 1:
+            self.hijack.fixes = [x.fixes for batch_chunk in all_batch_chunks for x in batch_chunk]
+            tokens = [[x.tokens for x in batch_chunk] for batch_chunk in all_batch_chunks]
+            multipliers = [[x.multipliers for x in batch_chunk] for batch_chunk in all_batch_chunks]
+            zs = self.process_token_chunks(tokens, multipliers)
+        else:
+            zs = []
+            for batch_chunk in all_batch_chunks:
+                tokens = [x.tokens for x in batch_chunk]
+                multipliers = [x.multipliers for x in batch_chunk]
+                self.hijack.fixes = [x.fixes for x in batch_chunk]
+
+                z = self.process_tokens(tokens, multipliers)
+                zs.append(z)
 
         if opts.textual_inversion_add_hashes_to_infotext and used_embeddings:
             hashes = []
@@ -258,6 +301,47 @@ class TextConditionalModel(torch.nn.Module):
         Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
         corresponds to one token.
         """
+
+        z = self.encode_tokens(remade_batch_tokens)
+
+        pooled = getattr(z, 'pooled', None)
+
+        z = self.apply_emphasis(z, remade_batch_tokens, batch_multipliers)
+
+        if pooled is not None:
+            z.pooled = pooled
+
+        return z
+
+    def process_token_chunks(self, batch_chunk_tokens, batch_chunk_multipliers):
+        """
+        Same as process_tokens, but for several prompt chunks at once: batch_chunk_tokens and batch_chunk_multipliers have one
+        element for each chunk, and every element is a batch, same as process_tokens accepts. self.hijack.fixes must contain
+        fixes for all chunks' batches one after another.
+        All chunks are sent through transformers network in a single batch; emphasis is then applied to every chunk's output
+        separately, like process_tokens does. Returns a list of tensors, one for each chunk.
+        """
+
+        batch_size = len(batch_chunk_tokens[0])
+
+        z = self.encode_tokens(sum(batch_chunk_tokens, []))
+
+        pooled = getattr(z, 'pooled', None)
+
+        zs = []
+        for i, (remade_batch_tokens, batch_multipliers) in enumerate(zip(batch_chunk_tokens, batch_chunk_multipliers)):
+            z_chunk = self.apply_emphasis(z[i * batch_size:(i + 1) * batch_size], remade_batch_tokens, batch_multipliers)
+
+            if pooled is not None:
+                z_chunk.pooled = pooled[i * batch_size:(i + 1) * batch_size]
+
+            zs.append(z_chunk)
+
+        return zs
+
+    def encode_tokens(self, remade_batch_tokens):
+        """converts a batch of token ids in python lists into a tensor and sends it through transformers network"""
+
         tokens = torch.asarray(remade_batch_tokens).to(devices.device)
 
         # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
@@ -266,10 +350,9 @@ class TextConditionalModel(torch.nn.Module):
                 index = remade_batch_tokens[batch_pos].index(self.id_end)
                 tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
 
-        z = self.encode_with_transformers(tokens)
-
-        pooled = getattr(z, 'pooled', None)
+        return self.encode_with_transformers(tokens)
 
+    def apply_emphasis(self, z, remade_batch_tokens, batch_multipliers):
         emphasis = sd_emphasis.get_current_option(opts.emphasis)()
         emphasis.tokens = remade_batch_tokens
         emphasis.multipliers = torch.asarray(batch_multipliers).to(devices.device)
@@ -277,12 +360,7 @@ class TextConditionalModel(torch.nn.Module):
 
         emphasis.after_transformers()
 
-        z = emphasis.z
-
-        if pooled is not None:
-            z.pooled = pooled
-
-        return z
+        return emphasis.z
 
 
 class FrozenCLIPEmbedderWithCustomWordsBase(TextConditionalModel):
@@ -13,7 +13,7 @@ from urllib import request
 import ldm.modules.midas as midas
 import gc
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, extra_networks, processing, lowvram, sd_hijack, patches, safetensors_header, cache
 from modules.timer import Timer
 import numpy as np
 from modules_forge import forge_loader
@@ -76,16 +76,13 @@ class CheckpointInfo:
         if name.startswith("\\") or name.startswith("/"):
             name = name[1:]
 
-        def read_metadata():
-            metadata = read_metadata_from_safetensors(filename)
-            self.modelspec_thumbnail = metadata.pop('modelspec.thumbnail', None)
-
-            return metadata
-
         self.metadata = {}
+        self.architecture = None
         if self.is_safetensors:
             try:
-                self.metadata = cache.cached_data_for_file('safetensors-metadata', "checkpoint/" + name, filename, read_metadata)
+                self.metadata = read_metadata_from_safetensors(filename)
+                self.modelspec_thumbnail = self.metadata.pop('modelspec.thumbnail', None)
+                _, self.architecture = sd_models_config.guess_model_from_header(filename)
             except Exception as e:
                 errors.display(e, f"reading metadata for {filename}")
 
@@ -288,29 +285,27 @@ def get_state_dict_from_checkpoint(pl_sd):
 def read_metadata_from_safetensors(filename):
     import json
 
-    with open(filename, mode="rb") as file:
-        metadata_len = file.read(8)
-        metadata_len = int.from_bytes(metadata_len, "little")
-        json_start = file.read(2)
-
-        assert metadata_len > 2 and json_start in (b'{"', b"{'"), f"{filename} is not a safetensors file"
-
-        res = {}
-
-        try:
-            json_data = json_start + file.read(metadata_len-2)
-            json_obj = json.loads(json_data)
-            for k, v in json_obj.get("__metadata__", {}).items():
-                res[k] = v
-                if isinstance(v, str) and v[0:1] == '{':
-                    try:
-                        res[k] = json.loads(v)
-                    except Exception:
-                        pass
-        except Exception:
-             errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
+    try:
+        metadata = safetensors_header.get_metadata(filename)
+    except json.JSONDecodeError:
+        errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
+        return {}
+    except ValueError as e:
+        raise AssertionError(f"{filename} is not a safetensors file") from e
+    except Exception:
+        errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
+        return {}
+
+    res = {}
+    for k, v in metadata.items():
+        res[k] = v
+        if isinstance(v, str) and v[0:1] == '{':
+            try:
+                res[k] = json.loads(v)
+            except Exception:
+                pass
 
-        return res
+    return res
 
 
 def read_state_dict(checkpoint_file, print_global_state=False, map_location=None):
@@ -603,6 +598,59 @@ def get_empty_cond(sd_model):
     return d
 
 
+empty_conds = collections.OrderedDict()
+"""(checkpoint, settings) -> empty prompt conditioning, for the most recently loaded checkpoints; see get_empty_cond_cached"""
+
+empty_conds_limit = 8
+
+
+def get_empty_cond_cached(sd_model, checkpoint_info=None):
+    """
+    Same as get_empty_cond, but computes the conditioning only once for every checkpoint and combination of settings that
+    affect it: clip skip and dtypes. Results are kept in memory for a few recently loaded checkpoints, so that switching
+    between checkpoints (like for refiner or hires fix checkpoint) does not run the text encoder again, and, if enabled
+    in settings, on disk, keyed by the checkpoint's hash.
+    Extra networks are always deactivated for the empty prompt, so they are not part of the key.
+    """
+
+    if checkpoint_info is None:
+        return get_empty_cond(sd_model)
+
+    key = f"clip_skip={shared.opts.CLIP_stop_at_last_layers},sdxl_clip_l_skip={shared.opts.sdxl_clip_l_skip},text_encoder_dtype={model_management.text_encoder_dtype()},dtype={devices.dtype_inference}"
+
+    checkpoint_hash = checkpoint_info.sha256
+    memory_key = (checkpoint_hash or f"{os.path.abspath(checkpoint_info.filename)}:{os.path.getmtime(checkpoint_info.filename)}", key)
+
+    cond = empty_conds.get(memory_key)
+    if cond is not None:
+        empty_conds.move_to_end(memory_key)
+        return cond
+
+    disk_cache = cache.cache('empty-cond') if shared.opts.sd_empty_cond_disk_cache and checkpoint_hash else None
+    disk_key = f"{checkpoint_hash}:{key}"
+
+    cond = None
+    if disk_cache is not None:
+        try:
+            cached = disk_cache.get(disk_key)
+            if cached is not None:
+                cond = cached.to(devices.device)
+        except Exception as e:
+            errors.display(e, "loading cached empty prompt conditioning")
+
+    if cond is None:
+        cond = get_empty_cond(sd_model)
+
+        if disk_cache is not None:
+            disk_cache[disk_key] = cond.detach().cpu()
+
+    empty_conds[memory_key] = cond
+    while len(empty_conds) > empty_conds_limit:
+        empty_conds.popitem(last=False)
+
+    return cond
+
+
 def send_model_to_cpu(m):
     pass
 
@@ -694,7 +742,7 @@ if shared.opts.model_management_type == 'Old':
         timer.record("scripts callbacks")
 
         with torch.no_grad():
-            sd_model.cond_stage_model_empty_prompt = get_empty_cond(sd_model)
+            sd_model.cond_stage_model_empty_prompt = get_empty_cond_cached(sd_model, checkpoint_info)
 
         timer.record("calculate empty prompt")
 
@@ -769,7 +817,7 @@ elif shared.opts.model_management_type == 'New':
         timer.record("scripts callbacks")
 
         with torch.no_grad():
-            sd_model.cond_stage_model_empty_prompt = get_empty_cond(sd_model)
+            sd_model.cond_stage_model_empty_prompt = get_empty_cond_cached(sd_model, checkpoint_info)
         timer.record("calculate empty prompt")
 
         print(f"Model {checkpoint_info.title} loaded in {timer.summary()}.")
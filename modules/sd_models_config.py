@@ -2,7 +2,7 @@ import os
 
 import torch
 
-from modules import shared, paths, sd_disable_initialization, devices
+from modules import shared, paths, sd_disable_initialization, devices, cache, errors, safetensors_header
 
 sd_configs_path = shared.sd_configs_path
 sd_repo_configs_path = os.path.join(paths.paths['Stable Diffusion'], "configs", "stable-diffusion")
@@ -25,6 +25,24 @@ config_alt_diffusion = os.path.join(sd_configs_path, "alt-diffusion-inference.ya
 config_alt_diffusion_m18 = os.path.join(sd_configs_path, "alt-diffusion-m18-inference.yaml")
 config_sd3 = os.path.join(sd_configs_path, "sd3-inference.yaml")
 
+config_architectures = {
+    config_default: "SD1",
+    config_inpainting: "SD1",
+    config_instruct_pix2pix: "SD1",
+    config_alt_diffusion: "SD1",
+    config_alt_diffusion_m18: "SD1",
+    config_sd2: "SD2",
+    config_sd2v: "SD2",
+    config_sd2_inpainting: "SD2",
+    config_depth_model: "SD2",
+    config_unclip: "SD2",
+    config_unopenclip: "SD2",
+    config_sdxl: "SDXL",
+    config_sdxl_inpainting: "SDXL",
+    config_sdxl_refiner: "SDXL Refiner",
+    config_sd3: "SD3",
+}
+
 
 def is_using_v_parameterization_for_sd2(state_dict):
     """
@@ -69,51 +87,110 @@ def is_using_v_parameterization_for_sd2(state_dict):
     return out < -1
 
 
-def guess_model_config_from_state_dict(sd, filename):
-    sd2_cond_proj_weight = sd.get('cond_stage_model.model.transformer.resblocks.0.attn.in_proj_weight', None)
-    diffusion_model_input = sd.get('model.diffusion_model.input_blocks.0.0.weight', None)
-    sd2_variations_weight = sd.get('embedder.model.ln_final.weight', None)
+def guess_model_config_from_shapes(shapes, metadata=None):
+    """
+    Guesses config for a checkpoint using only names and shapes of its tensors, as listed in a .safetensors header.
+    Returns None if that's not enough - for SD2 models, telling v-prediction apart needs the weights unless
+    the model's metadata says which prediction type it uses.
+    """
+
+    metadata = metadata or {}
+
+    sd2_turbo_ln_final = shapes.get('conditioner.embedders.0.model.ln_final.weight', None)
+    if sd2_turbo_ln_final is not None and sd2_turbo_ln_final[0] == 1024:
+        # SD 2.1 Turbo in SGM format; use the names its tensors get in the state dict after loading
+        from modules import sd_models
+
+        shapes = {sd_models.transform_checkpoint_dict_key(k, sd_models.checkpoint_dict_replacements_sd2_turbo): v for k, v in shapes.items()}
 
-    if "model.diffusion_model.x_embedder.proj.weight" in sd:
+    sd2_cond_proj_weight = shapes.get('cond_stage_model.model.transformer.resblocks.0.attn.in_proj_weight', None)
+    diffusion_model_input = shapes.get('model.diffusion_model.input_blocks.0.0.weight', None)
+    sd2_variations_weight = shapes.get('embedder.model.ln_final.weight', None)
+
+    if "model.diffusion_model.x_embedder.proj.weight" in shapes:
         return config_sd3
 
-    if sd.get('conditioner.embedders.1.model.ln_final.weight', None) is not None:
-        if diffusion_model_input.shape[1] == 9:
+    if shapes.get('conditioner.embedders.1.model.ln_final.weight', None) is not None:
+        if diffusion_model_input[1] == 9:
             return config_sdxl_inpainting
         else:
             return config_sdxl
 
-    if sd.get('conditioner.embedders.0.model.ln_final.weight', None) is not None:
+    if shapes.get('conditioner.embedders.0.model.ln_final.weight', None) is not None:
         return config_sdxl_refiner
-    elif sd.get('depth_model.model.pretrained.act_postprocess3.0.project.0.bias', None) is not None:
+    elif shapes.get('depth_model.model.pretrained.act_postprocess3.0.project.0.bias', None) is not None:
         return config_depth_model
-    elif sd2_variations_weight is not None and sd2_variations_weight.shape[0] == 768:
+    elif sd2_variations_weight is not None and sd2_variations_weight[0] == 768:
         return config_unclip
-    elif sd2_variations_weight is not None and sd2_variations_weight.shape[0] == 1024:
+    elif sd2_variations_weight is not None and sd2_variations_weight[0] == 1024:
         return config_unopenclip
 
-    if sd2_cond_proj_weight is not None and sd2_cond_proj_weight.shape[1] == 1024:
-        if diffusion_model_input.shape[1] == 9:
+    if sd2_cond_proj_weight is not None and sd2_cond_proj_weight[1] == 1024:
+        prediction_type = metadata.get('modelspec.prediction_type', None)
+        if diffusion_model_input[1] == 9:
             return config_sd2_inpainting
-        elif is_using_v_parameterization_for_sd2(sd):
+        elif prediction_type == 'v':
             return config_sd2v
-        else:
+        elif prediction_type == 'epsilon':
             return config_sd2
+        else:
+            return None
 
     if diffusion_model_input is not None:
-        if diffusion_model_input.shape[1] == 9:
+        if diffusion_model_input[1] == 9:
             return config_inpainting
-        if diffusion_model_input.shape[1] == 8:
+        if diffusion_model_input[1] == 8:
             return config_instruct_pix2pix
 
-    if sd.get('cond_stage_model.roberta.embeddings.word_embeddings.weight', None) is not None:
-        if sd.get('cond_stage_model.transformation.weight').size()[0] == 1024:
+    if shapes.get('cond_stage_model.roberta.embeddings.word_embeddings.weight', None) is not None:
+        if shapes.get('cond_stage_model.transformation.weight')[0] == 1024:
             return config_alt_diffusion_m18
         return config_alt_diffusion
 
     return config_default
 
 
+def guess_model_config_from_state_dict(sd, filename):
+    shapes = {k: tuple(v.shape) for k, v in sd.items() if isinstance(v, torch.Tensor)}
+
+    config = guess_model_config_from_shapes(shapes)
+    if config is None:
+        config = config_sd2v if is_using_v_parameterization_for_sd2(sd) else config_sd2
+
+    return config
+
+
+def architecture_from_shapes(shapes, config):
+    if config is None:
+        return "SD2"
+
+    architecture = config_architectures.get(config, "Unknown")
+    if architecture == "SDXL" and 'model.diffusion_model.middle_block.1.transformer_blocks.0.attn1.to_q.weight' not in shapes:
+        architecture = "SSD"
+
+    return architecture
+
+
+def guess_model_from_header(filename):
+    """
+    Guesses config and architecture (SD1, SD2, SDXL, SDXL Refiner, SSD, SD3) of a .safetensors checkpoint from its header,
+    without reading any weights. The verdict is cached for the file. Returns a (config, architecture) tuple;
+    config is None if the header is not enough to choose it.
+    """
+
+    def guess():
+        header = safetensors_header.read_header(filename)
+        shapes = {k: shape for k, (_, shape) in header.tensors.items()}
+        config = guess_model_config_from_shapes(shapes, header.metadata)
+
+        return {"config": os.path.basename(config) if config else None, "architecture": architecture_from_shapes(shapes, config)}
+
+    verdict = cache.cached_data_for_file('checkpoint-architecture-v2', os.path.abspath(filename), filename, guess)
+    configs_by_name = {os.path.basename(x): x for x in config_architectures}
+
+    return configs_by_name.get(verdict["config"]), verdict["architecture"]
+
+
 def find_checkpoint_config(state_dict, info):
     if info is None:
         return guess_model_config_from_state_dict(state_dict, "")
@@ -122,6 +199,14 @@ def find_checkpoint_config(state_dict, info):
     if config is not None:
         return config
 
+    if info.is_safetensors:
+        try:
+            config, _ = guess_model_from_header(info.filename)
+            if config is not None:
+                return config
+        except Exception as e:
+            errors.display(e, f"guessing config for {info.filename}")
+
     return guess_model_config_from_state_dict(state_dict, info.filename)
 
 
@@ -99,6 +99,7 @@ options_templates.update(options_section(('saving-to-dirs', "Saving to a directo
 
 options_templates.update(options_section(('upscaling', "Upscaling", "postprocessing"), {
     "unload_sd_during_upscale": OptionInfo(False, "Unload SD Model from VRAM to RAM during upscale"),
+    "upscaler_models_cache_limit": OptionInfo(1, "Number of upscaler models to keep loaded", gr.Slider, {"minimum": 0, "maximum": 5, "step": 1}).info("0 = load from disk for every image; loaded models are moved out of VRAM when other models need space"),
     "ESRGAN_tile": OptionInfo(256, "Tile size for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 4096, "step": 16}).info("0 = no tiling"),
     "ESRGAN_tile_overlap": OptionInfo(32, "Tile overlap for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 2048, "step": 8}).info("Low values = visible seam"),
     "RCAN_tile": OptionInfo(512, "Tile size for RCAN upscaler. 0 = no tiling.", gr.Slider, {"minimum": 0, "maximum": 4096, "step": 16}),
@@ -117,6 +118,7 @@ options_templates.update(options_section(('upscaling', "Upscaling", "postprocess
     "SPAN_tile_overlap": OptionInfo(32, "Tile overlap for SPAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 2048, "step": 32}).info("Low values = visible seam"),
     "COMPACT_tile": OptionInfo(0, "Tile size for COMPACT upscalers.", gr.Slider, {"minimum": 0, "maximum": 4096, "step": 16}).info("0 = no tiling"),
     "COMPACT_tile_overlap": OptionInfo(32, "Tile overlap for COMPACT upscalers.", gr.Slider, {"minimum": 0, "maximum": 2048, "step": 16}).info("Low values = visible seam"),
+    "upscaler_tile_batch_size": OptionInfo(8, "Maximum number of tiles upscaled at once", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}).info("fewer are used if they do not fit into free VRAM; 1 = one tile at a time"),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "dat_enabled_models": OptionInfo(["DAT x2", "DAT x3", "DAT x4"], "Select which DAT models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.dat_models_names()}),
     "DAT_tile": OptionInfo(192, "Tile size for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
@@ -129,6 +131,7 @@ options_templates.update(options_section(('face-restoration', "Face restoration"
     "face_restoration_model": OptionInfo("CodeFormer", "Face restoration model", gr.Radio, lambda: {"choices": [x.name() for x in shared.face_restorers]}),
     "code_former_weight": OptionInfo(0.5, "CodeFormer weight", gr.Slider, {"minimum": 0, "maximum": 1, "step": 0.01}).info("0 = maximum effect; 1 = minimum effect"),
     "face_restoration_unload": OptionInfo(False, "Move face restoration model from VRAM into RAM after processing"),
+    "face_restoration_batch_size": OptionInfo(8, "Maximum number of faces to restore at once", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}).info("faces from all images in a batch are restored together"),
 }))
 
 options_templates.update(options_section(('system', "System", "system"), {
@@ -173,6 +176,10 @@ options_templates.update(options_section(('API', "API", "system"), {
 options_templates.update(options_section(('training', "Training", "training"), {
     "unload_models_when_training": OptionInfo(False, "Move VAE and CLIP to RAM when training if possible. Saves VRAM."),
     "pin_memory": OptionInfo(False, "Turn on pin_memory for DataLoader. Makes training slightly faster but can increase memory usage."),
+    "training_latent_cache": OptionInfo(True, "Cache VAE-encoded dataset images on disk").info("latents are reused when training is restarted with the same images, size and VAE; stored in the cache directory"),
+    "training_aspect_ratio_buckets": OptionInfo(True, "Sort images into aspect ratio buckets when training with \"Do not resize images\"").info("images are resized and cropped to the nearest of a set of resolutions with about the area of training width x height; otherwise, they are batched only with images of the exact same size"),
+    "training_bucket_max_aspect_ratio": OptionInfo(2.0, "Maximum aspect ratio of a bucket", gr.Slider, {"minimum": 1.0, "maximum": 4.0, "step": 0.25}),
+    "training_dataloader_prefetch": OptionInfo(2, "Number of training batches to prepare ahead in background threads", gr.Slider, {"minimum": 0, "maximum": 8, "step": 1}).info("0 = prepare each batch when it's needed"),
     "save_optimizer_state": OptionInfo(False, "Saves Optimizer state as separate *.optim file. Training of embedding or HN can be resumed with the matching optim file."),
     "save_training_settings_to_txt": OptionInfo(True, "Save textual inversion and hypernet settings to a text file whenever training starts."),
     "dataset_filename_word_regex": OptionInfo("", "Filename word regex"),
@@ -190,6 +197,7 @@ options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
     "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
+    "sd_empty_cond_disk_cache": OptionInfo(False, "Cache empty prompt conditioning on disk").info("saves the text encoder output for an empty prompt for every checkpoint with a known hash, so that loading the checkpoint again does not have to run the text encoder"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
     "emphasis": OptionInfo("Original", "Emphasis mode", gr.Radio, lambda: {"choices": [x.name for x in sd_emphasis.options]}, infotext="Emphasis").info("makes it possible to make model to pay (more:1.1) or (less:0.9) attention to text when you use the syntax in prompt; " + sd_emphasis.get_options_descriptions()),
@@ -319,6 +327,8 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
+    "batch_cond_chunks": OptionInfo(True, "Batch prompt chunks").info("send all 75-token chunks of long prompts through text encoder in one batch; uses a bit more VRAM, but improves speed"),
+    "batch_cond_prompts": OptionInfo(0, "Batch different prompts for text encoder", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}).info("maximum number of texts from different prompts (AND parts, prompt editing steps, batch) to encode in one text encoder call; 0 = one call per prompt; with Original emphasis mode, results can differ slightly from one call per prompt"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
 }))
@@ -343,12 +353,14 @@ options_templates.update(options_section(('interrogate', "Interrogate"), {
     "interrogate_clip_min_length": OptionInfo(24, "BLIP: minimum description length", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}),
     "interrogate_clip_max_length": OptionInfo(48, "BLIP: maximum description length", gr.Slider, {"minimum": 1, "maximum": 256, "step": 1}),
     "interrogate_clip_dict_limit": OptionInfo(1500, "CLIP: maximum number of lines in text file").info("0 = No limit"),
+    "interrogate_batch_size": OptionInfo(8, "Number of images to interrogate at once in batch mode", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
     "interrogate_clip_skip_categories": OptionInfo([], "CLIP: skip inquire categories", gr.CheckboxGroup, lambda: {"choices": interrogate.category_types()}, refresh=interrogate.category_types),
     "interrogate_deepbooru_score_threshold": OptionInfo(0.5, "deepbooru: score threshold", gr.Slider, {"minimum": 0, "maximum": 1, "step": 0.01}),
     "deepbooru_sort_alpha": OptionInfo(True, "deepbooru: sort tags alphabetically").info("if not: sort by score"),
     "deepbooru_use_spaces": OptionInfo(True, "deepbooru: use spaces in tags").info("if not: use underscores"),
     "deepbooru_escape": OptionInfo(True, "deepbooru: escape (\\) brackets").info("so they are used as literal brackets and not for emphasis"),
     "deepbooru_filter_tags": OptionInfo("", "deepbooru: filter out those tags").info("separate by comma"),
+    "deepbooru_batch_size": OptionInfo(16, "deepbooru: number of images to tag at once", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("when tagging many images"),
 }))
 
 options_templates.update(options_section(('extra_networks', "Extra Networks", "sd"), {
@@ -360,6 +372,7 @@ options_templates.update(options_section(('extra_networks', "Extra Networks", "s
     "extra_networks_card_height": OptionInfo(0, "Card height for Extra Networks").info("in pixels"),
     "extra_networks_card_text_scale": OptionInfo(1.0, "Card text scale", gr.Slider, {"minimum": 0.0, "maximum": 2.0, "step": 0.01}).info("1 = original size"),
     "extra_networks_card_show_desc": OptionInfo(True, "Show description on card"),
+    "extra_networks_thumbnail_size": OptionInfo(512, "Size of Extra Networks card preview thumbnails", gr.Number, {"precision": 0}).info("in pixels; previews are shrunk to fit and cached as WebP; 0 = send full-size previews"),
     "extra_networks_card_description_is_html": OptionInfo(False, "Treat card description as HTML"),
     "extra_networks_card_order_field": OptionInfo("Path", "Default order field for Extra Networks cards", gr.Dropdown, {"choices": ['Path', 'Name', 'Date Created', 'Date Modified']}).needs_reload_ui(),
     "extra_networks_card_order": OptionInfo("Ascending", "Default order for Extra Networks cards", gr.Dropdown, {"choices": ['Ascending', 'Descending']}).needs_reload_ui(),
@@ -368,6 +381,8 @@ options_templates.update(options_section(('extra_networks', "Extra Networks", "s
     "extra_networks_tree_view_default_width": OptionInfo(180, "Default width for the Extra Networks directory tree view", gr.Number).needs_reload_ui(),
     "extra_networks_add_text_separator": OptionInfo(" ", "Extra networks separator").info("extra text to add before <...> when adding extra network to prompt"),
     "ui_extra_networks_tab_reorder": OptionInfo("", "Extra networks tab order").needs_reload_ui(),
+    "extra_networks_cards_page_size": OptionInfo(0, "Number of Extra Networks cards to load at once", gr.Number, {"precision": 0}).info("0 = all; otherwise cards are loaded from server in pages as you scroll, search and sort are done on server, and the directory tree only lists directories").needs_reload_ui(),
+    "extra_networks_persistent_index": OptionInfo(True, "Keep an on-disk index of Extra Networks descriptions and user metadata").info("speeds up refreshing pages with many items; files are only read again after they change"),
     "textual_inversion_print_at_load": OptionInfo(False, "Print a list of Textual Inversion embeddings when loading model"),
     "textual_inversion_add_hashes_to_infotext": OptionInfo(True, "Add Textual Inversion hashes to infotext"),
     "sd_hypernetwork": OptionInfo("None", "Add hypernetwork to prompt", gr.Dropdown, lambda: {"choices": ["None", *shared.hypernetworks]}, refresh=shared_items.reload_hypernetworks),
@@ -812,6 +827,8 @@ options_templates.update(options_section(('postprocessing', "Postprocessing", "p
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts(filter_out_main_ui_only=True)]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     'postprocessing_existing_caption_action': OptionInfo("Ignore", "Action for existing captions", gr.Radio, {"choices": ["Ignore", "Keep", "Prepend", "Append"]}).info("when generating captions using postprocessing; Ignore = use generated; Keep = use original; Prepend/Append = combine both"),
+    'postprocessing_io_threads': OptionInfo(4, "Number of threads for reading and saving images in extras batch processing", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("images are read ahead and saved in background while others are processed; saving with numbered filenames always uses one thread"),
+    'postprocessing_skip_existing': OptionInfo(False, "Skip images that already have results in output directory when processing a directory").info("requires \"Use original name for output filename during batch process in extras tab\"; lets an interrupted batch continue where it stopped"),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from functools import lru_cache
 from pathlib import Path
 from modules import errors
 import csv
@@ -25,6 +26,11 @@ def merge_prompts(style_prompt: str, prompt: str) -> str:
 
 
 def apply_styles_to_prompt(prompt, styles):
+    return apply_styles_to_prompt_cached(prompt, tuple(styles))
+
+
+@lru_cache(maxsize=1024)
+def apply_styles_to_prompt_cached(prompt, styles):
     for style in styles:
         prompt = merge_prompts(style, prompt)
 
@@ -79,6 +85,51 @@ def extract_original_prompts(style: PromptStyle, prompt, negative_prompt):
     return True, extracted_positive, extracted_negative
 
 
+def style_text_suffix(style_text):
+    """Text that a prompt must end with (after stripping) for extract_style_text_from_prompt to find style_text in it."""
+
+    stripped_style_text = (style_text or "").strip()
+    if "{prompt}" in stripped_style_text:
+        return stripped_style_text.partition("{prompt}")[2]
+
+    return stripped_style_text
+
+
+class StyleIndex:
+    """
+    Groups styles by the text a prompt must end with if the style was applied to it, so that extracting styles from
+    a prompt only has to check styles that can possibly match, instead of every style in the database.
+    """
+
+    def __init__(self, styles):
+        self.styles = tuple(styles)
+        self.by_suffix = {}
+        """length of suffix -> {suffix: [indexes of styles in self.styles]}"""
+
+        for i, style in enumerate(self.styles):
+            if not style.prompt and not style.negative_prompt:
+                continue
+
+            suffix = style_text_suffix(style.prompt)
+            self.by_suffix.setdefault(len(suffix), {}).setdefault(suffix, []).append(i)
+
+    def candidates(self, prompt):
+        """Returns sorted indexes of styles whose positive prompt can be extracted from the prompt."""
+
+        stripped_prompt = prompt.strip()
+
+        res = []
+        for length, suffixes in self.by_suffix.items():
+            if length > len(stripped_prompt):
+                continue
+
+            indexes = suffixes.get(stripped_prompt[len(stripped_prompt) - length:])
+            if indexes:
+                res.extend(indexes)
+
+        return sorted(res)
+
+
 class StyleDatabase:
     def __init__(self, paths: list[str | Path]):
         self.no_style = PromptStyle("None", "", "", None)
@@ -95,6 +146,7 @@ class StyleDatabase:
             self.default_path = Path(self.paths[0])
 
         self.prompt_fields = [field for field in PromptStyle._fields if field != "path"]
+        self.index = None
 
         self.reload()
 
@@ -129,6 +181,17 @@ class StyleDatabase:
             if styles_file.is_file():
                 self.load_from_csv(styles_file)
 
+        self.get_index()
+
+    def get_index(self) -> StyleIndex:
+        """Returns StyleIndex for current styles, rebuilding it if styles were added, changed or removed since it was built."""
+
+        styles = tuple(self.styles.values())
+        if self.index is None or self.index.styles != styles:
+            self.index = StyleIndex(styles)
+
+        return self.index
+
     def load_from_csv(self, path: str | Path):
         try:
             with open(path, "r", encoding="utf-8-sig", newline="") as file:
@@ -210,17 +273,23 @@ class StyleDatabase:
     def extract_styles_from_prompt(self, prompt, negative_prompt):
         extracted = []
 
-        applicable_styles = list(self.styles.values())
+        index = self.get_index()
+        extracted_indexes = set()
 
         while True:
             found_style = None
 
-            for style in applicable_styles:
+            for i in index.candidates(prompt):
+                if i in extracted_indexes:
+                    continue
+
+                style = index.styles[i]
                 is_match, new_prompt, new_neg_prompt = extract_original_prompts(
                     style, prompt, negative_prompt
                 )
                 if is_match:
                     found_style = style
+                    extracted_indexes.add(i)
                     prompt = new_prompt
                     negative_prompt = new_neg_prompt
                     break
@@ -228,7 +297,6 @@ class StyleDatabase:
             if not found_style:
                 break
 
-            applicable_styles.remove(found_style)
             extracted.append(found_style.name)
 
         return list(reversed(extracted)), prompt, negative_prompt
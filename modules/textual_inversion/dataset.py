@@ -1,34 +1,128 @@
+import copy
+import hashlib
+import math
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import PIL
 import torch
 from torch.utils.data import Dataset, DataLoader, Sampler
 from torchvision import transforms
 from collections import defaultdict
-from random import shuffle, choices
+from random import shuffle, choices, sample
 
 import random
 import tqdm
-from modules import devices, shared, images
+from modules import devices, shared, images, cache, sd_vae
 import re
 
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 
 re_numbers_at_start = re.compile(r"^[-\d]+\s*")
 
+latent_cache_dir = os.path.join(cache.cache_dir, "training-latents")
+
 
 class DatasetEntry:
-    def __init__(self, filename=None, filename_text=None, latent_dist=None, latent_sample=None, cond=None, cond_text=None, pixel_values=None, weight=None):
+    def __init__(self, filename=None, filename_text=None, latent_dist=None, latent_sample=None, cond=None, cond_text=None, pixel_values=None, weight=None, latent_filename=None):
         self.filename = filename
         self.filename_text = filename_text
         self.weight = weight
         self.latent_dist = latent_dist
         self.latent_sample = latent_sample
+        self.latent_filename = latent_filename
         self.cond = cond
         self.cond_text = cond_text
         self.pixel_values = pixel_values
 
 
+def latent_cache_filename(path, size, latent_sampling_method, use_weight, vae_id):
+    """
+    Name of the file in latent_cache_dir for the latents of image at path; the name is derived from the image's contents,
+    the way it is sized for training (size), latent sampling method, whether the weight map is used and the VAE, so that
+    a change in any of them gives a different file. The hash of the image's contents is only computed again when the
+    image file is modified.
+    """
+
+    def calculate_image_hash():
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    image_hash = cache.cached_data_for_file("training-image-hashes", os.path.abspath(path), path, calculate_image_hash)
+
+    key = f"{image_hash}-{size}-{latent_sampling_method}-{'weight' if use_weight else 'noweight'}-{vae_id}"
+
+    return os.path.join(latent_cache_dir, f"{hashlib.sha256(key.encode('utf8')).hexdigest()}.safetensors")
+
+
+def read_cached_latents(filename, metadata_only=False):
+    """Reads the tensors and metadata of a file written by save_cached_latents; with metadata_only, only the file's header is read."""
+
+    import safetensors
+
+    with safetensors.safe_open(filename, framework="pt", device="cpu") as file:
+        tensors = {} if metadata_only else {key: file.get_tensor(key) for key in file.keys()}
+        return tensors, file.metadata() or {}
+
+
+def save_cached_latents(filename, tensors, metadata):
+    import safetensors.torch
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    temp_filename = f"{filename}.tmp"
+    safetensors.torch.save_file({k: v.contiguous() for k, v in tensors.items()}, temp_filename, metadata=metadata)
+    os.replace(temp_filename, filename)
+
+
+def aspect_ratio_buckets(width, height, max_aspect_ratio, step=64):
+    """
+    Resolutions for aspect ratio bucketing: both sides are multiples of step, every area is as close as possible to
+    width x height without exceeding it, and aspect ratios are at most max_aspect_ratio in either orientation.
+    """
+
+    area = width * height
+    buckets = {(width, height)}
+    for w in range(step, int(math.sqrt(area * max_aspect_ratio)) + 1, step):
+        h = area // w // step * step
+        if h >= step and max(w / h, h / w) <= max_aspect_ratio:
+            buckets.add((w, h))
+
+    return sorted(buckets)
+
+
+def nearest_bucket(buckets, size):
+    """The bucket with aspect ratio closest to that of size."""
+
+    w, h = size
+    return min(buckets, key=lambda b: abs(math.log(b[0] / b[1]) - math.log(w / h)))
+
+
+def resize_to_bucket(image, bucket):
+    """Resizes the image to cover the bucket's resolution, keeping aspect ratio, and crops the excess evenly from both sides."""
+
+    w, h = bucket
+    scale = max(w / image.width, h / image.height)
+    resized_width, resized_height = max(w, round(image.width * scale)), max(h, round(image.height * scale))
+    image = image.resize((resized_width, resized_height), PIL.Image.BICUBIC)
+
+    left = (resized_width - w) // 2
+    top = (resized_height - h) // 2
+    return image.crop((left, top, left + w, top + h))
+
+
+def vae_identity(model):
+    """A string identifying the VAE used by model for latent_cache_filename, or None if there is no way to tell."""
+
+    vae_hash = sd_vae.get_loaded_vae_hash() or getattr(model, 'sd_model_hash', None)
+    if vae_hash is None:
+        return None
+
+    return f"{vae_hash}-{devices.dtype_vae}"
+
+
 class PersonalizedBase(Dataset):
     def __init__(self, data_root, width, height, repeats, flip_p=0.5, placeholder_token="*", model=None, cond_model=None, device=None, template_file=None, include_cond=False, batch_size=1, gradient_step=1, shuffle_tags=False, tag_drop_out=0, latent_sampling_method='once', varsize=False, use_weight=False):
         re_word = re.compile(shared.opts.dataset_filename_word_regex) if shared.opts.dataset_filename_word_regex else None
@@ -54,11 +148,52 @@ class PersonalizedBase(Dataset):
         self.tag_drop_out = tag_drop_out
         groups = defaultdict(list)
 
+        vae_id = vae_identity(model) if shared.opts.training_latent_cache else None
+        if shared.opts.training_latent_cache and vae_id is None:
+            print("Not caching latents of the dataset on disk: could not get the hash of VAE.")
+
+        buckets = None
+        if varsize and shared.opts.training_aspect_ratio_buckets:
+            max_aspect_ratio = shared.opts.training_bucket_max_aspect_ratio
+            buckets = aspect_ratio_buckets(width, height, max_aspect_ratio)
+            size_key = f"buckets-{width}x{height}-{max_aspect_ratio}"
+        elif varsize:
+            size_key = "varsize"
+        else:
+            size_key = f"{width}x{height}"
+
+        requested_latent_sampling_method = latent_sampling_method
+        cache_hits = 0
+
         print("Preparing dataset...")
         for path in tqdm.tqdm(self.image_paths):
             alpha_channel = None
             if shared.state.interrupted:
                 raise Exception("interrupted")
+
+            latent_filename = None
+            cached = None
+            if vae_id is not None:
+                try:
+                    latent_filename = latent_cache_filename(path, size_key, requested_latent_sampling_method, use_weight, vae_id)
+                    if os.path.exists(latent_filename):
+                        cached = read_cached_latents(latent_filename, metadata_only=True)[1]
+                except Exception:
+                    latent_filename = None
+                    cached = None
+
+            if cached is not None:
+                filename_text = self.read_filename_text(path, re_word)
+                if cached.get("latent_sampling_method") == "once" and latent_sampling_method == "deterministic":
+                    latent_sampling_method = "once"
+
+                entry = DatasetEntry(filename=path, filename_text=filename_text, latent_filename=latent_filename)
+                self.add_entry(entry, include_cond, cond_model)
+                groups[(int(cached["width"]), int(cached["height"]))].append(len(self.dataset))
+                self.dataset.append(entry)
+                cache_hits += 1
+                continue
+
             try:
                 image = images.read(path)
                 #Currently does not work for single color transparency
@@ -66,23 +201,18 @@ class PersonalizedBase(Dataset):
                 if use_weight and 'A' in image.getbands():
                     alpha_channel = image.getchannel('A')
                 image = image.convert('RGB')
-                if not varsize:
+                if buckets is not None:
+                    bucket = nearest_bucket(buckets, image.size)
+                    image = resize_to_bucket(image, bucket)
+                    # the weight map has to be cropped the same way to stay aligned with the image
+                    if alpha_channel is not None:
+                        alpha_channel = resize_to_bucket(alpha_channel, bucket)
+                elif not varsize:
                     image = image.resize((width, height), PIL.Image.BICUBIC)
             except Exception:
                 continue
 
-            text_filename = f"{os.path.splitext(path)[0]}.txt"
-            filename = os.path.basename(path)
-
-            if os.path.exists(text_filename):
-                with open(text_filename, "r", encoding="utf8") as file:
-                    filename_text = file.read()
-            else:
-                filename_text = os.path.splitext(filename)[0]
-                filename_text = re.sub(re_numbers_at_start, '', filename_text)
-                if re_word:
-                    tokens = re_word.findall(filename_text)
-                    filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
+            filename_text = self.read_filename_text(path, re_word)
 
             npimage = np.array(image).astype(np.uint8)
             npimage = (npimage / 127.5 - 1.0).astype(np.float32)
@@ -123,12 +253,13 @@ class PersonalizedBase(Dataset):
             else:
                 entry = DatasetEntry(filename=path, filename_text=filename_text, latent_sample=latent_sample, weight=weight)
 
-            if not (self.tag_drop_out != 0 or self.shuffle_tags):
-                entry.cond_text = self.create_text(filename_text)
+            if latent_filename is not None:
+                try:
+                    self.save_entry_latents(entry, latent_filename, image.size, latent_sampling_method)
+                except Exception as e:
+                    print(f"Failed to cache latents of {path}: {e}")
 
-            if include_cond and not (self.tag_drop_out != 0 or self.shuffle_tags):
-                with devices.autocast():
-                    entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
+            self.add_entry(entry, include_cond, cond_model)
             groups[image.size].append(len(self.dataset))
             self.dataset.append(entry)
             del torchdata
@@ -139,6 +270,8 @@ class PersonalizedBase(Dataset):
         self.length = len(self.dataset)
         self.groups = list(groups.values())
         assert self.length > 0, "No images have been found in the dataset."
+        if vae_id is not None:
+            print(f"Found latents of {cache_hits} out of {self.length} images in cache.")
         self.batch_size = min(batch_size, self.length)
         self.gradient_step = min(gradient_step, self.length // self.batch_size)
         self.latent_sampling_method = latent_sampling_method
@@ -146,9 +279,58 @@ class PersonalizedBase(Dataset):
         if len(groups) > 1:
             print("Buckets:")
             for (w, h), ids in sorted(groups.items(), key=lambda x: x[0]):
-                print(f"  {w}x{h}: {len(ids)}")
+                print(f"  {w}x{h} ({w / h:.2f}): {len(ids)} images, {len(ids) // self.batch_size} full batches")
             print()
 
+    def read_filename_text(self, path, re_word):
+        text_filename = f"{os.path.splitext(path)[0]}.txt"
+        filename = os.path.basename(path)
+
+        if os.path.exists(text_filename):
+            with open(text_filename, "r", encoding="utf8") as file:
+                return file.read()
+
+        filename_text = os.path.splitext(filename)[0]
+        filename_text = re.sub(re_numbers_at_start, '', filename_text)
+        if re_word:
+            tokens = re_word.findall(filename_text)
+            filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
+
+        return filename_text
+
+    def add_entry(self, entry, include_cond, cond_model):
+        if not (self.tag_drop_out != 0 or self.shuffle_tags):
+            entry.cond_text = self.create_text(entry.filename_text)
+
+        if include_cond and not (self.tag_drop_out != 0 or self.shuffle_tags):
+            with devices.autocast():
+                entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
+
+    def save_entry_latents(self, entry, latent_filename, size, latent_sampling_method):
+        """
+        Writes latents of the entry to latent_filename and drops them from memory; __getitem__ reads them back.
+        For random sampling, parameters of the distribution are saved if it is one, so that every read gives a new sample.
+        """
+
+        tensors = {}
+        if entry.latent_dist is None:
+            tensors["latent_sample"] = entry.latent_sample
+        elif isinstance(entry.latent_dist, DiagonalGaussianDistribution):
+            tensors["latent_parameters"] = entry.latent_dist.parameters.to(devices.cpu)
+        else:
+            tensors["latent_sample"] = entry.latent_dist.to(devices.cpu)
+
+        if entry.weight is not None:
+            tensors["weight"] = entry.weight
+
+        width, height = size
+        save_cached_latents(latent_filename, tensors, {"width": str(width), "height": str(height), "latent_sampling_method": latent_sampling_method})
+
+        entry.latent_filename = latent_filename
+        entry.latent_dist = None
+        entry.latent_sample = None
+        entry.weight = None
+
     def create_text(self, filename_text):
         text = random.choice(self.lines)
         tags = filename_text.split(',')
@@ -164,9 +346,18 @@ class PersonalizedBase(Dataset):
         return self.length
 
     def __getitem__(self, i):
-        entry = self.dataset[i]
+        entry = copy.copy(self.dataset[i])
         if self.tag_drop_out != 0 or self.shuffle_tags:
             entry.cond_text = self.create_text(entry.filename_text)
+        if entry.latent_filename is not None:
+            tensors, _ = read_cached_latents(entry.latent_filename)
+            entry.weight = tensors.get("weight")
+            if "latent_parameters" in tensors:
+                entry.latent_dist = DiagonalGaussianDistribution(tensors["latent_parameters"])
+            elif self.latent_sampling_method == "random":
+                entry.latent_dist = tensors["latent_sample"]
+            else:
+                entry.latent_sample = tensors["latent_sample"]
         if self.latent_sampling_method == "random":
             entry.latent_sample = shared.sd_model.get_first_stage_encoding(entry.latent_dist).to(devices.cpu)
         return entry
@@ -195,11 +386,22 @@ class GroupedBatchSampler(Sampler):
             shuffle(g)
 
         batches = []
+        leftovers = []
         for g in self.groups:
             batches.extend(g[i*b:(i+1)*b] for i in range(len(g) // b))
+            leftovers.append(g[len(g) // b * b:])
+
+        # extra batches take images that did not make it into a full batch of their group first, then other images of the group;
+        # an image is repeated within a batch only if the group is smaller than the batch
         for _ in range(self.n_rand_batches):
-            rand_group = choices(self.groups, self.probs)[0]
-            batches.append(choices(rand_group, k=b))
+            k = choices(range(len(self.groups)), self.probs)[0]
+            batch, leftovers[k] = leftovers[k][:b], leftovers[k][b:]
+
+            others = [i for i in self.groups[k] if i not in batch]
+            batch += sample(others, min(b - len(batch), len(others)))
+            batch += choices(self.groups[k], k=b - len(batch))
+
+            batches.append(batch)
 
         shuffle(batches)
 
@@ -207,13 +409,39 @@ class GroupedBatchSampler(Sampler):
 
 
 class PersonalizedDataLoader(DataLoader):
-    def __init__(self, dataset, latent_sampling_method="once", batch_size=1, pin_memory=False):
+    def __init__(self, dataset, latent_sampling_method="once", batch_size=1, pin_memory=False, prefetch=0):
         super(PersonalizedDataLoader, self).__init__(dataset, batch_sampler=GroupedBatchSampler(dataset, batch_size), pin_memory=pin_memory)
         if latent_sampling_method == "random":
             self.collate_fn = collate_wrapper_random
         else:
             self.collate_fn = collate_wrapper
 
+        self.prefetch = prefetch
+
+    def load_batch(self, indices):
+        batch = self.collate_fn([self.dataset[i] for i in indices])
+        if self.pin_memory:
+            batch = batch.pin_memory()
+
+        return batch
+
+    def __iter__(self):
+        """With prefetch > 0, up to that many next batches are loaded in background threads while the current one is used for training."""
+
+        if self.prefetch <= 0:
+            yield from super().__iter__()
+            return
+
+        with ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix="training-data") as executor:
+            pending = deque()
+            for indices in self.batch_sampler:
+                pending.append(executor.submit(self.load_batch, indices))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
 
 class BatchLoader:
     def __init__(self, data):
@@ -1,18 +1,20 @@
 import os
 from collections import namedtuple
 from contextlib import closing
+from functools import partial
 
 import torch
 import tqdm
 import html
 import datetime
+import time
 import csv
 import safetensors.torch
 
 import numpy as np
 from PIL import Image, PngImagePlugin
 
-from modules import shared, devices, sd_hijack, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes, cache
+from modules import shared, devices, sd_hijack, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes, cache, safetensors_header
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
@@ -38,6 +40,9 @@ def list_textual_inversion_templates():
 
 class Embedding:
     def __init__(self, vec, name, step=None):
+        self.vec_loader = None
+        """if set, a function that returns vectors for this embedding; it is called on first access to vec"""
+
         self.vec = vec
         self.name = name
         self.step = step
@@ -87,11 +92,24 @@ class Embedding:
         self.hash = v
         self.shorthash = self.hash[0:12]
 
+    @property
+    def vec(self):
+        if self.loaded_vec is None and self.vec_loader is not None:
+            self.loaded_vec = self.vec_loader()
+
+        return self.loaded_vec
+
+    @vec.setter
+    def vec(self, value):
+        self.loaded_vec = value
+
 
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
         self.path = path
         self.mtime = None
+        self.files = {}
+        """full path of every loaded file -> ((mtime, size), name of embedding loaded from it or None)"""
 
     def has_changed(self):
         if not os.path.isdir(self.path):
@@ -108,15 +126,77 @@ class DirWithTextualInversionEmbeddings:
         self.mtime = os.path.getmtime(self.path)
 
 
+class EmbeddingTrie:
+    """Prefix tree over token ids of embedding names. Finds the longest embedding name that starts at a position in a
+    prompt in a single pass over the prompt's tokens, instead of comparing the prompt with every name sharing the first token."""
+
+    def __init__(self):
+        self.root = {}
+        """maps a token id to the child node; key None holds the list of embeddings whose names end at this node"""
+
+    def clear(self):
+        self.root.clear()
+
+    def add(self, ids, embedding):
+        node = self.root
+        for token in ids:
+            node = node.setdefault(token, {})
+
+        node.setdefault(None, []).append(embedding)
+
+    def remove(self, ids, name):
+        path = []
+        node = self.root
+        for token in ids:
+            child = node.get(token)
+            if child is None:
+                return
+
+            path.append((node, token))
+            node = child
+
+        embeddings = [x for x in node.get(None, []) if x.name != name]
+        if embeddings:
+            node[None] = embeddings
+            return
+
+        node.pop(None, None)
+        for parent, token in reversed(path):
+            if parent[token]:
+                break
+
+            del parent[token]
+
+    def find(self, tokens, offset):
+        """returns the embedding with the longest name that starts at tokens[offset] and the length of its name in tokens, or (None, None)"""
+
+        found, found_length = None, None
+
+        node = self.root
+        for position in range(offset, len(tokens)):
+            node = node.get(tokens[position])
+            if node is None:
+                break
+
+            embeddings = node.get(None)
+            if embeddings:
+                found, found_length = embeddings[0], position - offset + 1
+
+        return found, found_length
+
+
 class EmbeddingDatabase:
     def __init__(self):
         self.ids_lookup = {}
+        self.ids_trie = EmbeddingTrie()
         self.word_embeddings = {}
         self.skipped_embeddings = {}
         self.expected_shape = -1
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
         self.image_embedding_cache = cache.cache('image-embedding')
+        self.version = 0
+        """incremented every time the set of known embeddings changes; used to invalidate cached tokenization results"""
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -128,6 +208,7 @@ class EmbeddingDatabase:
         return self.register_embedding_by_name(embedding, model, embedding.name)
 
     def register_embedding_by_name(self, embedding, model, name):
+        self.version += 1
         ids = model.cond_stage_model.tokenize([name])[0]
         first_id = ids[0]
         if first_id not in self.ids_lookup:
@@ -135,10 +216,12 @@ class EmbeddingDatabase:
         if name in self.word_embeddings:
             # remove old one from the lookup list
             lookup = [x for x in self.ids_lookup[first_id] if x[1].name!=name]
+            self.ids_trie.remove(ids, name)
         else:
             lookup = self.ids_lookup[first_id]
         if embedding is not None:
             lookup += [(ids, embedding)]
+            self.ids_trie.add(ids, embedding)
         self.ids_lookup[first_id] = sorted(lookup, key=lambda x: len(x[0]), reverse=True)
         if embedding is None:
             # unregister embedding with specified name
@@ -176,71 +259,171 @@ class EmbeddingDatabase:
             errors.report(f"Error loading embedding {path}", exc_info=True)
         return None, None
 
-    def load_from_file(self, path, filename):
+    def load_embedding_data(self, path, filename):
+        """loads an embedding file fully; returns its data and the name of the embedding, or (None, None) if the file is not an embedding"""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None, None
 
-            data, name = self.read_embedding_from_image(path, name)
-            if data is None:
-                return
+            return self.read_embedding_from_image(path, name)
         elif ext in ['.BIN', '.PT']:
-            data = torch.load(path, map_location="cpu")
+            return torch.load(path, map_location="cpu"), name
         elif ext in ['.SAFETENSORS']:
-            data = safetensors.torch.load_file(path, device="cpu")
-        else:
-            return
+            return safetensors.torch.load_file(path, device="cpu"), name
+
+        return None, None
+
+    def load_embedding_vec(self, path, filename):
+        data, _ = self.load_embedding_data(path, filename)
+        if data is None:
+            raise Exception(f"Couldn't load textual inversion embedding from {path}")
+
+        vec, _, _ = embedding_vec_from_data(data, filename)
+        return vec
+
+    def read_embedding_header(self, path, filename):
+        """
+        Returns a dict with name, shape, number of vectors and training info of the embedding in the file, or None if the file is
+        not an embedding. For .safetensors files, only the header of the file is read. Results are cached until the file changes.
+        """
+
+        name, ext = os.path.splitext(filename)
+        ext = ext.upper()
+
+        if ext not in ['.PNG', '.WEBP', '.JXL', '.AVIF', '.BIN', '.PT', '.SAFETENSORS']:
+            return None
+
+        def read_header():
+            if ext == '.SAFETENSORS':
+                header = safetensors_header.read_header(path)
+                shapes = {k: shape for k, (_, shape) in header.tensors.items()}
+                shape, vectors = embedding_shape_from_shapes(shapes, filename)
 
-        if data is not None:
-            embedding = create_embedding_from_data(data, name, filename=filename, filepath=path)
+                return {"name": name, "shape": shape, "vectors": vectors}
 
-            if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-                self.register_embedding(embedding, shared.sd_model)
-            else:
-                self.skipped_embeddings[name] = embedding
+            data, data_name = self.load_embedding_data(path, filename)
+            if data is None:
+                return None
+
+            _, shape, vectors = embedding_vec_from_data(data, filename, device="cpu")
+
+            return {
+                "name": data_name,
+                "shape": shape,
+                "vectors": vectors,
+                "step": data.get('step', None),
+                "sd_checkpoint": data.get('sd_checkpoint', None),
+                "sd_checkpoint_name": data.get('sd_checkpoint_name', None),
+            }
+
+        return cache.cached_data_for_file('textual-inversion-header', path, path, read_header)
+
+    def load_from_file(self, path, filename):
+        """
+        Registers the embedding from the file using only its header; vectors are read from the file when the embedding is first used.
+        Returns the name of the embedding, or None if the file is not an embedding.
+        """
+
+        header = self.read_embedding_header(path, filename)
+        if header is None:
+            return None
+
+        name = header["name"]
+
+        embedding = Embedding(None, name, step=header.get("step"))
+        embedding.vec_loader = partial(self.load_embedding_vec, path, filename)
+        embedding.sd_checkpoint = header.get("sd_checkpoint")
+        embedding.sd_checkpoint_name = header.get("sd_checkpoint_name")
+        embedding.vectors = header["vectors"]
+        embedding.shape = header["shape"]
+        embedding.filename = path
+        embedding.set_hash(hashes.sha256(path, "textual_inversion/" + name) or '')
+
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.register_embedding(embedding, shared.sd_model)
         else:
-            print(f"Unable to load Textual inversion embedding due to data issue: '{name}'.")
+            self.skipped_embeddings[name] = embedding
+
+        return name
+
+    def unregister_embedding(self, name):
+        self.skipped_embeddings.pop(name, None)
 
+        if name in self.word_embeddings:
+            self.register_embedding_by_name(None, shared.sd_model, name)
+
+    def load_from_dir(self, embdir, incremental=False):
+        """
+        Loads all embeddings from the directory. If incremental is True, only files that were added or changed since the
+        previous call are loaded, and embeddings from removed files are unregistered.
+        """
 
-    def load_from_dir(self, embdir):
         if not os.path.isdir(embdir.path):
             return
 
+        previous_files = embdir.files if incremental else {}
+        files = {}
+
         for root, _, fns in os.walk(embdir.path, followlinks=True):
             for fn in fns:
                 try:
                     fullfn = os.path.join(root, fn)
 
-                    if os.stat(fullfn).st_size == 0:
+                    stat = os.stat(fullfn)
+                    if stat.st_size == 0:
                         continue
 
-                    self.load_from_file(fullfn, fn)
+                    signature = (stat.st_mtime, stat.st_size)
+                    previous = previous_files.pop(fullfn, None)
+                    if previous is not None:
+                        previous_signature, previous_name = previous
+                        if previous_signature == signature:
+                            files[fullfn] = previous
+                            continue
+
+                        if previous_name is not None:
+                            self.unregister_embedding(previous_name)
+
+                    files[fullfn] = (signature, self.load_from_file(fullfn, fn))
                 except Exception:
                     errors.report(f"Error loading embedding {fn}", exc_info=True)
                     continue
 
+        for _, name in previous_files.values():
+            if name is not None:
+                self.unregister_embedding(name)
+
+        embdir.files = files
+
     def load_textual_inversion_embeddings(self, force_reload=False):
-        if not force_reload:
-            need_reload = False
-            for embdir in self.embedding_dirs.values():
-                if embdir.has_changed():
-                    need_reload = True
-                    break
+        embedding_dirs = list(self.embedding_dirs.values())
 
-            if not need_reload:
+        if not force_reload and self.expected_shape != -1:
+            embedding_dirs = [embdir for embdir in embedding_dirs if embdir.has_changed()]
+
+            if not embedding_dirs:
                 return
 
-        self.ids_lookup.clear()
-        self.word_embeddings.clear()
-        self.skipped_embeddings.clear()
-        self.expected_shape = self.get_expected_shape()
+            incremental = True
+        else:
+            incremental = False
 
-        for embdir in self.embedding_dirs.values():
-            self.load_from_dir(embdir)
+        self.version += 1
+
+        if not incremental:
+            self.ids_lookup.clear()
+            self.ids_trie.clear()
+            self.word_embeddings.clear()
+            self.skipped_embeddings.clear()
+            self.expected_shape = self.get_expected_shape()
+
+        for embdir in embedding_dirs:
+            self.load_from_dir(embdir, incremental=incremental)
             embdir.update()
 
         # re-sort word_embeddings because load_from_dir may not load in alphabetic order.
@@ -257,17 +440,7 @@ class EmbeddingDatabase:
                 print(f"Textual inversion embeddings skipped({len(self.skipped_embeddings)}): {', '.join(self.skipped_embeddings.keys())}")
 
     def find_embedding_at_position(self, tokens, offset):
-        token = tokens[offset]
-        possible_matches = self.ids_lookup.get(token, None)
-
-        if possible_matches is None:
-            return None, None
-
-        for ids, embedding in possible_matches:
-            if tokens[offset:offset + len(ids)] == ids:
-                return embedding, len(ids)
-
-        return None, None
+        return self.ids_trie.find(tokens, offset)
 
 
 def create_embedding(name, num_vectors_per_token, overwrite_old, init_text='*'):
@@ -298,17 +471,21 @@ def create_embedding(name, num_vectors_per_token, overwrite_old, init_text='*'):
     return fn
 
 
-def create_embedding_from_data(data, name, filename='unknown embedding file', filepath=None):
+def embedding_vec_from_data(data, filename='unknown embedding file', device=None):
+    """extracts vectors from data loaded from an embedding file; returns vectors, their dimensionality and number of vectors"""
+
+    device = device or devices.device
+
     if 'string_to_param' in data:  # textual inversion embeddings
         param_dict = data['string_to_param']
         param_dict = getattr(param_dict, '_parameters', param_dict)  # fix for torch 1.12.1 loading saved file from torch 1.11
         assert len(param_dict) == 1, 'embedding file has multiple terms in it'
         emb = next(iter(param_dict.items()))[1]
-        vec = emb.detach().to(devices.device, dtype=torch.float32)
+        vec = emb.detach().to(device, dtype=torch.float32)
         shape = vec.shape[-1]
         vectors = vec.shape[0]
     elif type(data) == dict and 'clip_g' in data and 'clip_l' in data:  # SDXL embedding
-        vec = {k: v.detach().to(devices.device, dtype=torch.float32) for k, v in data.items()}
+        vec = {k: v.detach().to(device, dtype=torch.float32) for k, v in data.items()}
         shape = data['clip_g'].shape[-1] + data['clip_l'].shape[-1]
         vectors = data['clip_g'].shape[0]
     elif type(data) == dict and type(next(iter(data.values()))) == torch.Tensor:  # diffuser concepts
@@ -317,12 +494,32 @@ def create_embedding_from_data(data, name, filename='unknown embedding file', fi
         emb = next(iter(data.values()))
         if len(emb.shape) == 1:
             emb = emb.unsqueeze(0)
-        vec = emb.detach().to(devices.device, dtype=torch.float32)
+        vec = emb.detach().to(device, dtype=torch.float32)
         shape = vec.shape[-1]
         vectors = vec.shape[0]
     else:
         raise Exception(f"Couldn't identify {filename} as neither textual inversion embedding nor diffuser concept.")
 
+    return vec, shape, vectors
+
+
+def embedding_shape_from_shapes(shapes, filename='unknown embedding file'):
+    """same as embedding_vec_from_data, but uses only tensor names and shapes from a .safetensors header; returns dimensionality and number of vectors"""
+
+    if 'clip_g' in shapes and 'clip_l' in shapes:  # SDXL embedding
+        return shapes['clip_g'][-1] + shapes['clip_l'][-1], shapes['clip_g'][0]
+    elif len(shapes) == 1:  # diffuser concepts
+        shape = next(iter(shapes.values()))
+        return shape[-1], shape[0] if len(shape) > 1 else 1
+    elif len(shapes) > 1:
+        raise AssertionError('embedding file has multiple terms in it')
+
+    raise Exception(f"Couldn't identify {filename} as neither textual inversion embedding nor diffuser concept.")
+
+
+def create_embedding_from_data(data, name, filename='unknown embedding file', filepath=None):
+    vec, shape, vectors = embedding_vec_from_data(data, filename)
+
     embedding = Embedding(vec, name)
     embedding.step = data.get('step', None)
     embedding.sd_checkpoint = data.get('sd_checkpoint', None)
@@ -483,7 +680,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
 
     latent_sampling_method = ds.latent_sampling_method
 
-    dl = modules.textual_inversion.dataset.PersonalizedDataLoader(ds, latent_sampling_method=latent_sampling_method, batch_size=ds.batch_size, pin_memory=pin_memory)
+    dl = modules.textual_inversion.dataset.PersonalizedDataLoader(ds, latent_sampling_method=latent_sampling_method, batch_size=ds.batch_size, pin_memory=pin_memory, prefetch=shared.opts.training_dataloader_prefetch)
 
     if unload:
         shared.parallel_processing_allowed = False
@@ -523,6 +720,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
     img_c = None
 
     pbar = tqdm.tqdm(total=steps - initial_step)
+    step_start = time.perf_counter()
     try:
         sd_hijack_checkpoint.add()
 
@@ -588,7 +786,10 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
                 epoch_num = embedding.step // steps_per_epoch
                 epoch_step = embedding.step % steps_per_epoch
 
-                description = f"Training textual inversion [Epoch {epoch_num}: {epoch_step+1}/{steps_per_epoch}] loss: {loss_step:.7f}"
+                # time since the previous step finished, not counting saving and previews
+                images_per_second = batch_size * gradient_step / (time.perf_counter() - step_start)
+
+                description = f"Training textual inversion [Epoch {epoch_num}: {epoch_step+1}/{steps_per_epoch}] loss: {loss_step:.7f}, {images_per_second:.2f} images/s"
                 pbar.set_description(description)
                 if embedding_dir is not None and steps_done % save_embedding_every == 0:
                     # Before saving, change name to match current checkpoint.
@@ -683,11 +884,13 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
 <p>
 Loss: {loss_step:.7f}<br/>
 Step: {steps_done}<br/>
+Speed: {images_per_second:.2f} images/s<br/>
 Last prompt: {html.escape(batch.cond_text[0])}<br/>
 Last saved embedding: {html.escape(last_saved_file)}<br/>
 Last saved image: {html.escape(last_saved_image)}<br/>
 </p>
 """
+                step_start = time.perf_counter()
         filename = os.path.join(shared.cmd_opts.embeddings_dir, f'{embedding_name}.pt')
         save_embedding(embedding, optimizer, checkpoint, embedding_name, filename, remove_cached_checksum=True)
     except Exception:
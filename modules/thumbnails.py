@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from modules import shared, errors
+from modules.cache import cache_dir
+from modules.images import LANCZOS
+
+thumbnails_dir = os.path.join(cache_dir, "thumbnails")
+thumbnail_extensions = {"png", "jpg", "jpeg", "webp", "avif"}
+"""extensions of images that are resized into thumbnails; others (GIFs, which may be animated) are served as they are"""
+
+max_thumbnails = 10000
+"""when there are more thumbnails than this on disk, the oldest ones are removed"""
+
+max_prefetch_pending = 64
+"""prefetch does not queue more thumbnails when this many are already waiting to be created"""
+
+prune_every = 100
+
+wait_timeout = 0.25
+"""how long, in seconds, a request waits for its thumbnail to be created before the original image is served instead"""
+
+executor = None
+pending = {}
+pending_lock = threading.Lock()
+created_count = 0
+
+
+def file_key(filename, size, mtime=None, file_size=None):
+    """Content address of a thumbnail for a file; changes whenever the file's path, mtime or size, or the thumbnail size change."""
+
+    if mtime is None or file_size is None:
+        stat = os.stat(filename)
+        mtime, file_size = stat.st_mtime, stat.st_size
+
+    return hashlib.sha256(f"{os.path.abspath(filename)}:{mtime}:{file_size}:{size}".encode("utf8")).hexdigest()
+
+
+def data_key(data, size):
+    """Content address of a thumbnail for an image stored in memory."""
+
+    return hashlib.sha256(data + f":{size}".encode("utf8")).hexdigest()
+
+
+def thumbnail_path(key):
+    return os.path.join(thumbnails_dir, key[:2], f"{key}.webp")
+
+
+def create_thumbnail(source, size, path):
+    global created_count
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), LANCZOS)
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    image.save(tmp_path, format="WEBP", quality=85, method=4)
+    os.replace(tmp_path, path)
+
+    with pending_lock:
+        created_count += 1
+        should_prune = created_count % prune_every == 0
+
+    if should_prune:
+        prune()
+
+
+def prune():
+    """Removes the oldest thumbnails if there are more than max_thumbnails of them."""
+
+    try:
+        files = []
+        for subdir in os.scandir(thumbnails_dir):
+            if subdir.is_dir():
+                files.extend((entry.stat().st_mtime, entry.path) for entry in os.scandir(subdir.path) if entry.name.endswith(".webp"))
+
+        if len(files) <= max_thumbnails:
+            return
+
+        files.sort()
+        for _, path in files[:len(files) - max_thumbnails]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    except Exception as e:
+        errors.display(e, "removing old thumbnails")
+
+
+def submit(key, source, size):
+    """Starts creating the thumbnail with given key in background unless it's already being created; returns the future for the job."""
+
+    global executor
+
+    with pending_lock:
+        future = pending.get(key)
+        if future is not None:
+            return future
+
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnails")
+
+        future = executor.submit(create_thumbnail, source, size, thumbnail_path(key))
+        pending[key] = future
+
+    future.add_done_callback(lambda _: pending.pop(key, None))
+    return future
+
+
+def prefetch(filename, size, mtime=None, file_size=None):
+    """
+    Queues creation of a thumbnail for filename if it's not in cache yet, so that it's ready by the time the browser asks for it.
+    Does nothing if max_prefetch_pending thumbnails are already queued.
+    """
+
+    if size <= 0 or os.path.splitext(filename)[1].lower()[1:] not in thumbnail_extensions:
+        return
+
+    if len(pending) >= max_prefetch_pending:
+        return
+
+    try:
+        key = file_key(filename, size, mtime, file_size)
+        if not os.path.isfile(thumbnail_path(key)):
+            submit(key, filename, size)
+    except Exception as e:
+        errors.display(e, f"queueing thumbnail for {filename}")
+
+
+def wait(future):
+    """Whether the job finished within wait_timeout; exceptions from the job are raised."""
+
+    try:
+        future.result(timeout=wait_timeout)
+        return True
+    except TimeoutError:
+        return False
+
+
+def get_for_file(filename, size):
+    """
+    Returns (path, key) for the thumbnail of an image file; the key works as a strong ETag. If the thumbnail is not
+    in cache and is not created within wait_timeout, returns None: it keeps being created in background, and the
+    caller should serve the original file this time, so that a page with many new images does not occupy all server
+    threads waiting for thumbnails.
+    """
+
+    key = file_key(filename, size)
+    path = thumbnail_path(key)
+    if not os.path.isfile(path) and not wait(submit(key, filename, size)):
+        return None
+
+    return path, key
+
+
+def get_for_data(data, size):
+    """Same as get_for_file, for an image stored in memory as bytes."""
+
+    key = data_key(data, size)
+    path = thumbnail_path(key)
+    if not os.path.isfile(path) and not wait(submit(key, BytesIO(data), size)):
+        return None
+
+    return path, key
+
+
+def thumbnail_size():
+    return int(shared.opts.extra_networks_thumbnail_size or 0)
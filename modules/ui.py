@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import mimetypes
 import os
 import sys
@@ -112,7 +113,7 @@ def resize_from_to_html(width, height, scale_by):
     return f"resize: from <span class='resolution'>{width}x{height}</span> to <span class='resolution'>{target_width}x{target_height}</span>"
 
 
-def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_dir, *ii_singles):
+def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_dir, *ii_singles, batch_interrogation_function=None):
     if mode in {0, 1, 3, 4}:
         return [interrogation_function(ii_singles[mode]), None]
     elif mode == 2:
@@ -126,11 +127,24 @@ def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_di
         else:
             ii_output_dir = ii_input_dir
 
-        for image in images:
-            img = Image.open(image)
-            filename = os.path.basename(image)
-            left, _ = os.path.splitext(filename)
-            print(interrogation_function(img), file=open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8'))
+        shared.state.begin(job="interrogate")
+        try:
+            # images are opened as the batch function asks for them, and every caption is written as soon as it's ready
+            imgs = (Image.open(image) for image in images)
+            prompts = batch_interrogation_function(imgs) if batch_interrogation_function else (interrogation_function(img) for img in imgs)
+
+            for image, prompt in zip(images, prompts):
+                if prompt is None:  # not processed because the job was interrupted
+                    break
+
+                filename = os.path.basename(image)
+                left, _ = os.path.splitext(filename)
+                print(prompt, file=open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8'))
+
+                if shared.state.interrupted:
+                    break
+        finally:
+            shared.state.end()
 
         return [gr.update(), None]
 
@@ -140,11 +154,24 @@ def interrogate(image):
     return gr.update() if prompt is None else prompt
 
 
+def interrogate_batch(images):
+    batch_size = max(int(shared.opts.interrogate_batch_size), 1)
+    while batch := [image.convert("RGB") for image in itertools.islice(images, batch_size)]:
+        if shared.state.interrupted:
+            return
+
+        yield from shared.interrogator.interrogate_batch(batch)
+
+
 def interrogate_deepbooru(image):
     prompt = deepbooru.model.tag(image)
     return gr.update() if prompt is None else prompt
 
 
+def interrogate_deepbooru_batch(images):
+    return deepbooru.model.tag_batch(images)
+
+
 def connect_clear_prompt(button):
     """Given clear button, prompt, and token_counter objects, setup clear prompt button click event"""
     button.click(
@@ -829,12 +856,12 @@ def create_ui():
             )
 
             toprow.button_interrogate.click(
-                fn=lambda *args: process_interrogate(interrogate, *args),
+                fn=lambda *args: process_interrogate(interrogate, *args, batch_interrogation_function=interrogate_batch),
                 **interrogate_args,
             )
 
             toprow.button_deepbooru.click(
-                fn=lambda *args: process_interrogate(interrogate_deepbooru, *args),
+                fn=lambda *args: process_interrogate(interrogate_deepbooru, *args, batch_interrogation_function=interrogate_deepbooru_batch),
                 **interrogate_args,
             )
 
@@ -1,5 +1,7 @@
 import functools
+import logging
 import os.path
+import time
 import urllib.parse
 from base64 import b64decode
 from io import BytesIO
@@ -7,19 +9,23 @@ from pathlib import Path
 from typing import Optional, Union
 from dataclasses import dataclass
 
-from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util
+from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util, cache, thumbnails
 from modules.images import read_info_from_image, save_image_with_geninfo
 import gradio as gr
 import json
 import html
 from fastapi.exceptions import HTTPException
 from PIL import Image
+from starlette.requests import Request
 
 from modules.infotext_utils import image_from_url_text
 
 extra_pages = []
 allowed_dirs = set()
 default_allowed_preview_extensions = ["png", "jpg", "jpeg", "webp", "gif"]
+card_order_field_sort_keys = {'Path': 'default', 'Name': 'name', 'Date Created': 'date_created', 'Date Modified': 'date_modified'}
+
+logger = logging.getLogger(__name__)
 
 @functools.cache
 def allowed_preview_extensions_with_extra(extra_extensions=None):
@@ -36,6 +42,67 @@ class ExtraNetworksItem:
     item: dict
 
 
+class ExtraNetworksIndex:
+    """Persistent index of data read from files next to extra networks items: descriptions and user metadata.
+
+    Entries are stored in the "extra-networks-index" cache subsection, keyed by the item's path without extension.
+    An entry is valid for as long as names, mtimes and sizes of all files next to the item stay the same; those
+    are taken from the page's MassFileLister, which stats each directory once, so refreshing a page only reads
+    files for items that changed since the last refresh.
+    """
+
+    def __init__(self, lister: util.MassFileLister):
+        self.lister = lister
+        self.entries = {}
+        self.changed = set()
+
+    def reset(self):
+        self.entries.clear()
+        self.changed.clear()
+
+    def sidecar_files(self, path):
+        previews = sum([[f"{path}.{ext}", f"{path}.preview.{ext}"] for ext in allowed_preview_extensions()], [])
+        return [*previews, f"{path}.txt", f"{path}.description.txt", f"{path}.json"]
+
+    def signature(self, path):
+        stats = (self.lister.find(file) for file in self.sidecar_files(path))
+        return [tuple(x) for x in stats if x is not None]
+
+    def get(self, path, field, func):
+        """Returns value of field for the item at path (without extension), calling func to compute it if the files next to the item changed."""
+
+        if not shared.opts.extra_networks_persistent_index:
+            return func()
+
+        signature = self.signature(path)
+        entry = self.entries.get(path)
+        if entry is None or entry['signature'] != signature:
+            entry = cache.cache("extra-networks-index").get(path)
+            if entry is None or entry.get('signature') != signature:
+                entry = {'signature': signature, 'values': {}}
+            self.entries[path] = entry
+
+        values = entry['values']
+        if field not in values:
+            values[field] = func()
+            self.changed.add(path)
+
+        return values[field]
+
+    def save(self):
+        """Writes entries that were updated since the last save to disk."""
+
+        if not self.changed:
+            return
+
+        index_cache = cache.cache("extra-networks-index")
+        with index_cache.transact():
+            for path in self.changed:
+                index_cache[path] = self.entries[path]
+
+        self.changed.clear()
+
+
 def get_tree(paths: Union[str, list[str]], items: dict[str, ExtraNetworksItem]) -> dict:
     """Recursively builds a directory tree.
 
@@ -94,9 +161,19 @@ def register_page(page):
     allowed_dirs.update(set(sum([x.allowed_directories_for_previews() for x in extra_pages], [])))
 
 
-def fetch_file(filename: str = ""):
-    from starlette.responses import FileResponse
+def file_response(request: Request, filename: str, etag: str, max_age: int = 86400):
+    """Serves a file with a strong ETag, answering with 304 if the browser already has it."""
+    from starlette.responses import FileResponse, Response
+
+    etag = f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={max_age}"}
+    if request is not None and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(filename, headers={"Accept-Ranges": "bytes", **headers})
 
+
+def fetch_file(request: Request, filename: str = ""):
     if not os.path.isfile(filename):
         raise HTTPException(status_code=404, detail="File not found")
 
@@ -107,11 +184,27 @@ def fetch_file(filename: str = ""):
     if ext not in allowed_preview_extensions():
         raise ValueError(f"File cannot be fetched: {filename}. Extensions allowed: {allowed_preview_extensions()}.")
 
-    # would profit from returning 304
-    return FileResponse(filename, headers={"Accept-Ranges": "bytes"})
+    # if the thumbnail is still being created, the original is served without letting the browser keep it for long,
+    # so that the thumbnail is picked up next time
+    max_age = 86400
+
+    thumbnail_size = thumbnails.thumbnail_size()
+    if thumbnail_size > 0 and ext in thumbnails.thumbnail_extensions:
+        try:
+            thumbnail = thumbnails.get_for_file(filename, thumbnail_size)
+            if thumbnail is not None:
+                thumbnail_filename, key = thumbnail
+                return file_response(request, thumbnail_filename, key)
 
+            max_age = 0
+        except Exception as e:
+            errors.display(e, f"creating thumbnail for {filename}")
 
-def fetch_cover_images(page: str = "", item: str = "", index: int = 0):
+    stat = os.stat(filename)
+    return file_response(request, filename, f"{stat.st_mtime_ns:x}-{stat.st_size:x}", max_age=max_age)
+
+
+def fetch_cover_images(request: Request, page: str = "", item: str = "", index: int = 0):
     from starlette.responses import Response
 
     page = next(iter([x for x in extra_pages if x.name == page]), None)
@@ -127,6 +220,16 @@ def fetch_cover_images(page: str = "", item: str = "", index: int = 0):
     if not image:
         raise HTTPException(status_code=404, detail="File not found")
 
+    thumbnail_size = thumbnails.thumbnail_size()
+    if thumbnail_size > 0:
+        try:
+            thumbnail = thumbnails.get_for_data(b64decode(image), thumbnail_size)
+            if thumbnail is not None:
+                thumbnail_filename, key = thumbnail
+                return file_response(request, thumbnail_filename, key)
+        except Exception as e:
+            errors.display(e, f"creating thumbnail for cover image of {item}")
+
     try:
         image = Image.open(BytesIO(b64decode(image)))
         buffer = BytesIO()
@@ -170,11 +273,36 @@ def get_single_card(page: str = "", tabname: str = "", name: str = ""):
     return JSONResponse({"html": item_html})
 
 
+def get_cards(page: str = "", tabname: str = "", search: str = "", sort: str = "default", sort_dir: str = "Ascending", offset: int = 0, limit: int = 0):
+    """Returns HTML for a window of cards of a page, filtered and sorted on server; used when cards are paginated."""
+    from starlette.responses import JSONResponse
+
+    page = next(iter([x for x in extra_pages if x.name == page]), None)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    t = time.perf_counter()
+
+    items = page.filter_and_sort_items(search, sort, sort_dir)
+    limit = limit or int(shared.opts.extra_networks_cards_page_size) or len(items)
+    offset = max(0, offset)
+    window = items[offset:offset + limit]
+    for item in window:
+        page.prefetch_thumbnail(item.get("preview"))
+
+    cards_html = "".join(page.create_item_html(tabname, item, page.card_tpl) for item in window)
+
+    logger.debug(f"extra networks cards for {page.name}: {min(limit, max(0, len(items) - offset))} of {len(items)} from {offset}, {len(cards_html)} bytes in {time.perf_counter() - t:.3f}s")
+
+    return JSONResponse({"html": cards_html, "total": len(items), "offset": offset})
+
+
 def add_pages_to_demo(app):
     app.add_api_route("/sd_extra_networks/thumb", fetch_file, methods=["GET"])
     app.add_api_route("/sd_extra_networks/cover-images", fetch_cover_images, methods=["GET"])
     app.add_api_route("/sd_extra_networks/metadata", get_metadata, methods=["GET"])
     app.add_api_route("/sd_extra_networks/get-single-card", get_single_card, methods=["GET"])
+    app.add_api_route("/sd_extra_networks/cards", get_cards, methods=["GET"])
 
 
 def quote_js(s: str):
@@ -191,7 +319,9 @@ class ExtraNetworksPage:
         self.allow_negative_prompt = False
         self.metadata = {}
         self.items = {}
+        self.items_search_text = {}
         self.lister = util.MassFileLister()
+        self.index = ExtraNetworksIndex(self.lister)
         # HTML Templates
         self.pane_tpl = shared.html("extra-networks-pane.html")
         self.pane_content_tree_tpl = shared.html("extra-networks-pane-tree.html")
@@ -207,7 +337,11 @@ class ExtraNetworksPage:
 
     def read_user_metadata(self, item, use_cache=True):
         filename = item.get("filename", None)
-        metadata = extra_networks.get_user_metadata(filename, lister=self.lister if use_cache else None)
+        if use_cache and filename is not None:
+            path, _ = os.path.splitext(filename)
+            metadata = dict(self.index.get(path, "user_metadata", lambda: extra_networks.get_user_metadata(filename, lister=self.lister)))
+        else:
+            metadata = extra_networks.get_user_metadata(filename, lister=self.lister if use_cache else None)
 
         desc = metadata.get("description", None)
         if desc is not None:
@@ -217,9 +351,22 @@ class ExtraNetworksPage:
 
     def link_preview(self, filename):
         quoted_filename = urllib.parse.quote(filename.replace('\\', '/'))
-        mtime, _ = self.lister.mctime(filename)
+        stats = self.lister.find(filename)
+        mtime = stats[1] if stats else 0
+
         return f"./sd_extra_networks/thumb?filename={quoted_filename}&mtime={mtime}"
 
+    def prefetch_thumbnail(self, preview):
+        """Queues creation of the thumbnail for a preview URL made by link_preview, so that it's ready when the browser asks for it."""
+
+        if not preview or not preview.startswith("./sd_extra_networks/thumb?"):
+            return
+
+        filename = urllib.parse.parse_qs(urllib.parse.urlparse(preview).query).get("filename", [None])[0]
+        stats = self.lister.find(filename) if filename else None
+        if stats:
+            thumbnails.prefetch(filename, thumbnails.thumbnail_size(), stats[1], stats[3])
+
     def search_terms_from_path(self, filename, possible_directories=None):
         abspath = os.path.abspath(filename)
         for parentdir in (possible_directories if possible_directories is not None else self.allowed_directories_for_previews()):
@@ -284,21 +431,7 @@ class ExtraNetworksPage:
             }
         )
 
-        local_path = ""
-        filename = item.get("filename", "")
-        for reldir in self.allowed_directories_for_previews():
-            absdir = os.path.abspath(reldir)
-
-            if filename.startswith(absdir):
-                local_path = filename[len(absdir):]
-
-        # if this is true, the item must not be shown in the default view, and must instead only be
-        # shown when searching for it
-        if shared.opts.extra_networks_hidden_models == "Always":
-            search_only = False
-        else:
-            search_only = "/." in local_path or "\\." in local_path
-
+        search_only = self.is_search_only(item)
         if search_only and shared.opts.extra_networks_hidden_models == "Never":
             return ""
 
@@ -348,6 +481,57 @@ class ExtraNetworksPage:
         else:
             return args
 
+    def is_search_only(self, item: dict) -> bool:
+        """Returns True if the item must not be shown in the default view, and must instead only be shown when searching for it."""
+
+        if shared.opts.extra_networks_hidden_models == "Always":
+            return False
+
+        local_path = ""
+        filename = item.get("filename", "")
+        for reldir in self.allowed_directories_for_previews():
+            absdir = os.path.abspath(reldir)
+
+            if filename.startswith(absdir):
+                local_path = filename[len(absdir):]
+
+        return "/." in local_path or "\\." in local_path
+
+    def search_text(self, item: dict) -> str:
+        """Lowercase text that the search string is matched against; same as what the browser searches in when cards are not paginated."""
+
+        text = self.items_search_text.get(item["name"])
+        if text is None:
+            description = item.get("description", "") or "" if shared.opts.extra_networks_card_show_desc else ""
+            text = " ".join([*item.get("search_terms", []), description]).lower()
+            self.items_search_text[item["name"]] = text
+
+        return text
+
+    def filter_and_sort_items(self, search: str = "", sort: str = "default", sort_dir: str = "Ascending") -> list[dict]:
+        """Returns items of the page matching the search string, in the requested order."""
+
+        search = search.lower()
+        res = []
+        for item in self.items.values():
+            search_only = self.is_search_only(item)
+            if search_only and (len(search) < 4 or shared.opts.extra_networks_hidden_models == "Never"):
+                continue
+
+            if search and search not in self.search_text(item):
+                continue
+
+            res.append(item)
+
+        def sort_key(item):
+            value = item.get("sort_keys", {}).get(sort)
+            if isinstance(value, (int, float)):
+                return 0, value, ""
+
+            return 1, 0, str(value)
+
+        return sorted(res, key=sort_key, reverse=sort_dir == "Descending")
+
     def create_tree_dir_item_html(
         self,
         tabname: str,
@@ -490,7 +674,9 @@ class ExtraNetworksPage:
 
             for k, v in sorted(data.items(), key=lambda x: shared.natural_sort_key(x[0])):
                 if isinstance(v, (ExtraNetworksItem,)):
-                    _file_li.append(self.create_tree_file_item_html(tabname, k, v.item))
+                    # with paginated cards, only directories are listed in the tree
+                    if not shared.opts.extra_networks_cards_page_size:
+                        _file_li.append(self.create_tree_file_item_html(tabname, k, v.item))
                 else:
                     _dir_li.append(self.create_tree_dir_item_html(tabname, k, _build_tree(v)))
 
@@ -560,8 +746,13 @@ class ExtraNetworksPage:
         Returns:
             HTML formatted string.
         """
+        items = self.items.values()
+        if shared.opts.extra_networks_cards_page_size:
+            sort = card_order_field_sort_keys.get(shared.opts.extra_networks_card_order_field, 'default')
+            items = self.filter_and_sort_items(sort=sort, sort_dir=shared.opts.extra_networks_card_order)[:int(shared.opts.extra_networks_cards_page_size)]
+
         res = []
-        for item in self.items.values():
+        for item in items:
             res.append(self.create_item_html(tabname, item, self.card_tpl))
 
         if not res:
@@ -582,8 +773,12 @@ class ExtraNetworksPage:
         Returns:
             HTML formatted string.
         """
+        t = time.perf_counter()
+
         self.lister.reset()
+        self.index.reset()
         self.metadata = {}
+        self.items_search_text = {}
 
         items_list = [] if empty else self.list_items()
         self.items = {x["name"]: x for x in items_list}
@@ -597,6 +792,8 @@ class ExtraNetworksPage:
             if "user_metadata" not in item:
                 self.read_user_metadata(item)
 
+        self.index.save()
+
         show_tree = shared.opts.extra_networks_tree_view_default_enabled
 
         page_params = {
@@ -611,6 +808,9 @@ class ExtraNetworksPage:
             "items_html": self.create_card_view_html(tabname, none_message="Loading..." if empty else None),
             "extra_networks_tree_view_default_width": shared.opts.extra_networks_tree_view_default_width,
             "tree_view_div_default_display_class": "" if show_tree else "extra-network-dirs-hidden",
+            "extra_networks_page": html.escape(self.name),
+            "cards_page_size": int(shared.opts.extra_networks_cards_page_size),
+            "cards_total": len(self.filter_and_sort_items()) if shared.opts.extra_networks_cards_page_size else len(self.items),
         }
 
         if shared.opts.extra_networks_tree_view_style == "Tree":
@@ -618,7 +818,11 @@ class ExtraNetworksPage:
         else:
             pane_content = self.pane_content_dirs_tpl.format(**page_params, dirs_html=self.create_dirs_view_html(tabname))
 
-        return self.pane_tpl.format(**page_params, pane_content=pane_content)
+        res = self.pane_tpl.format(**page_params, pane_content=pane_content)
+
+        logger.debug(f"extra networks page {self.name}: {len(self.items)} items, {len(res)} bytes in {time.perf_counter() - t:.3f}s")
+
+        return res
 
     def create_item(self, name, index=None):
         raise NotImplementedError()
@@ -670,6 +874,9 @@ class ExtraNetworksPage:
         """
         Find and read a description file for a given path (without extension).
         """
+        return self.index.get(path, "description", lambda: self.read_description(path))
+
+    def read_description(self, path):
         for file in [f"{path}.txt", f"{path}.description.txt"]:
             if not self.lister.exists(file):
                 continue
@@ -23,6 +23,8 @@ class ExtraNetworksPageCheckpoints(ui_extra_networks.ExtraNetworksPage):
         search_terms = [self.search_terms_from_path(checkpoint.filename)]
         if checkpoint.sha256:
             search_terms.append(checkpoint.sha256)
+        if checkpoint.architecture:
+            search_terms.append(checkpoint.architecture)
         return {
             "name": checkpoint.name_for_extra,
             "filename": checkpoint.filename,
@@ -34,6 +36,7 @@ class ExtraNetworksPageCheckpoints(ui_extra_networks.ExtraNetworksPage):
             "local_preview": f"{path}.{shared.opts.samples_format}",
             "metadata": checkpoint.metadata,
             "sort_keys": {'default': index, **self.get_sort_keys(checkpoint.filename)},
+            "architecture": checkpoint.architecture,
         }
 
     def list_items(self):
@@ -6,7 +6,7 @@ import torch
 import tqdm
 from PIL import Image
 
-from modules import devices, images, shared, torch_utils
+from modules import devices, shared, torch_utils
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +27,9 @@ def torch_bgr_to_pil_image(tensor: torch.Tensor) -> Image.Image:
             raise ValueError(f"{tensor.shape} does not describe a BCHW tensor")
         tensor = tensor.squeeze(0)
     assert tensor.ndim == 3, f"{tensor.shape} does not describe a CHW tensor"
+    if tensor.dtype == torch.uint8:
+        arr = np.moveaxis(tensor.cpu().numpy(), 0, 2)[:, :, ::-1]  # CHW to HWC, flip BGR to RGB
+        return Image.fromarray(np.ascontiguousarray(arr), "RGB")
     # TODO: is `tensor.float().cpu()...numpy()` the most efficient idiom?
     arr = tensor.float().cpu().clamp_(0, 1).numpy()  # clamp
     arr = 255.0 * np.moveaxis(arr, 0, 2)  # CHW to HWC, rescale
@@ -62,30 +65,179 @@ def upscale_with_model(
         logger.debug("=> %s", output)
         return output
 
-    grid = images.split_grid(img, tile_size, tile_size, tile_overlap)
-    newtiles = []
-
-    with tqdm.tqdm(total=grid.tile_count, desc=desc, disable=not shared.opts.enable_upscale_progressbar) as p:
-        for y, h, row in grid.tiles:
-            newrow = []
-            for x, w, tile in row:
-                if shared.state.interrupted:
-                    return img
-                output = upscale_pil_patch(model, tile)
-                scale_factor = output.width // tile.width
-                newrow.append([x * scale_factor, w * scale_factor, output])
-                p.update(1)
-            newtiles.append([y * scale_factor, h * scale_factor, newrow])
-
-    newgrid = images.Grid(
-        newtiles,
-        tile_w=grid.tile_w * scale_factor,
-        tile_h=grid.tile_h * scale_factor,
-        image_w=grid.image_w * scale_factor,
-        image_h=grid.image_h * scale_factor,
-        overlap=grid.overlap * scale_factor,
+    param = torch_utils.get_param(model)
+    tensor = pil_image_to_torch_bgr(img).to(dtype=param.dtype).unsqueeze(0)  # add batch dimension
+
+    output = tiled_upscale_batched(
+        tensor,
+        model,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
+        device=param.device,
+        dtype=param.dtype,
+        desc=desc,
     )
-    return images.combine_grid(newgrid)
+    if output is None:
+        return img
+
+    return torch_bgr_to_pil_image(output)
+
+
+def tile_positions(size: int, tile_size: int, tile_overlap: int) -> list[int]:
+    stride = max(tile_size - tile_overlap, 1)
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def feather_weights(length: int, feather: int, *, start: bool, end: bool) -> torch.Tensor:
+    """
+    1D blending weights for one side of a tile: linearly rising over `feather` pixels at the start and
+    falling at the end; sides that touch the border of the image are not feathered.
+    """
+    weights = torch.ones(length)
+    feather = min(feather, length // 2)
+    if feather > 0:
+        ramp = torch.arange(1, feather + 1, dtype=torch.float32) / (feather + 1)
+        if start:
+            weights[:feather] = ramp
+        if end:
+            weights[length - feather:] = ramp.flip(0)
+    return weights
+
+
+def to_uint8(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.clamp_(0, 1).mul_(255).round_().to(torch.uint8)
+
+
+def measure_tile_memory(device: torch.device, func: Callable[[], torch.Tensor]) -> tuple[torch.Tensor, int]:
+    """
+    Runs func and returns its result and the peak amount of device memory it used (0 if unknown).
+    """
+    if device.type != "cuda":
+        return func(), 0
+
+    torch.cuda.reset_peak_memory_stats(device)
+    before = torch.cuda.memory_allocated(device)
+    result = func()
+    return result, max(torch.cuda.max_memory_allocated(device) - before, 0)
+
+
+def tile_batch_size(device: torch.device, bytes_per_tile: int) -> int:
+    """
+    How many tiles to run through the model at once: as many as fit into free memory
+    (if it can be measured), but no more than the limit from settings.
+    """
+    max_batch_size = max(int(shared.opts.upscaler_tile_batch_size or 1), 1)
+    if device.type != "cuda" or bytes_per_tile <= 0:
+        return max_batch_size
+
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    return max(1, min(max_batch_size, int(free_memory * 0.8) // bytes_per_tile))
+
+
+def is_out_of_memory(e: Exception) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e)
+
+
+def tiled_upscale_batched(
+    img: torch.Tensor,
+    model: Callable[[torch.Tensor], torch.Tensor],
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    device: torch.device,
+    dtype: torch.dtype | None = None,
+    desc="Tiled upscale",
+) -> torch.Tensor | None:
+    """
+    Upscales a BCHW tensor tile by tile, running tiles through the model in batches sized by free
+    device memory, and blending overlapping tiles with feathered weights.
+
+    The model's scale factor is detected from its output. Returns a uint8 CPU tensor,
+    or None if the job was interrupted or skipped.
+
+    Only one band of output rows as tall as a tile is accumulated in float32; tiles are processed
+    row by row, so rows above the current tile row are final and get written out as uint8.
+    """
+    b, c, h, w = img.size()
+    tile_size = min(tile_size, h, w)
+    dtype = dtype or img.dtype
+
+    positions = [(y, x) for y in tile_positions(h, tile_size, tile_overlap) for x in tile_positions(w, tile_size, tile_overlap)]
+    logger.debug("Upscaling %s with %d tiles of %d px", img.shape, len(positions), tile_size)
+
+    def flush(rows):
+        nonlocal band_start
+
+        result[..., band_start:band_start + rows, :] = to_uint8(band[..., :rows, :] / band_weights[..., :rows, :])
+        band[..., :-rows, :] = band[..., rows:, :].clone()
+        band_weights[..., :-rows, :] = band_weights[..., rows:, :].clone()
+        band[..., -rows:, :] = 0
+        band_weights[..., -rows:, :] = 0
+        band_start += rows
+
+    def run(batch_positions):
+        tiles = torch.cat([img[..., y:y + tile_size, x:x + tile_size] for y, x in batch_positions])
+        with torch.inference_mode(), devices.without_autocast():
+            return model(tiles.to(device=device, dtype=dtype)).float().cpu()
+
+    result = None
+    band = None
+    band_weights = None
+    band_start = 0
+    scale = None
+    batch_size = 1
+    index = 0
+
+    with tqdm.tqdm(total=len(positions), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
+        while index < len(positions):
+            if shared.state.interrupted or shared.state.skipped:
+                return None
+
+            batch_positions = positions[index:index + batch_size]
+            try:
+                if result is None:
+                    out, bytes_per_tile = measure_tile_memory(device, lambda: run(batch_positions))
+                    next_batch_size = tile_batch_size(device, bytes_per_tile)
+                else:
+                    out = run(batch_positions)
+                    next_batch_size = batch_size
+            except Exception as e:
+                if batch_size == 1 or not is_out_of_memory(e):
+                    raise
+
+                batch_size = max(batch_size // 2, 1)
+                logger.debug("Out of memory when upscaling a batch of tiles, retrying with %d tiles", batch_size)
+                devices.torch_gc()
+                continue
+
+            if result is None:
+                scale = out.shape[-1] // tile_size
+                result = torch.empty(b, out.shape[1], h * scale, w * scale, dtype=torch.uint8)
+                band = torch.zeros(b, out.shape[1], tile_size * scale, w * scale)
+                band_weights = torch.zeros(1, 1, tile_size * scale, w * scale)
+
+            out_tile_size = tile_size * scale
+            feather = tile_overlap * scale
+            for i, (y, x) in enumerate(batch_positions):
+                if y * scale > band_start:
+                    # no tile left to process reaches above this row
+                    flush(y * scale - band_start)
+
+                weight = torch.outer(
+                    feather_weights(out_tile_size, feather, start=y > 0, end=y + tile_size < h),
+                    feather_weights(out_tile_size, feather, start=x > 0, end=x + tile_size < w),
+                )
+
+                xs = slice(x * scale, x * scale + out_tile_size)
+                band[..., xs].add_(out[i * b:(i + 1) * b] * weight)
+                band_weights[..., xs].add_(weight)
+
+            index += len(batch_positions)
+            batch_size = next_batch_size
+            pbar.update(len(batch_positions))
+
+    flush(h * scale - band_start)
+    return result
 
 
 def tiled_upscale_2(
@@ -97,67 +249,32 @@ def tiled_upscale_2(
     scale: int,
     device: torch.device,
     desc="Tiled upscale",
-):
-    # Alternative implementation of `upscale_with_model` originally used by
-    # SwinIR and ScuNET.  It differs from `upscale_with_model` in that tiling and
-    # weighting is done in PyTorch space, as opposed to `images.Grid` doing it in
-    # Pillow space without weighting.
+) -> torch.Tensor:
+    """
+    Alternative implementation of `upscale_with_model` originally used by SwinIR and ScuNET, working on tensors
+    rather than PIL images.
+
+    Whichever way the image is upscaled, returns a uint8 CPU tensor with values in 0..255, like
+    `tiled_upscale_batched`. If the job was interrupted or skipped, that is the input image, not upscaled.
+    """
 
     b, c, h, w = img.size()
     tile_size = min(tile_size, h, w)
 
     if tile_size <= 0:
         logger.debug("Upscaling %s without tiling", img.shape)
-        return model(img)
-
-    stride = tile_size - tile_overlap
-    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
-    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
-    result = torch.zeros(
-        b,
-        c,
-        h * scale,
-        w * scale,
+        return to_uint8(model(img).float().cpu())
+
+    output = tiled_upscale_batched(
+        img,
+        model,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
         device=device,
-        dtype=img.dtype,
+        desc=desc,
     )
-    weights = torch.zeros_like(result)
-    logger.debug("Upscaling %s to %s with tiles", img.shape, result.shape)
-    with tqdm.tqdm(total=len(h_idx_list) * len(w_idx_list), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
-        for h_idx in h_idx_list:
-            if shared.state.interrupted or shared.state.skipped:
-                break
-
-            for w_idx in w_idx_list:
-                if shared.state.interrupted or shared.state.skipped:
-                    break
-
-                # Only move this patch to the device if it's not already there.
-                in_patch = img[
-                    ...,
-                    h_idx : h_idx + tile_size,
-                    w_idx : w_idx + tile_size,
-                ].to(device=device)
-
-                out_patch = model(in_patch)
-
-                result[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch)
-
-                out_patch_mask = torch.ones_like(out_patch)
-
-                weights[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch_mask)
-
-                pbar.update(1)
-
-    output = result.div_(weights)
+    if output is None:
+        return to_uint8(img.to(device="cpu", dtype=torch.float32, copy=True))
 
     return output
 
@@ -77,7 +77,7 @@ class MassFileListerCachedDir:
         self.dirname = dirname
 
         stats = ((x.name, x.stat(follow_symlinks=False)) for x in os.scandir(self.dirname))
-        files = [(n, s.st_mtime, s.st_ctime) for n, s in stats]
+        files = [(n, s.st_mtime, s.st_ctime, s.st_size) for n, s in stats]
         self.files = {x[0].lower(): x for x in files}
         self.files_cased = {x[0]: x for x in files}
 
@@ -86,7 +86,7 @@ class MassFileListerCachedDir:
         file_path = os.path.join(self.dirname, filename)
         try:
             stat = os.stat(file_path)
-            entry = (filename, stat.st_mtime, stat.st_ctime)
+            entry = (filename, stat.st_mtime, stat.st_ctime, stat.st_size)
             self.files[filename.lower()] = entry
             self.files_cased[filename] = entry
         except FileNotFoundError as e:
@@ -104,7 +104,7 @@ class MassFileLister:
         Find the metadata for a file at the given path.
 
         Returns:
-            tuple or None: A tuple of (name, mtime, ctime) if the file exists, or None if it does not.
+            tuple or None: A tuple of (name, mtime, ctime, size) if the file exists, or None if it does not.
         """
 
         dirname, filename = os.path.split(path)
@@ -124,7 +124,7 @@ class MassFileLister:
 
         try:
             os_stats = os.stat(path, follow_symlinks=False)
-            return filename, os_stats.st_mtime, os_stats.st_ctime
+            return filename, os_stats.st_mtime, os_stats.st_ctime, os_stats.st_size
         except Exception:
             return None
 
@@ -4,15 +4,17 @@ from itertools import permutations, chain
 import random
 import csv
 import os.path
+import shutil
+import tempfile
 from io import StringIO
-from PIL import Image
+from PIL import Image, ImageColor
 import numpy as np
 import gc
 
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors, script_callbacks
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, state
 import modules.shared as shared
@@ -286,9 +288,114 @@ axis_options = [
 ]
 
 
+class IncrementalSubGrids:
+    """
+    Z sub-grids of an X/Y/Z plot, composed while the plot is being made: every cell is pasted into the canvas of its
+    sub-grid as soon as it's ready, so cells do not have to be kept in memory until the last one is done. Axis labels are
+    drawn once into an empty template canvas, which is copied for every sub-grid.
+
+    Cells are also written into a temporary directory. They are read back from there only when a cell larger than all
+    previous ones comes in: like images.image_grid, the grid uses the size of the largest cell for all of them, so
+    canvases have to be made anew.
+
+    Like images.image_grid, the layout is passed to script_callbacks.image_grid_callback, which can change the number of
+    columns and rows; cells are placed in the grid in the same order as image_grid would place them. As cells are not
+    known yet when the layout is chosen, the callback gets None in place of images. Axis labels are not drawn if the
+    layout is changed.
+    """
+
+    preview_max_size = 1024
+
+    def __init__(self, x_labels, y_labels, count, draw_legend, margin_size):
+        self.x_labels = x_labels
+        self.y_labels = y_labels
+        self.draw_legend = draw_legend
+        self.margin_size = margin_size
+
+        self.cell_size = None
+        self.cell_mode = None
+        self.template = None
+        self.cell_position = None
+        self.layout = None
+        self.canvases = [None] * count
+        self.cells = {}
+        if opts.temp_dir:
+            os.makedirs(opts.temp_dir, exist_ok=True)
+
+        self.directory = tempfile.mkdtemp(prefix="xyz_grid_", dir=opts.temp_dir or None)
+
+    def make_template(self):
+        if self.layout is None:
+            params = script_callbacks.ImageGridLoopParams([None] * (len(self.x_labels) * len(self.y_labels)), len(self.x_labels), len(self.y_labels))
+            script_callbacks.image_grid_callback(params)
+            self.layout = (params.cols, params.rows)
+
+        cols, rows = self.layout
+        w, h = self.cell_size
+
+        # axis labels only fit the layout of the plot
+        if self.draw_legend and self.layout == (len(self.x_labels), len(self.y_labels)):
+            hor_texts = [[images.GridAnnotation(x)] for x in self.x_labels]
+            ver_texts = [[images.GridAnnotation(y)] for y in self.y_labels]
+            self.template, self.cell_position = images.grid_annotations_canvas(cols, rows, w, h, hor_texts, ver_texts, self.margin_size)
+        else:
+            grid_background_color = ImageColor.getcolor(opts.grid_background_color, 'RGBA')
+            self.template = Image.new('RGBA', size=(cols * w, rows * h), color=grid_background_color)
+            self.cell_position = lambda col, row: (col * w, row * h)
+
+    def canvas(self, iz):
+        if self.canvases[iz] is None:
+            self.canvases[iz] = self.template.copy()
+
+        return self.canvases[iz]
+
+    def paste(self, image, ix, iy, iz):
+        w, h = self.cell_size
+        index = ix + iy * len(self.x_labels)
+        x, y = self.cell_position(index % self.layout[0], index // self.layout[0])
+        self.canvas(iz).paste(image, box=(x + (w - image.width) // 2, y + (h - image.height) // 2))
+
+    def add(self, image, ix, iy, iz):
+        filename = os.path.join(self.directory, f"{ix}-{iy}-{iz}.png")
+        image.save(filename, compress_level=1)
+        self.cells[(ix, iy, iz)] = filename
+
+        if self.cell_size is not None and image.width <= self.cell_size[0] and image.height <= self.cell_size[1]:
+            self.paste(image, ix, iy, iz)
+            return
+
+        if self.cell_size is None:
+            self.cell_size = image.size
+            self.cell_mode = image.mode
+            self.make_template()
+            self.paste(image, ix, iy, iz)
+            return
+
+        self.cell_size = (max(self.cell_size[0], image.width), max(self.cell_size[1], image.height))
+        self.make_template()
+        self.canvases = [None] * len(self.canvases)
+        for (cx, cy, cz), cell_filename in self.cells.items():
+            with Image.open(cell_filename) as cell_image:
+                self.paste(cell_image, cx, cy, cz)
+
+    def preview(self, iz):
+        """A copy of the sub-grid as it is now, scaled down to at most preview_max_size pixels on the longer side."""
+
+        canvas = self.canvas(iz)
+        scale = self.preview_max_size / max(canvas.size)
+        if scale >= 1:
+            return canvas.copy()
+
+        return canvas.resize((max(1, round(canvas.width * scale)), max(1, round(canvas.height * scale))), Image.BILINEAR)
+
+    def grids(self):
+        return [self.canvas(iz) for iz in range(len(self.canvases))]
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
 def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, draw_individual_labels, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size):
-    hor_texts = [[images.GridAnnotation(x)] for x in x_labels]
-    ver_texts = [[images.GridAnnotation(y)] for y in y_labels]
     title_texts = [[images.GridAnnotation(z)] for z in z_labels]
 
     list_size = (len(xs) * len(ys) * len(zs))
@@ -297,6 +404,8 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
 
     state.job_count = list_size * p.n_iter
 
+    sub_grids = IncrementalSubGrids(x_labels, y_labels, len(zs), draw_legend, margin_size)
+
     @staticmethod
     def draw_label_on_image(image, text):
         from PIL import ImageDraw, ImageFont
@@ -370,19 +479,59 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
                 label = f"X: {x_labels[ix]}\nY: {y_labels[iy]}\nZ: {z_labels[iz]}"
                 draw_label_on_image(process_image, label)
 
-            processed_result.images[idx] = process_image
             processed_result.all_prompts[idx] = processed.prompt
             processed_result.all_seeds[idx] = processed.seed
             processed_result.infotexts[idx] = processed.infotexts[0]
         else:
             cell_mode = "P"
             cell_size = (processed_result.width, processed_result.height)
-            if processed_result.images[0] is not None:
-                cell_mode = processed_result.images[0].mode
+            if sub_grids.cell_size is not None:
+                cell_mode = sub_grids.cell_mode
                 # This corrects size in case of batches:
-                cell_size = processed_result.images[0].size
-            processed_result.images[idx] = Image.new(cell_mode, cell_size)
+                cell_size = sub_grids.cell_size
+            process_image = Image.new(cell_mode, cell_size)
 
+        sub_grids.add(process_image, ix, iy, iz)
+
+        # cells that are not returned only live in the sub-grid canvas and the temporary directory
+        if include_lone_images:
+            processed_result.images[idx] = process_image
+
+        if opts.live_previews_enable:
+            state.assign_current_image(sub_grids.preview(iz))
+
+    try:
+        process_cells(xs, ys, zs, process_cell, first_axes_processed, second_axes_processed)
+
+        if not processed_result:
+            print("Unexpected error: Processing could not begin, you may need to refresh the tab or restart the service.")
+            return Processed(p, [])
+        elif not sub_grids.cells:
+            print("Unexpected error: draw_xyz_grid failed to return even a single processed image")
+            return Processed(p, [])
+
+        z_count = len(zs)
+
+        for i, grid in enumerate(sub_grids.grids()):
+            start_index = (i * len(xs) * len(ys)) + i
+            processed_result.images.insert(i, grid)
+            processed_result.all_prompts.insert(i, processed_result.all_prompts[start_index])
+            processed_result.all_seeds.insert(i, processed_result.all_seeds[start_index])
+            processed_result.infotexts.insert(i, processed_result.infotexts[start_index])
+    finally:
+        sub_grids.close()
+
+    z_grid = images.image_grid(processed_result.images[:z_count], rows=1)
+    z_sub_grid_max_w, z_sub_grid_max_h = map(max, zip(*(img.size for img in processed_result.images[:z_count])))
+    if draw_legend:
+        z_grid = images.draw_grid_annotations(z_grid, z_sub_grid_max_w, z_sub_grid_max_h, title_texts, [[images.GridAnnotation()]])
+    processed_result.images.insert(0, z_grid)
+    processed_result.infotexts.insert(0, processed_result.infotexts[0])
+
+    return processed_result
+
+
+def process_cells(xs, ys, zs, process_cell, first_axes_processed, second_axes_processed):
     if first_axes_processed == 'x':
         for ix, x in enumerate(xs):
             if second_axes_processed == 'y':
@@ -414,36 +563,6 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
                     for ix, x in enumerate(xs):
                         process_cell(x, y, z, ix, iy, iz)
 
-    if not processed_result:
-        print("Unexpected error: Processing could not begin, you may need to refresh the tab or restart the service.")
-        return Processed(p, [])
-    elif not any(processed_result.images):
-        print("Unexpected error: draw_xyz_grid failed to return even a single processed image")
-        return Processed(p, [])
-
-    z_count = len(zs)
-
-    for i in range(z_count):
-        start_index = (i * len(xs) * len(ys)) + i
-        end_index = start_index + len(xs) * len(ys)
-        grid = images.image_grid(processed_result.images[start_index:end_index], rows=len(ys))
-        if draw_legend:
-            grid_max_w, grid_max_h = map(max, zip(*(img.size for img in processed_result.images[start_index:end_index])))
-            grid = images.draw_grid_annotations(grid, grid_max_w, grid_max_h, hor_texts, ver_texts, margin_size)
-        processed_result.images.insert(i, grid)
-        processed_result.all_prompts.insert(i, processed_result.all_prompts[start_index])
-        processed_result.all_seeds.insert(i, processed_result.all_seeds[start_index])
-        processed_result.infotexts.insert(i, processed_result.infotexts[start_index])
-
-    z_grid = images.image_grid(processed_result.images[:z_count], rows=1)
-    z_sub_grid_max_w, z_sub_grid_max_h = map(max, zip(*(img.size for img in processed_result.images[:z_count])))
-    if draw_legend:
-        z_grid = images.draw_grid_annotations(z_grid, z_sub_grid_max_w, z_sub_grid_max_h, title_texts, [[images.GridAnnotation()]])
-    processed_result.images.insert(0, z_grid)
-    processed_result.infotexts.insert(0, processed_result.infotexts[0])
-
-    return processed_result
-
 
 class SharedSettingsStackHelper(object):
     def __enter__(self):
@@ -0,0 +1,74 @@
+"""
+Compares encoding long prompts chunk by chunk with encoding all chunks in one batch (opts.batch_cond_chunks).
+Uses a small randomly initialized CLIP text model, so it runs on CPU without any checkpoints:
+
+    python -m test.benchmarks.bench_cond_chunks [--repeats 20] [--batch-size 2]
+"""
+
+import argparse
+import random
+
+from test.benchmarks.common import measure
+
+import torch
+import transformers
+
+from modules import devices, sd_hijack_clip
+
+
+class BenchmarkTextModel(sd_hijack_clip.TextConditionalModel):
+    def __init__(self, hidden_size=768, layers=12):
+        super().__init__()
+
+        config = transformers.CLIPTextConfig(hidden_size=hidden_size, intermediate_size=hidden_size * 4, num_hidden_layers=layers, num_attention_heads=hidden_size // 64)
+        self.transformer = transformers.CLIPTextModel(config).to(devices.device).eval()
+
+        self.id_start = config.bos_token_id
+        self.id_end = config.eos_token_id
+        self.id_pad = self.id_end
+
+    def encode_with_transformers(self, tokens):
+        self.hijack.fixes = None
+        return self.transformer(input_ids=tokens).last_hidden_state
+
+
+def make_chunks(model, chunk_count, batch_size):
+    tokens, multipliers = [], []
+    for _ in range(chunk_count):
+        tokens.append([[model.id_start] + [random.randrange(1, model.id_end) for _ in range(model.chunk_length)] + [model.id_end] for _ in range(batch_size)])
+        multipliers.append([[1.0] + [random.choice([1.0, 1.1, 0.9]) for _ in range(model.chunk_length)] + [1.0] for _ in range(batch_size)])
+
+    return tokens, multipliers
+
+
+def run_sequential(model, tokens, multipliers):
+    return [model.process_tokens(t, m) for t, m in zip(tokens, multipliers)]
+
+
+def run_batched(model, tokens, multipliers):
+    return model.process_token_chunks(tokens, multipliers)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--max-chunks", type=int, default=8)
+    args = parser.parse_args()
+
+    model = BenchmarkTextModel()
+
+    print(f"{'chunks':>6} {'sequential, ms':>15} {'batched, ms':>12} {'max diff':>10}")
+    with torch.no_grad():
+        for chunk_count in range(1, args.max_chunks + 1):
+            tokens, multipliers = make_chunks(model, chunk_count, args.batch_size)
+
+            diff = max((a - b).abs().max().item() for a, b in zip(run_sequential(model, tokens, multipliers), run_batched(model, tokens, multipliers)))
+            _, sequential = measure(lambda: run_sequential(model, tokens, multipliers), args.repeats, warmup=True)
+            _, batched = measure(lambda: run_batched(model, tokens, multipliers), args.repeats, warmup=True)
+
+            print(f"{chunk_count:>6} {sequential:>15.2f} {batched:>12.2f} {diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compares finding textual inversion embeddings in prompts with the token id trie against the previous approach:
+a dict lookup by the first token followed by a scan over all embeddings sharing that token.
+
+    python -m test.benchmarks.bench_embedding_lookup [--embeddings 3000] [--repeats 20]
+"""
+
+import argparse
+import random
+from types import SimpleNamespace
+
+from test.benchmarks.common import measure
+
+from modules.textual_inversion.textual_inversion import EmbeddingTrie
+
+
+def build_lookup(names):
+    ids_lookup = {}
+    for ids, embedding in names:
+        ids_lookup.setdefault(ids[0], []).append((ids, embedding))
+
+    for first_id, lookup in ids_lookup.items():
+        ids_lookup[first_id] = sorted(lookup, key=lambda x: len(x[0]), reverse=True)
+
+    return ids_lookup
+
+
+def find_with_lookup(ids_lookup, tokens, offset):
+    possible_matches = ids_lookup.get(tokens[offset], None)
+    if possible_matches is None:
+        return None, None
+
+    for ids, embedding in possible_matches:
+        if tokens[offset:offset + len(ids)] == ids:
+            return embedding, len(ids)
+
+    return None, None
+
+
+def scan(find, prompts):
+    found = []
+    for tokens in prompts:
+        position = 0
+        while position < len(tokens):
+            embedding, length = find(tokens, position)
+            if embedding is None:
+                position += 1
+            else:
+                found.append(embedding.name)
+                position += length
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", type=int, default=3000)
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    # few distinct first tokens, like names of embeddings that start with same word - "easynegative", "easyphoto", ...
+    first_tokens = list(range(100, 120))
+    names = []
+    for i in range(args.embeddings):
+        ids = [random.choice(first_tokens)] + [random.randrange(1000, 1100) for _ in range(random.randrange(0, 6))]
+        names.append((ids, SimpleNamespace(name=f"embedding-{i}")))
+
+    ids_lookup = build_lookup(names)
+    trie = EmbeddingTrie()
+    for ids, embedding in names:
+        trie.add(ids, embedding)
+
+    prompts = []
+    for _ in range(args.prompts):
+        tokens = []
+        while len(tokens) < 225:
+            tokens += random.choice(names)[0] if random.random() < 0.1 else [random.choice(first_tokens + list(range(1000, 1100)))]
+        prompts.append(tokens)
+
+    assert scan(lambda t, o: find_with_lookup(ids_lookup, t, o), prompts) == scan(trie.find, prompts)
+
+    _, lookup_time = measure(lambda: scan(lambda t, o: find_with_lookup(ids_lookup, t, o), prompts), args.repeats)
+    _, trie_time = measure(lambda: scan(trie.find, prompts), args.repeats)
+
+    print(f"{args.embeddings} embeddings, {args.prompts} prompts: first token lookup and scan {lookup_time:.2f} ms, trie {trie_time:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
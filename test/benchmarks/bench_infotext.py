@@ -0,0 +1,81 @@
+"""
+Measures composing and parsing of infotext for a corpus of generated infotexts, similar to what
+a large batch or an API client pasting infotexts does:
+
+    python -m test.benchmarks.bench_infotext [--count 10000]
+"""
+
+import argparse
+import random
+
+from test.benchmarks.common import measure
+
+from modules import infotext_utils
+
+words = ["masterpiece", "best quality", "1girl", "(detailed eyes:1.2)", "[red|blue] hair", "outdoors", "cherry blossoms", "<lora:add_detail:0.5>", "lowres", "bad hands"]
+samplers = ["Euler a", "DPM++ 2M", "DPM++ SDE", "DDIM", "UniPC"]
+
+
+def make_params(rng):
+    params = {
+        "Steps": rng.randrange(10, 60),
+        "Sampler": rng.choice(samplers),
+        "Schedule type": rng.choice(["Automatic", "Karras", "Exponential"]),
+        "CFG scale": rng.choice([4, 5.5, 7, 9]),
+        "Seed": rng.randrange(2 ** 32),
+        "Size": f"{rng.choice([512, 768, 832, 1024])}x{rng.choice([512, 768, 1216, 1024])}",
+        "Model hash": f"{rng.randrange(16 ** 10):010x}",
+        "Model": "sd_xl_base_1.0",
+        "Clip skip": rng.choice([None, 2]),
+        "Lora hashes": f"add_detail: {rng.randrange(16 ** 12):012x}",
+        "Version": "f0.0.17v1.8.0rc",
+    }
+
+    if rng.random() < 0.3:
+        params["Denoising strength"] = 0.45
+        params["Hires upscale"] = 2
+        params["Hires upscaler"] = "Latent"
+        params["Hires prompt"] = ", ".join(rng.sample(words, 4))
+
+    return params
+
+
+def make_infotext(rng):
+    prompt = ", ".join(rng.sample(words, 6))
+    negative_prompt = ", ".join(rng.sample(words, 2))
+    generation_params_text = infotext_utils.compose_generation_parameters(make_params(rng))
+
+    return f"{prompt}\nNegative prompt: {negative_prompt}\n{generation_params_text}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    corpus_params = [make_params(rng) for _ in range(args.count)]
+    corpus = [make_infotext(rng) for _ in range(args.count)]
+
+    def compose():
+        for params in corpus_params:
+            infotext_utils.compose_generation_parameters(params)
+
+    def split(texts):
+        for text in texts:
+            infotext_utils.split_generation_parameters(text)
+
+    def parse():
+        for text in corpus:
+            infotext_utils.parse_generation_parameters(text, skip_fields=[])
+
+    _, compose_time = measure(compose, 1)
+    _, split_time = measure(lambda: split(corpus), 1, before=infotext_utils.split_generation_parameters.cache_clear)
+    _, split_cached_time = measure(lambda: split(corpus[:1000]), 1)
+    _, parse_time = measure(parse, 1)
+
+    print(f"{args.count} infotexts: compose {compose_time:.1f} ms, split {split_time:.1f} ms, split of 1000 recently seen {split_cached_time:.1f} ms, full parse {parse_time:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measures prompt parsing with empty and with warm caches, the way an X/Y/Z plot or a batch with many prompts does it:
+
+    python -m test.benchmarks.bench_prompt_parser [--repeats 20]
+"""
+
+import argparse
+
+from test.benchmarks.common import measure
+
+from modules import prompt_parser
+
+prompts = [
+    "a photo of a cat",
+    "fantasy landscape with a [mountain:lake:0.25] and [an oak:a christmas tree:0.75][ in foreground::0.6][: in background:0.25] [shoddy:masterful:0.5]",
+    "masterpiece, best quality, (1girl:1.2), [red|blue|green] hair, ((detailed eyes)), [smiling:crying:10], outdoors, (cherry blossoms:0.8)",
+    "a [dog:cat:[0.2:0.5:3]] sitting on a (((chair))), [[dark]] room, BREAK (realistic:1.3), [[[film grain]]]",
+]
+
+
+def run(step_counts, hires_steps):
+    for steps in step_counts:
+        prompt_parser.get_learned_conditioning_prompt_schedules(prompts, steps, hires_steps)
+        for prompt in prompts:
+            prompt_parser.parse_prompt_attention(prompt)
+
+
+def clear_caches():
+    prompt_parser.parse_schedule.cache_clear()
+    prompt_parser.get_schedule.cache_clear()
+    prompt_parser.parse_prompt_attention_cached.cache_clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    step_counts = list(range(10, 60, 5))
+
+    for hires_steps in [None, 20]:
+        _, cold = measure(lambda: run(step_counts, hires_steps), args.repeats, before=clear_caches)
+        _, warm = measure(lambda: run(step_counts, hires_steps), args.repeats)
+
+        print(f"hires steps: {hires_steps}; {len(prompts)} prompts x {len(step_counts)} step counts; empty cache: {cold:.2f} ms, warm cache: {warm:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
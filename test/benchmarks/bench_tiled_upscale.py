@@ -0,0 +1,48 @@
+"""
+Compares upscaling an image tile by tile against running batches of tiles through the model at once,
+using a small randomly initialized RealESRGAN Compact network so that it runs on CPU in reasonable time.
+
+    python -m test.benchmarks.bench_tiled_upscale [--size 512] [--tile 128] [--batch 8] [--repeats 3]
+"""
+
+import argparse
+
+from test.benchmarks.common import measure
+
+import torch
+from spandrel import ModelLoader
+from spandrel.architectures.Compact import Compact
+
+from modules import shared, upscaler_utils
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--tile", type=int, default=128)
+    parser.add_argument("--overlap", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    network = Compact(num_feat=16, num_conv=4, upscale=4)
+    model = ModelLoader().load_from_state_dict(network.state_dict())
+    model.eval()
+
+    img = torch.rand(1, 3, args.size, args.size)
+    shared.opts.enable_upscale_progressbar = False
+
+    def upscale(batch_size):
+        shared.opts.upscaler_tile_batch_size = batch_size
+        return upscaler_utils.tiled_upscale_batched(img, model, tile_size=args.tile, tile_overlap=args.overlap, device=torch.device("cpu"))
+
+    single, single_time = measure(lambda: upscale(1), args.repeats)
+    batched, batched_time = measure(lambda: upscale(args.batch), args.repeats)
+
+    difference = (single.int() - batched.int()).abs().max().item()
+    print(f"{args.size}px image, {args.tile}px tiles: one tile at a time {single_time:.0f} ms, batches of {args.batch} {batched_time:.0f} ms, max difference {difference}/255")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Shared setup for the benchmarks. Importing this module initializes webui modules the same way the tests do
+(without parsing the benchmark's own command line arguments), so it should be imported before anything from modules:
+
+    from test.benchmarks.common import measure
+    from modules import ...
+"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+
+from modules import shared_init  # noqa: E402
+
+shared_init.initialize()
+
+
+def synchronize():
+    """Waits for queued GPU work, if any, so that it is included in the measured time."""
+
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+def measure(func, repeats, *, before=None, warmup=False):
+    """
+    Calls func repeats times and returns the result of the last call and the average time of one call in milliseconds.
+    before is called ahead of every call, outside of the measured time; with warmup, func is called once more before
+    measuring.
+    """
+
+    if warmup:
+        func()
+        synchronize()
+
+    result = None
+    total = 0
+    for _ in range(repeats):
+        if before is not None:
+            before()
+
+        start = time.perf_counter()
+        result = func()
+        synchronize()
+        total += time.perf_counter() - start
+
+    return result, total / repeats * 1000
@@ -0,0 +1,67 @@
+import pytest
+
+corpus = [
+    (
+        "a photo of a cat",
+        "",
+        {"Steps": 20, "Sampler": "Euler a", "CFG scale": 7, "Seed": 965400086, "Size": "512x512", "Model hash": "45dee52b"},
+    ),
+    (
+        "masterpiece, best quality, (1girl:1.2), [red|blue] hair\nBREAK outdoors",
+        "lowres, bad hands\nwatermark",
+        {"Steps": 30, "Sampler": "DPM++ 2M", "Schedule type": "Karras", "CFG scale": 5.5, "Seed": 1, "Size": "832x1216", "Clip skip": 2, "Lora hashes": "add_detail: 7c6bad76eb54, more_art: 5b4b4ac3e5d5", "Version": "f0.0.17v1.8.0rc-latest-276-g29be1da7"},
+    ),
+    (
+        "landscape",
+        "ugly",
+        {"Steps": 25, "Sampler": "DDIM", "CFG scale": 7, "Seed": 2, "Size": "768x512", "Denoising strength": 0.45, "Hires upscale": 2, "Hires upscaler": "Latent", "Hires prompt": "landscape, sharp: detailed, \"quoted\"", "Hires negative prompt": "line one\nline two"},
+    ),
+    (
+        "",
+        "",
+        {"Steps": 10, "Sampler": "Euler", "CFG scale": 1, "Seed": 3, "Size": "64x64", "Tiling": "True", "ADetailer model": "face_yolov8n.pt", "Template": "{prompt}, {subject}"},
+    ),
+]
+
+
+def compose(prompt, negative_prompt, params):
+    from modules import infotext_utils
+
+    negative_prompt_text = f"\nNegative prompt: {negative_prompt}" if negative_prompt else ""
+    return f"{prompt}{negative_prompt_text}\n{infotext_utils.compose_generation_parameters(params)}".strip()
+
+
+@pytest.mark.parametrize("prompt,negative_prompt,params", corpus)
+def test_infotext_round_trip(initialize, prompt, negative_prompt, params):
+    from modules import infotext_utils
+
+    parsed_prompt, parsed_negative_prompt, parsed_params = infotext_utils.split_generation_parameters(compose(prompt, negative_prompt, params))
+
+    expected_params = []
+    for k, v in params.items():
+        if k == "Size":
+            width, height = v.split("x")
+            expected_params += [(f"{k}-1", width), (f"{k}-2", height)]
+        else:
+            expected_params.append((k, str(v)))
+
+    assert parsed_prompt == prompt
+    assert parsed_negative_prompt == negative_prompt
+    assert list(parsed_params) == expected_params
+
+
+@pytest.mark.parametrize("prompt,negative_prompt,params", corpus)
+def test_infotext_compose_is_stable(initialize, prompt, negative_prompt, params):
+    from modules import infotext_utils
+
+    text = compose(prompt, negative_prompt, params)
+    parsed_prompt, parsed_negative_prompt, parsed_params = infotext_utils.split_generation_parameters(text)
+
+    recomposed_params = {}
+    for k, v in parsed_params:
+        if k.endswith("-1") and k[:-2] in params:
+            recomposed_params[k[:-2]] = f"{v}x{dict(parsed_params)[k[:-2] + '-2']}"
+        elif not k.endswith("-2") or k[:-2] not in params:
+            recomposed_params[k] = v
+
+    assert compose(parsed_prompt, parsed_negative_prompt, recomposed_params) == text
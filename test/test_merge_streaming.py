@@ -0,0 +1,106 @@
+import types
+
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from modules import merge_streaming
+
+
+def weighted_sum(theta0, theta1, alpha):
+    return ((1 - alpha) * theta0) + (alpha * theta1)
+
+
+@pytest.fixture
+def checkpoints(tmp_path):
+    a = {
+        "model.diffusion_model.out.0.weight": torch.ones(4, 3),
+        "model.diffusion_model.out.0.bias": torch.ones(3, dtype=torch.float16),
+        "model.diffusion_model.input_blocks.0.0.weight": torch.ones(320, 9, 3, 3),
+        "alphas_cumprod": torch.linspace(0, 1, 5),
+        "model.diffusion_model.step": torch.tensor([7], dtype=torch.int64),
+    }
+    b = {
+        "model.diffusion_model.out.0.weight": torch.full((4, 3), 3.0),
+        "model.diffusion_model.out.0.bias": torch.full((3,), 3.0, dtype=torch.float16),
+        "model.diffusion_model.input_blocks.0.0.weight": torch.full((320, 4, 3, 3), 3.0),
+        "alphas_cumprod": torch.zeros(5),
+    }
+
+    infos = []
+    for name, state_dict in [("a", a), ("b", b)]:
+        filename = str(tmp_path / f"{name}.safetensors")
+        save_file(state_dict, filename)
+        infos.append(types.SimpleNamespace(filename=filename))
+
+    return a, b, infos
+
+
+def test_can_merge():
+    assert merge_streaming.can_merge([types.SimpleNamespace(filename="a.safetensors"), None], "safetensors")
+    assert not merge_streaming.can_merge([types.SimpleNamespace(filename="a.ckpt")], "safetensors")
+    assert not merge_streaming.can_merge([types.SimpleNamespace(filename="a.safetensors")], "ckpt")
+
+
+@pytest.mark.parametrize("save_as_half", [False, True])
+def test_weighted_sum_matches_in_memory_merge(tmp_path, checkpoints, save_as_half):
+    a, b, (info_a, info_b) = checkpoints
+
+    merge = merge_streaming.StreamingMerge(info_a, info_b, None, theta_func1=None, theta_func2=weighted_sum, multiplier=0.25, save_as_half=save_as_half, bake_in_vae_filename=None, discard_weights="", skip_keys=[])
+    assert merge.result_is_inpainting_model
+    assert not merge.result_is_instruct_pix2pix_model
+
+    filename = str(tmp_path / "merged.safetensors")
+    merge.save(filename, {"format": "pt", "note": "test"})
+    result = load_file(filename)
+
+    half = torch.float16 if save_as_half else torch.float32
+    assert result.keys() == a.keys()
+    assert result["model.diffusion_model.out.0.weight"].dtype == half
+    assert torch.allclose(result["model.diffusion_model.out.0.weight"].float(), torch.full((4, 3), 1.5))
+    assert torch.allclose(result["model.diffusion_model.out.0.bias"].float(), torch.full((3,), 1.5))
+
+    # only the first four channels of an inpainting model are merged
+    inpainting = result["model.diffusion_model.input_blocks.0.0.weight"].float()
+    assert torch.allclose(inpainting[:, :4], torch.full((320, 4, 3, 3), 1.5))
+    assert torch.allclose(inpainting[:, 4:], torch.ones(320, 5, 3, 3))
+
+    # tensors outside of the model or missing from B are taken from A
+    assert torch.equal(result["alphas_cumprod"], a["alphas_cumprod"])
+    assert torch.equal(result["model.diffusion_model.step"], a["model.diffusion_model.step"])
+
+    with safe_open(filename, framework="pt") as file:
+        assert file.metadata() == {"format": "pt", "note": "test"}
+
+    assert not (tmp_path / "merged.safetensors.tmp").exists()
+
+
+def test_header_is_aligned(tmp_path, checkpoints):
+    _, _, (info_a, _) = checkpoints
+
+    merge = merge_streaming.StreamingMerge(info_a, None, None, theta_func1=None, theta_func2=None, multiplier=0, save_as_half=True, bake_in_vae_filename=None, discard_weights="alphas", skip_keys=[])
+
+    filename = str(tmp_path / "pruned.safetensors")
+    merge.save(filename)
+
+    with open(filename, "rb") as file:
+        header_size = int.from_bytes(file.read(8), "little")
+        header = file.read(header_size).decode("utf8")
+
+    assert header_size % 8 == 0
+    assert '"__metadata__"' not in header
+
+    result = load_file(filename)
+    assert "alphas_cumprod" not in result
+    assert result["model.diffusion_model.step"].dtype == torch.int64
+    assert result["model.diffusion_model.out.0.weight"].dtype == torch.float16
+
+
+def test_metadata_must_be_strings(tmp_path, checkpoints):
+    _, _, (info_a, _) = checkpoints
+
+    merge = merge_streaming.StreamingMerge(info_a, None, None, theta_func1=None, theta_func2=None, multiplier=0, save_as_half=False, bake_in_vae_filename=None, discard_weights="", skip_keys=[])
+
+    with pytest.raises(ValueError):
+        merge.save(str(tmp_path / "merged.safetensors"), {"count": 1})
@@ -0,0 +1,17 @@
+from modules import postprocessing
+
+
+def test_existing_output_names(tmp_path):
+    for filename in ["00001-cat.png", "00001-cat-0000.PNG", "dog.jpg", "caption.txt"]:
+        (tmp_path / filename).write_bytes(b"")
+
+    names = postprocessing.existing_output_names(str(tmp_path), "png")
+
+    assert names == {"00001-cat", "00001-cat-0000"}
+
+    # only exact names count: an output of "00001-ca" would not be named like the existing ones
+    assert "00001-ca" not in names
+
+
+def test_existing_output_names_missing_directory(tmp_path):
+    assert postprocessing.existing_output_names(str(tmp_path / "missing"), "png") == set()
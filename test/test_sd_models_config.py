@@ -0,0 +1,57 @@
+import pytest
+
+from modules import sd_models_config
+
+unet_input = {"model.diffusion_model.input_blocks.0.0.weight": (320, 4, 3, 3)}
+
+sd1 = {
+    **unet_input,
+    "cond_stage_model.transformer.text_model.embeddings.token_embedding.weight": (49408, 768),
+}
+
+sd2 = {
+    **unet_input,
+    "cond_stage_model.model.transformer.resblocks.0.attn.in_proj_weight": (3072, 1024),
+    "cond_stage_model.model.ln_final.weight": (1024,),
+}
+
+sd2_turbo = {
+    **unet_input,
+    "conditioner.embedders.0.model.transformer.resblocks.0.attn.in_proj_weight": (3072, 1024),
+    "conditioner.embedders.0.model.ln_final.weight": (1024,),
+}
+
+sdxl = {
+    **unet_input,
+    "model.diffusion_model.middle_block.1.transformer_blocks.0.attn1.to_q.weight": (1280, 1280),
+    "conditioner.embedders.0.transformer.text_model.final_layer_norm.weight": (768,),
+    "conditioner.embedders.1.model.ln_final.weight": (1280,),
+}
+
+ssd = {k: v for k, v in sdxl.items() if "middle_block" not in k}
+
+sdxl_refiner = {
+    "model.diffusion_model.input_blocks.0.0.weight": (384, 4, 3, 3),
+    "conditioner.embedders.0.model.ln_final.weight": (1280,),
+}
+
+epsilon = {"modelspec.prediction_type": "epsilon"}
+v_prediction = {"modelspec.prediction_type": "v"}
+
+
+@pytest.mark.parametrize("shapes,metadata,config,architecture", [
+    (sd1, None, sd_models_config.config_default, "SD1"),
+    (sd2, epsilon, sd_models_config.config_sd2, "SD2"),
+    (sd2, v_prediction, sd_models_config.config_sd2v, "SD2"),
+    (sd2, None, None, "SD2"),
+    (sd2_turbo, None, None, "SD2"),
+    (sd2_turbo, epsilon, sd_models_config.config_sd2, "SD2"),
+    (sdxl, None, sd_models_config.config_sdxl, "SDXL"),
+    (ssd, None, sd_models_config.config_sdxl, "SSD"),
+    (sdxl_refiner, None, sd_models_config.config_sdxl_refiner, "SDXL Refiner"),
+])
+def test_guess_model_config_from_shapes(shapes, metadata, config, architecture):
+    guessed = sd_models_config.guess_model_config_from_shapes(shapes, metadata)
+
+    assert guessed == config
+    assert sd_models_config.architecture_from_shapes(shapes, guessed) == architecture